@@ -0,0 +1,313 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import repository
+from dates import PERIOD_MONTH, day_range, normalize_date, normalize_timestamp, period_days
+from schema import (CHANGE_LOG_TRIGGERS, FTS_REFRESH, FTS_TRIGGERS, USE_COUNT_REFRESH, USE_COUNT_TRIGGERS,
+                    create_flagged_change_log_triggers, create_flagged_fts_triggers, create_use_count_triggers)
+from storage import STORAGE_FLAT, store_file
+
+# Benchmarks for the catalog's hot paths on a synthetic catalog.
+#
+#   python benchmark.py --scale 100k --output before.json
+#   python benchmark.py --scale 100k --reuse --compare before.json
+#
+# The catalog is generated from a seed, so runs with the same options measure the same
+# data. Tag usage follows a Zipf distribution like a real catalog: a few tags are on most
+# images and most tags are rare. Results are written as JSON for comparing commits.
+
+# Catalog sizes selectable with --scale
+SCALES = {"10k": 10000, "100k": 100000, "1m": 1000000}
+# Rows per executemany while generating
+GENERATE_BATCH_SIZE = 10000
+# Rows in one page of the image table (a visible screen plus prefetch)
+PAGE_SIZE = 60
+# Tags entered when timing insert and edit
+BENCHMARK_TAGS_PER_EDIT = 8
+# Existing files sharing a name when timing collision probing in the flat layout
+BENCHMARK_COLLISIONS = 200
+
+# A valid 1x1 PNG, used for every dummy image file
+def tiny_png():
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    header = struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(b"\x00\xff\xff\xff")) + chunk(b"IEND", b""))
+
+def random_word(rng, low=3, high=10):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(low, high)))
+
+def unique_words(rng, count, prefix=""):
+    words = set()
+    while len(words) < count:
+        words.add(prefix + random_word(rng))
+    return sorted(words)
+
+# Cumulative Zipf weights for ranks 1..count
+def zipf_weights(count, exponent):
+    return list(itertools.accumulate(1.0 / rank ** exponent for rank in range(1, count + 1)))
+
+# Write a catalog of the given size to database_path, with dummy files in files_dir
+def generate_catalog(database_path, files_dir, images, tags, creators, files, tags_per_image, zipf, seed):
+    rng = random.Random(seed)
+    if os.path.exists(database_path):
+        os.remove(database_path)
+    conn = repository.connect(database_path, report=lambda line: None)
+    cursor = conn.cursor()
+
+    # Keep the full-text index and tag counts out of the bulk load and build them once at the end;
+    # a freshly generated catalog has no other instances to tell about its rows
+    for name in list(FTS_TRIGGERS) + ["images_fts_image_delete"] + list(USE_COUNT_TRIGGERS) + list(CHANGE_LOG_TRIGGERS):
+        cursor.execute("DROP TRIGGER IF EXISTS {}".format(name))
+
+    cursor.executemany("INSERT INTO creators (creator_name) VALUES (?)",
+                       [(name,) for name in unique_words(rng, creators)])
+    cursor.executemany("INSERT INTO tags (tag_name, tag_description, category) VALUES (?, ?, ?)",
+                       [(name, random_word(rng, 5, 20), rng.choice(("general", "character", "meta")))
+                        for name in unique_words(rng, tags)])
+    # Most common tags first, so Zipf rank 1 is tag_id 1
+    tag_ids = [row[0] for row in cursor.execute("SELECT tag_id FROM tags ORDER BY tag_id")]
+    creator_ids = [row[0] for row in cursor.execute("SELECT creator_id FROM creators")]
+    weights = zipf_weights(len(tag_ids), zipf)
+
+    os.makedirs(files_dir, exist_ok=True)
+    png = tiny_png()
+    file_paths = []
+    for index in range(files):
+        path = os.path.join(files_dir, "image_{}.png".format(index))
+        with open(path, "wb") as dummy:
+            dummy.write(png)
+        file_paths.append(path)
+
+    start_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    for first in range(1, images + 1, GENERATE_BATCH_SIZE):
+        ids = range(first, min(first + GENERATE_BATCH_SIZE, images + 1))
+        image_rows = []
+        tag_rows = []
+        for image_id in ids:
+            path = file_paths[image_id % len(file_paths)] if file_paths else os.path.join(files_dir, "missing.png")
+            added = start_date + timedelta(seconds=rng.randrange(5 * 365 * 86400))
+            uploaded = added - timedelta(days=rng.randrange(3 * 365))
+            image_rows.append((image_id, "{}_{}.png".format(random_word(rng), image_id), path,
+                               rng.choice(creator_ids), "https://example.com/{}".format(image_id),
+                               normalize_timestamp(added), normalize_date(uploaded),
+                               "{:064x}".format(rng.getrandbits(256))))
+            count = rng.randint(0, 2 * tags_per_image)
+            chosen = set(rng.choices(tag_ids, cum_weights=weights, k=count))
+            tag_rows.extend((image_id, tag_id) for tag_id in chosen)
+        cursor.executemany('''INSERT INTO images (image_id, filename, directory_path, creator_id, source_url,
+                              date_added, date_uploaded, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                           image_rows)
+        cursor.executemany("INSERT INTO image_tags (image_id, tag_id) VALUES (?, ?)", tag_rows)
+
+    for statement in FTS_REFRESH.format("1").split(";"):
+        if statement.strip():
+            cursor.execute(statement)
+    create_flagged_fts_triggers(cursor)
+    cursor.execute(USE_COUNT_REFRESH)
+    create_use_count_triggers(cursor)
+    create_flagged_change_log_triggers(cursor)
+    conn.commit()
+    cursor.execute("ANALYZE")
+    conn.close()
+
+# Time function over repeat runs; cleanup runs after each one, untimed
+def measure(function, repeat, cleanup=None):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+        if cleanup:
+            cleanup()
+    return {"repeat": repeat,
+            "min_ms": min(timings) * 1000,
+            "median_ms": statistics.median(timings) * 1000,
+            "mean_ms": statistics.fmean(timings) * 1000,
+            "max_ms": max(timings) * 1000}
+
+def benchmark_image_pages(conn, rng, repeat):
+    cursor = conn.cursor()
+    results = {}
+    for column in ("image_id", "filename", "creator", "date_added", "date_uploaded"):
+        # First page as shown by display_image_data, and a page from deep in the table
+        query, params = repository.image_page_query(column, False, repository.IMAGE_SOURCE, None, PAGE_SIZE)
+        results["image_page.first." + column] = measure(lambda: cursor.execute(query, params).fetchall(), repeat)
+
+        sort_expr = repository.IMAGE_SORT_COLUMNS[column]
+        total = cursor.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        middle = cursor.execute(repository.IMAGE_ROW_SELECT.format(sort_expr, repository.IMAGE_SOURCE)
+                                + "ORDER BY sort_key, i.image_id LIMIT 1 OFFSET ?", (total // 2,)).fetchone()
+        query, params = repository.image_page_query(column, False, repository.IMAGE_SOURCE,
+                                                    (middle[-1], middle[0]), PAGE_SIZE)
+        results["image_page.deep." + column] = measure(lambda: cursor.execute(query, params).fetchall(), repeat)
+
+    # A month picked from the timeline, and the timeline itself
+    months = [period for period, _ in repository.date_timeline(cursor, "date_added", PERIOD_MONTH)]
+    ranges = iter([("date_added",) + day_range(*period_days(month)) for month in rng.choices(months, k=repeat)])
+    results["image_page.date_range"] = measure(lambda: cursor.execute(*repository.image_page_query(
+        "date_added", False, repository.IMAGE_SOURCE, None, PAGE_SIZE, next(ranges))).fetchall(), repeat)
+    results["timeline.months"] = measure(lambda: repository.date_timeline(cursor, "date_added", PERIOD_MONTH), repeat)
+    return results
+
+def benchmark_writes(conn, rng, repeat):
+    cursor = conn.cursor()
+    tag_names = [row[0] for row in cursor.execute("SELECT tag_name FROM tags")]
+    creator_names = [row[0] for row in cursor.execute("SELECT creator_name FROM creators")]
+    image_ids = [row[0] for row in cursor.execute("SELECT image_id FROM images")]
+
+    # Half existing tags, half new ones, as typed into the add and edit windows
+    def entered_tags():
+        existing = rng.sample(tag_names, min(len(tag_names), BENCHMARK_TAGS_PER_EDIT // 2))
+        return existing + [random_word(rng) + "_new" for _ in range(BENCHMARK_TAGS_PER_EDIT - len(existing))]
+
+    # Inputs are drawn up front so only the calls themselves are timed
+    inserts = iter([("bench/insert.png", rng.choice(creator_names), "", entered_tags(),
+                     str(datetime.now(timezone.utc)), "") for _ in range(repeat)])
+    edits = iter([(rng.choice(image_ids), rng.choice(creator_names), "", entered_tags(),
+                   str(datetime.now(timezone.utc)), "") for _ in range(repeat)])
+    fetches = iter([rng.choice(image_ids) for _ in range(repeat)])
+
+    # Writes are rolled back so every run sees the same catalog
+    results = {}
+    results["insert.tag_resolution"] = measure(lambda: repository.add_image(cursor, *next(inserts)),
+                                               repeat, conn.rollback)
+    results["edit.tag_diff"] = measure(lambda: repository.edit_image(cursor, *next(edits)), repeat, conn.rollback)
+    results["fetch_image"] = measure(lambda: repository.fetch_image(cursor, next(fetches)), repeat)
+    return results
+
+def benchmark_autocomplete(conn, rng, repeat):
+    # helpers needs the GUI packages, but autocomplete's lookup itself runs without a window
+    from prefix_index import AUTOCOMPLETE_MAX_HITS, PrefixIndex
+
+    use_counts = dict(conn.execute("SELECT tag_name, use_count FROM tags"))
+    tag_names = list(use_counts)
+    results = {}
+    for name, weights in (("autocomplete.keystroke", None), ("autocomplete.keystroke_ranked", use_counts)):
+        started = time.perf_counter()
+        index = PrefixIndex(tag_names, weights=weights)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        # The same lookup AutocompleteMultiEntry.autocomplete makes for each keystroke
+        keystrokes = iter([(tag_name[:rng.randint(1, 3)], set(rng.sample(tag_names, 3)))
+                           for tag_name in rng.choices(tag_names, k=repeat)])
+        results[name] = measure(lambda: index.matches(*next(keystrokes), limit=AUTOCOMPLETE_MAX_HITS), repeat)
+        results[name]["build_ms"] = build_ms
+    return results
+
+def benchmark_store_file(repeat):
+    directory = tempfile.mkdtemp(prefix="benchmark_store_")
+    source_dir = tempfile.mkdtemp(prefix="benchmark_source_")
+    try:
+        source = os.path.join(source_dir, "collide.png")
+        with open(source, "wb") as dummy:
+            dummy.write(tiny_png())
+        # The flat layout probes collide.png, collide_1.png, ... until a name is free
+        for index in range(BENCHMARK_COLLISIONS):
+            name = "collide.png" if index == 0 else "collide_{}.png".format(index)
+            shutil.copy(source, os.path.join(directory, name))
+
+        stored = []
+        result = measure(lambda: stored.append(store_file(source, directory, STORAGE_FLAT)[0]), repeat,
+                         lambda: os.remove(stored.pop()))
+        result["collisions"] = BENCHMARK_COLLISIONS
+        return {"store_file.collisions": result}
+    finally:
+        shutil.rmtree(directory)
+        shutil.rmtree(source_dir)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_benchmarks(database_path, repeat, seed):
+    rng = random.Random(seed)
+    conn = repository.open_connection(database_path)
+    results = {}
+    try:
+        results.update(benchmark_image_pages(conn, rng, repeat))
+        results.update(benchmark_writes(conn, rng, repeat))
+        results.update(benchmark_autocomplete(conn, rng, repeat))
+        results.update(benchmark_store_file(repeat))
+    finally:
+        conn.close()
+    return results
+
+# Median change of each benchmark against an earlier results file
+def compare(results, baseline):
+    lines = []
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before:
+            ratio = result["median_ms"] / before["median_ms"] if before["median_ms"] else float("inf")
+            lines.append("{}: {:.3f} ms -> {:.3f} ms ({:+.1f}%)".format(
+                name, before["median_ms"], result["median_ms"], (ratio - 1) * 100))
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the catalog's hot paths on a synthetic catalog.")
+    parser.add_argument("--scale", choices=SCALES, default="10k", help="number of images")
+    parser.add_argument("--tags", type=int, default=50000)
+    parser.add_argument("--creators", type=int, default=2000)
+    parser.add_argument("--tags-per-image", type=int, default=6, help="average number of tags on an image")
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the tag usage distribution")
+    parser.add_argument("--files", type=int, default=1000, help="dummy image files shared by the rows")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=20, help="runs of each benchmark")
+    parser.add_argument("--database", default="benchmark_database.db")
+    parser.add_argument("--files-dir", default="benchmark_images")
+    parser.add_argument("--reuse", action="store_true", help="use an existing generated database as is")
+    parser.add_argument("--output", help="write the results as JSON to this file (standard output by default)")
+    parser.add_argument("--compare", help="earlier results file to compare medians against")
+    args = parser.parse_args(argv)
+
+    catalog = {"images": SCALES[args.scale], "tags": args.tags, "creators": args.creators, "files": args.files,
+               "tags_per_image": args.tags_per_image, "zipf": args.zipf, "seed": args.seed}
+    if not (args.reuse and os.path.exists(args.database)):
+        started = time.perf_counter()
+        generate_catalog(args.database, args.files_dir, catalog["images"], catalog["tags"], catalog["creators"],
+                         catalog["files"], catalog["tags_per_image"], catalog["zipf"], catalog["seed"])
+        print("Generated {} images in {:.1f} s".format(catalog["images"], time.perf_counter() - started),
+              file=sys.stderr)
+
+    report = {"commit": git_commit(),
+              "timestamp": datetime.now(timezone.utc).isoformat(),
+              "python": platform.python_version(),
+              "sqlite": sqlite3.sqlite_version,
+              "platform": platform.platform(),
+              "catalog": catalog,
+              "results": run_benchmarks(args.database, args.repeat, args.seed)}
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline:
+            for line in compare(report["results"], json.load(baseline)):
+                print(line, file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
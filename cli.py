@@ -0,0 +1,428 @@
+import argparse
+import sys
+
+# Command-line access to the catalog for scripts and scheduled jobs, e.g.
+#
+#   python cli.py add photo.jpg --creator "Some Artist" --tags cat,night
+#   python cli.py import ~/Downloads/art --creator-from-folder --creator Unsorted
+#   python cli.py search "cat AND NOT sketch"
+#
+# Only argparse and sys are imported up front. Each command imports what it needs when it
+# runs, so the CLI starts quickly and never loads tkinter or the other GUI packages.
+
+def split_tags(text):
+    return [tag.strip() for tag in (text or "").split(",") if tag.strip()]
+
+# argparse type for dates; stored as YYYY-MM-DD
+def upload_date(text):
+    from dates import normalize_date
+    try:
+        return normalize_date(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a date such as 2024-05-31, got {!r}".format(text))
+
+def log(message):
+    print(message, file=sys.stderr)
+
+def open_catalog(args):
+    import repository
+    return repository.connect(args.database, report=log)
+
+def command_add(args):
+    from datetime import datetime, timezone
+    import repository
+    from duplicates import dhash, to_signed
+    from metadata import try_read_metadata
+
+    conn = open_catalog(args)
+    cursor = conn.cursor()
+    path, content_hash, is_new, duplicate = repository.store_image(cursor, args.file, args.destination, args.storage)
+    if duplicate and not args.allow_duplicate:
+        repository.remove_stored(path, is_new)
+        log("Skipped {}: already catalogued as image {}".format(args.file, duplicate))
+        return 1
+
+    try:
+        phash = to_signed(dhash(path))
+    except (OSError, ValueError):
+        phash = None
+    changes = repository.add_image(cursor, path, args.creator, args.source, split_tags(args.tags),
+                                   datetime.now(timezone.utc), args.uploaded, content_hash, phash,
+                                   try_read_metadata(path))
+    conn.commit()
+    conn.close()
+    print(*changes.images)
+    return 0
+
+def command_import(args):
+    import queue
+    from importer import BulkImporter
+
+    # The importer expects an up to date schema
+    open_catalog(args).close()
+    importer = BulkImporter(args.database, args.destination, args.folder, creator_name=args.creator,
+                            tags=split_tags(args.tags), creator_from_folder=args.creator_from_folder,
+                            storage_mode=args.storage)
+    importer.start()
+    errors = 0
+    while True:
+        try:
+            message = importer.progress.get(timeout=1)
+        except queue.Empty:
+            continue
+        except KeyboardInterrupt:
+            # Stop after the current batch; everything written so far stays
+            log("Cancelling after the current batch...")
+            importer.cancel()
+            continue
+
+        if message[0] == "batch":
+            log("Imported {} file(s)".format(message[1]))
+        elif message[0] == "error":
+            errors += 1
+            log("Import error: {}: {}".format(message[1], message[2]))
+        elif message[0] == "done":
+            log("{}: imported {} file(s), {} already catalogued, {} error(s)".format(
+                "Cancelled" if importer.cancelled.is_set() else "Finished", message[1], importer.skipped, errors))
+            return 1 if errors else 0
+
+def command_tag(args):
+    import repository
+
+    if not args.add and not args.remove:
+        log("Nothing to do: give --add and/or --remove.")
+        return 2
+    conn = open_catalog(args)
+    cursor = conn.cursor()
+    missing = set(args.image_ids) - set(repository.image_paths(cursor, args.image_ids))
+    if missing:
+        log("No such image(s): {}".format(", ".join(str(image_id) for image_id in sorted(missing))))
+        return 1
+    repository.tag_images(cursor, args.image_ids, split_tags(args.add), split_tags(args.remove))
+    conn.commit()
+    conn.close()
+    return 0
+
+# Move images to the trash and print the batch that restores them
+def command_delete(args):
+    import repository
+
+    conn = open_catalog(args)
+    cursor = conn.cursor()
+    changes = repository.delete_images(cursor, args.image_ids)
+    conn.commit()
+    conn.close()
+    missing = set(args.image_ids) - changes.images
+    if missing:
+        log("No such image(s): {}".format(", ".join(str(image_id) for image_id in sorted(missing))))
+    if changes.trash_batch is not None:
+        print(changes.trash_batch)
+    return 1 if missing else 0
+
+def command_delete_creator(args):
+    import repository
+
+    conn = open_catalog(args)
+    cursor = conn.cursor()
+    creators = dict(cursor.execute("SELECT creator_name, creator_id FROM creators").fetchall())
+    missing = [name for name in args.creators if name not in creators]
+    if missing:
+        log("No such creator(s): {}".format(", ".join(missing)))
+        return 1
+    try:
+        changes = repository.delete_creators(cursor, [creators[name] for name in args.creators], args.reassign_to)
+    except ValueError as error:
+        log(error)
+        return 1
+    conn.commit()
+    conn.close()
+    if changes.trash_batch is not None:
+        print(changes.trash_batch)
+    return 0
+
+# Restore or empty trash batches, then list what is left
+def command_trash(args):
+    import repository
+    from trash import TrashCollector
+
+    if args.purge and args.empty:
+        log("Give --purge or --empty, not both.")
+        return 2
+    conn = open_catalog(args)
+    cursor = conn.cursor()
+    try:
+        if args.restore is not None:
+            try:
+                changes = repository.restore_trash(cursor, args.restore)
+            except ValueError as error:
+                log(error)
+                return 1
+            conn.commit()
+            log("Restored {} image(s)".format(len(changes.images)))
+        if args.purge or args.empty:
+            batch_ids = [row[0] for row in repository.trash_batches(cursor)] if args.empty else None
+            batches, removed = TrashCollector(args.database, batch_ids=batch_ids).collect(conn)
+            log("Emptied {} trash batch(es), removing {} file(s)".format(batches, removed))
+        for batch_id, deleted_at, images, files in repository.trash_batches(cursor):
+            print("{}\t{}\t{}\t{}".format(batch_id, deleted_at, images, files))
+    finally:
+        conn.close()
+    return 0
+
+def command_search(args):
+    import repository
+    from search import QueryError, TagIndex, text_search
+
+    conn = open_catalog(args)
+    cursor = conn.cursor()
+    try:
+        if args.text:
+            image_ids = text_search(cursor, args.query, limit=args.limit or -1)
+        else:
+            index = TagIndex()
+            index.build(cursor)
+            image_ids = index.search(args.query, cursor)
+            if args.limit:
+                image_ids = image_ids[:args.limit]
+    except QueryError as error:
+        log("Invalid search: {}".format(error))
+        return 2
+
+    paths = repository.image_paths(cursor, image_ids)
+    for image_id in image_ids:
+        print("{}\t{}".format(image_id, paths.get(image_id)))
+    conn.close()
+    return 0
+
+def command_tags(args):
+    import repository
+
+    conn = open_catalog(args)
+    cursor = conn.cursor()
+    if args.prune:
+        changes = repository.delete_unused_tags(cursor)
+        conn.commit()
+        log("Deleted {} unused tag(s)".format(len(changes.tags)))
+    for tag_name, use_count in repository.tag_usage(cursor, args.limit or None):
+        print("{}\t{}".format(use_count, tag_name))
+    conn.close()
+    return 0
+
+# Add or remove an alias, then list them all
+def command_alias(args):
+    import repository
+
+    if args.alias and not args.tag and not args.remove:
+        log("Give the tag the alias stands for, or --remove.")
+        return 2
+    conn = open_catalog(args)
+    cursor = conn.cursor()
+    try:
+        if args.alias and args.remove:
+            repository.remove_tag_alias(cursor, args.alias)
+        elif args.alias:
+            repository.add_tag_alias(cursor, args.alias, args.tag)
+    except ValueError as error:
+        log(error)
+        return 1
+    conn.commit()
+    aliases, _ = repository.tag_rules(cursor)
+    for alias_name, tag_name in aliases:
+        print("{}\t{}".format(alias_name, tag_name))
+    conn.close()
+    return 0
+
+# Add or remove an implication, then list them all
+def command_imply(args):
+    import repository
+
+    if bool(args.tag) != bool(args.implied):
+        log("Give both the tag and the tag it implies.")
+        return 2
+    conn = open_catalog(args)
+    cursor = conn.cursor()
+    try:
+        if args.tag and args.remove:
+            repository.remove_tag_implication(cursor, args.tag, args.implied)
+        elif args.tag:
+            repository.add_tag_implication(cursor, args.tag, args.implied)
+    except ValueError as error:
+        log(error)
+        return 1
+    conn.commit()
+    _, implications = repository.tag_rules(cursor)
+    for tag_name, implied_name in implications:
+        print("{}\t{}".format(tag_name, implied_name))
+    conn.close()
+    return 0
+
+def command_export(args):
+    import csv
+    import repository
+
+    conn = open_catalog(args)
+    output = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        writer = csv.writer(output)
+        writer.writerow(["image_id", "filename", "creator", "source_url", "tags", "date_added",
+                         "date_uploaded", "directory_path", "content_hash"])
+        writer.writerows(repository.iter_images(conn.cursor()))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        conn.close()
+    return 0
+
+def command_metadata(args):
+    from metadata import MetadataBackfill
+
+    conn = open_catalog(args)
+    try:
+        read = MetadataBackfill(args.database).backfill(conn)
+    finally:
+        conn.close()
+    log("Read metadata of {} image(s)".format(read))
+    return 0
+
+def command_check(args):
+    from integrity import IntegrityScan, fix_problems
+
+    conn = open_catalog(args)
+    try:
+        scan = IntegrityScan(args.database, args.destination, incremental=args.incremental)
+        report = scan.scan(conn)
+        for kind, image_id, path in report.rows():
+            print("{}\t{}\t{}".format(kind, "" if image_id is None else image_id, path))
+        log("Checked {} image(s) and {} file(s), hashed {}: {} problem(s)".format(
+            report.images, report.files, report.hashed, report.problems()))
+        if args.fix and report.problems():
+            changes, deleted = fix_problems(conn.cursor(), report)
+            conn.commit()
+            log("Relinked {} moved image(s), deleted {} orphan file(s)".format(len(changes.images), len(deleted)))
+            return 1 if len(report.missing) > len(changes.images) or report.mismatched else 0
+    finally:
+        conn.close()
+    return 1 if report.problems() else 0
+
+def command_backup(args):
+    from transfer import export_catalog
+
+    conn = open_catalog(args)
+    try:
+        export_catalog(conn, args.output, report=log)
+    finally:
+        conn.close()
+    return 0
+
+def command_restore(args):
+    from transfer import import_catalog
+
+    conn = open_catalog(args)
+    try:
+        import_catalog(conn, args.input, report=log)
+    except ValueError as error:
+        log(error)
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Manage an Image Keeper catalog without the GUI.")
+    # Matches repository.DATABASE_PATH and IMAGE_DESTINATION, kept literal so --help needs no imports
+    parser.add_argument("--database", default="image_database.db", help="catalog database file")
+    parser.add_argument("--destination", default="images", help="folder images are copied into")
+    parser.add_argument("--storage", choices=("flat", "hashed"), default="flat",
+                        help="flat keeps filenames, hashed stores files by content hash")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="copy one image into the catalog")
+    add.add_argument("file")
+    add.add_argument("--creator", required=True)
+    add.add_argument("--tags", help="comma-separated tag names")
+    add.add_argument("--source", default="", help="source URL")
+    add.add_argument("--uploaded", type=upload_date, help="upload date (YYYY-MM-DD)")
+    add.add_argument("--allow-duplicate", action="store_true", help="add the image even if its content is catalogued")
+    add.set_defaults(handler=command_add)
+
+    folder = commands.add_parser("import", help="import every image below a folder")
+    folder.add_argument("folder")
+    folder.add_argument("--creator", required=True, help="creator of the images (or of top-level files)")
+    folder.add_argument("--creator-from-folder", action="store_true", help="use subfolder names as creators")
+    folder.add_argument("--tags", help="comma-separated tags added to every image")
+    folder.set_defaults(handler=command_import)
+
+    tag = commands.add_parser("tag", help="add or remove tags on images")
+    tag.add_argument("image_ids", type=int, nargs="+")
+    tag.add_argument("--add", help="comma-separated tags to add")
+    tag.add_argument("--remove", help="comma-separated tags to remove")
+    tag.set_defaults(handler=command_tag)
+
+    delete = commands.add_parser("delete", help="move images to the trash and print the batch that restores them")
+    delete.add_argument("image_ids", type=int, nargs="+")
+    delete.set_defaults(handler=command_delete)
+
+    delete_creator = commands.add_parser("delete-creator", help="delete creators with their images, or give the images to another")
+    delete_creator.add_argument("creators", nargs="+", help="creator names")
+    delete_creator.add_argument("--reassign-to", metavar="CREATOR",
+                                help="give their images and handles to this creator instead of deleting them")
+    delete_creator.set_defaults(handler=command_delete_creator)
+
+    trash = commands.add_parser("trash", help="list deleted images by batch (id, deleted at, images, files)")
+    trash.add_argument("--restore", type=int, metavar="BATCH", help="bring back the images of a batch")
+    trash.add_argument("--purge", action="store_true",
+                       help="remove the files of batches past the undo period (7 days), as the app does at start")
+    trash.add_argument("--empty", action="store_true", help="remove the files of every batch now")
+    trash.set_defaults(handler=command_trash)
+
+    search = commands.add_parser("search", help="print the id and path of matching images")
+    search.add_argument("query")
+    search.add_argument("--text", action="store_true", help="full-text search ranked by relevance")
+    search.add_argument("--limit", type=int, default=0, help="largest number of results (0 for all)")
+    search.set_defaults(handler=command_search)
+
+    tags = commands.add_parser("tags", help="print each tag with the number of images using it")
+    tags.add_argument("--limit", type=int, default=0, help="largest number of tags (0 for all)")
+    tags.add_argument("--prune", action="store_true", help="delete tags no image uses first")
+    tags.set_defaults(handler=command_tags)
+
+    alias = commands.add_parser("alias", help="make a name stand for a tag, or list aliases")
+    alias.add_argument("alias", nargs="?", help="the other name; an existing tag of that name is merged")
+    alias.add_argument("tag", nargs="?", help="the tag it stands for")
+    alias.add_argument("--remove", action="store_true", help="delete the alias instead")
+    alias.set_defaults(handler=command_alias)
+
+    imply = commands.add_parser("imply", help="make searches for a tag find images of another, or list implications")
+    imply.add_argument("tag", nargs="?", help="e.g. kitten")
+    imply.add_argument("implied", nargs="?", help="e.g. cat")
+    imply.add_argument("--remove", action="store_true", help="delete the implication instead")
+    imply.set_defaults(handler=command_imply)
+
+    export = commands.add_parser("export", help="write every image as CSV")
+    export.add_argument("--output", help="file to write (standard output by default)")
+    export.set_defaults(handler=command_export)
+
+    metadata = commands.add_parser("metadata", help="read the size, format and EXIF details of images catalogued without them")
+    metadata.set_defaults(handler=command_metadata)
+
+    check = commands.add_parser("check", help="compare the catalog with the files in the image folder")
+    check.add_argument("--incremental", action="store_true", help="only hash files changed since the last check")
+    check.add_argument("--fix", action="store_true",
+                       help="relink moved files and delete orphan files older than an hour")
+    check.set_defaults(handler=command_check)
+
+    backup = commands.add_parser("backup", help="export creators, tags and their rules, images and socials")
+    backup.add_argument("output", help="a .jsonl or .jsonl.gz file, or a folder to fill with CSV files")
+    backup.set_defaults(handler=command_backup)
+
+    restore = commands.add_parser("restore", help="merge a backup into the catalog, resuming if interrupted")
+    restore.add_argument("input", help="a file or folder written by backup")
+    restore.set_defaults(handler=command_restore)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+from datetime import date, datetime, timedelta, timezone
+
+# Dates are stored as ISO 8601 text: date_added as a UTC timestamp and date_uploaded as a
+# calendar date. Both sort chronologically as text, so ordering and range filters can
+# scan the (COALESCE(column, ''), image_id) indexes.
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+DATE_FORMAT = "%Y-%m-%d"
+# Times without a zone, such as when a photo was taken by the camera's clock
+LOCAL_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Formats tried for upload dates typed before they were normalized, starting with the
+# short US format DateEntry shows by default
+LEGACY_DATE_FORMATS = ("%m/%d/%y", "%m/%d/%Y", "%d.%m.%y", "%d.%m.%Y", "%Y/%m/%d", "%d/%m/%Y")
+
+# Timeline periods, as the length of the ISO prefix they group by
+PERIOD_YEAR = 4
+PERIOD_MONTH = 7
+PERIOD_DAY = 10
+
+def parse_date(text):
+    text = text.strip()
+    try:
+        return date.fromisoformat(text[:10])
+    except ValueError:
+        pass
+    for date_format in LEGACY_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+    raise ValueError("Not a date: {!r}".format(text))
+
+# Stored form of date_added; naive datetimes are taken to be UTC, dates to be midnight.
+# Empty values are stored as NULL and unreadable text raises ValueError.
+def normalize_timestamp(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.strip())
+        except ValueError:
+            value = parse_date(value)
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+# Stored form of date_uploaded
+def normalize_date(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = parse_date(value)
+    return value.strftime(DATE_FORMAT)
+
+# Text bounds selecting the days start..end (inclusive) from either column; None leaves an end open.
+# A day's timestamps all sort after the bare date and before the next day.
+def day_range(start=None, end=None):
+    lower = normalize_date(start)
+    upper = normalize_date(end)
+    if upper is not None:
+        upper = (parse_date(upper) + timedelta(days=1)).strftime(DATE_FORMAT)
+    if lower is not None and upper is not None and lower >= upper:
+        raise ValueError("The start date is after the end date")
+    return lower, upper
+
+# First and last day of the period a timeline key such as "2024" or "2024-05" names
+def period_days(key):
+    if len(key) == PERIOD_YEAR:
+        return "{}-01-01".format(key), "{}-12-31".format(key)
+    if len(key) == PERIOD_MONTH:
+        first = date.fromisoformat(key + "-01")
+        following = date(first.year + first.month // 12, first.month % 12 + 1, 1)
+        return first.strftime(DATE_FORMAT), (following - timedelta(days=1)).strftime(DATE_FORMAT)
+    return key, key
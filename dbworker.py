@@ -0,0 +1,114 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from repository import open_connection
+
+# Milliseconds between checks for finished database work
+DATABASE_POLL_MS = 20
+
+def task_name(function):
+    return getattr(function, "__name__", type(function).__name__)
+
+# Runs all database work on one thread that owns the connection.
+#
+# Work is a function taking a cursor as its first argument. Each one runs in its own
+# transaction, committed when it returns and rolled back if it raises. Results are handed
+# back to the Tk thread through callbacks delivered with after(), so the mainloop never
+# waits on SQLite.
+class DatabaseWorker:
+    def __init__(self, root, database_path, on_error=None, diagnostics=None):
+        self.root = root
+        self.database_path = database_path
+        # Called with the exception of failed work that has no errback of its own
+        self.on_error = on_error
+        # Optional diagnostics.Diagnostics timing statements and work
+        self.diagnostics = diagnostics
+
+        self.tasks = queue.Queue()      # (future, function, args), or None to stop
+        self.finished = queue.Queue()   # (future, callback, errback, function, submitted) ready for the Tk thread
+        self.outstanding = 0
+        self.polling = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        conn = open_connection(self.database_path)
+        if self.diagnostics:
+            self.diagnostics.attach(conn)
+        cursor = conn.cursor()
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            future, function, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            try:
+                result = function(cursor, *args)
+                conn.commit()
+            except BaseException as error:
+                conn.rollback()
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+            finally:
+                if self.diagnostics:
+                    self.diagnostics.finish_statement()
+                    self.diagnostics.record("db.run." + task_name(function), time.perf_counter() - started)
+        conn.close()
+
+    # Queue function(cursor, *args); callback(result) or errback(error) later runs on the Tk thread
+    def submit(self, function, *args, callback=None, errback=None):
+        future = Future()
+        submitted = time.perf_counter()
+        future.add_done_callback(lambda done: self.finished.put((done, callback, errback, function, submitted)))
+        self.outstanding += 1
+        self.tasks.put((future, function, args))
+        if not self.polling:
+            self.polling = True
+            self.root.after(DATABASE_POLL_MS, self.poll)
+        return future
+
+    # Run function on the worker and wait for its result; only for startup, before the mainloop runs
+    def call(self, function, *args):
+        future = Future()
+        self.tasks.put((future, function, args))
+        return future.result()
+
+    # Deliver finished work on the Tk thread
+    def poll(self):
+        try:
+            while True:
+                try:
+                    future, callback, errback, function, submitted = self.finished.get_nowait()
+                except queue.Empty:
+                    break
+                self.outstanding -= 1
+                if future.cancelled():
+                    continue
+                # Wall-clock time from submit to delivery, including the wait behind earlier work
+                if self.diagnostics:
+                    self.diagnostics.record("db.wait." + task_name(function), time.perf_counter() - submitted)
+
+                error = future.exception()
+                if error is not None:
+                    handler = errback or self.on_error
+                    if handler:
+                        handler(error)
+                    else:
+                        print("Database error: {}".format(error))
+                elif callback:
+                    callback(future.result())
+        finally:
+            # Keep polling even if a callback raised
+            self.polling = self.outstanding > 0
+            if self.polling:
+                self.root.after(DATABASE_POLL_MS, self.poll)
+
+    # Finish the queued work and close the connection
+    def shutdown(self):
+        self.tasks.put(None)
+        self.thread.join()
@@ -0,0 +1,206 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+
+# Opt-in latency instrumentation, e.g.
+#
+#   IMAGE_KEEPER_DIAGNOSTICS=1 python main.py
+#
+# records how long each SQL statement, database operation and GUI action takes, and
+# reports whenever the Tk mainloop is blocked. Results are shown in the Diagnostics tab
+# and can be dumped to JSON. Without the variable nothing is installed and every
+# recording call returns immediately.
+DIAGNOSTICS_ENV = "IMAGE_KEEPER_DIAGNOSTICS"
+
+# Upper bounds (milliseconds) of the histogram buckets; slower samples go in a last, open bucket
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Milliseconds between mainloop heartbeats, and how late one must be to count as a stall
+HEARTBEAT_MS = 50
+STALL_THRESHOLD_MS = 200
+# Stalls kept with the stack the mainloop was blocked in
+RECENT_STALLS = 50
+# Distinct SQL statements tracked; statements beyond this share one "(other)" entry
+MAX_STATEMENTS = 500
+
+# The trace shows statements with their parameters filled in; literals, and runs of
+# placeholders, vary between calls of the same statement
+STRING = re.compile(r"'(?:[^']|'')*'")
+PLACEHOLDER_RUN = re.compile(r"\?(\s*,\s*\?)+")
+NUMBER = re.compile(r"\b\d+\b")
+WHITESPACE = re.compile(r"\s+")
+
+def enabled_from_environment():
+    return os.environ.get(DIAGNOSTICS_ENV, "") not in ("", "0")
+
+# Statement text with whitespace collapsed and literals folded, so repeats group together
+def normalize_statement(sql):
+    sql = WHITESPACE.sub(" ", sql).strip()
+    # Statements run by triggers are reported as comments naming their tables in quotes
+    if not sql.startswith("--"):
+        sql = STRING.sub("?", sql)
+    sql = PLACEHOLDER_RUN.sub("?, ...", sql)
+    return NUMBER.sub("N", sql)[:300]
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        index = 0
+        while index < len(LATENCY_BUCKETS_MS) and ms > LATENCY_BUCKETS_MS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    # Upper bound of the bucket holding the given fraction of samples, at most the slowest sample
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= wanted:
+                return min(LATENCY_BUCKETS_MS[index], self.max_ms) if index < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.5), 3),
+            "p95_ms": round(self.percentile(0.95), 3),
+            "max_ms": round(self.max_ms, 3),
+            "buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS_MS] + ["inf"], self.buckets)),
+        }
+
+# Collects the measurements; safe to record from the Tk thread and the database worker
+class Diagnostics:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.operations = {}    # GUI actions and database work, name -> LatencyHistogram
+        self.statements = {}    # normalized SQL -> LatencyHistogram
+        self.stalls = []        # (started wall-clock time, milliseconds, mainloop stack)
+        self.pending = {}       # action name -> perf_counter() when it began
+        self.started = time.time()
+
+        # Statement being timed on the connection traced by attach
+        self.current_statement = None
+        self.statement_started = 0.0
+
+        self.heartbeat = None
+        self.stall_stack = None
+        self.watchdog = None
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.operations.setdefault(name, LatencyHistogram()).add(seconds * 1000)
+
+    # Time an action that finishes in a later callback; beginning again restarts it
+    def begin(self, name):
+        if self.enabled:
+            with self.lock:
+                self.pending[name] = time.perf_counter()
+
+    def end(self, name):
+        if not self.enabled:
+            return
+        with self.lock:
+            started = self.pending.pop(name, None)
+        if started is not None:
+            self.record(name, time.perf_counter() - started)
+
+    # Time every statement run on a connection. SQLite only reports when a statement
+    # starts, so each one is charged until the next starts or the work ends (finish_statement),
+    # which includes fetching its rows.
+    def attach(self, conn):
+        if self.enabled:
+            conn.set_trace_callback(self.trace_statement)
+
+    def trace_statement(self, sql):
+        now = time.perf_counter()
+        self.finish_statement(now)
+        self.current_statement = sql
+        self.statement_started = now
+
+    def finish_statement(self, now=None):
+        if not self.enabled or self.current_statement is None:
+            return
+        now = time.perf_counter() if now is None else now
+        key = normalize_statement(self.current_statement)
+        self.current_statement = None
+        with self.lock:
+            if key not in self.statements and len(self.statements) >= MAX_STATEMENTS:
+                key = "(other)"
+            self.statements.setdefault(key, LatencyHistogram()).add((now - self.statement_started) * 1000)
+
+    # Report whenever the mainloop goes longer than STALL_THRESHOLD_MS without a heartbeat.
+    # A watchdog thread notices while the loop is still blocked and keeps the stack it is stuck in.
+    def watch_mainloop(self, root):
+        if not self.enabled:
+            return
+        self.heartbeat = time.perf_counter()
+        main_thread = threading.main_thread().ident
+
+        def beat():
+            now = time.perf_counter()
+            late_ms = (now - self.heartbeat) * 1000 - HEARTBEAT_MS
+            if late_ms > STALL_THRESHOLD_MS:
+                self.record_stall(late_ms)
+            self.heartbeat = now
+            root.after(HEARTBEAT_MS, beat)
+
+        def watch():
+            while True:
+                time.sleep(HEARTBEAT_MS / 1000)
+                blocked_ms = (time.perf_counter() - self.heartbeat) * 1000 - HEARTBEAT_MS
+                if blocked_ms > STALL_THRESHOLD_MS and self.stall_stack is None:
+                    frame = sys._current_frames().get(main_thread)
+                    self.stall_stack = "".join(traceback.format_stack(frame)) if frame else ""
+
+        root.after(HEARTBEAT_MS, beat)
+        self.watchdog = threading.Thread(target=watch, daemon=True)
+        self.watchdog.start()
+
+    def record_stall(self, ms):
+        stack, self.stall_stack = self.stall_stack, None
+        self.record("mainloop_stall", ms / 1000)
+        with self.lock:
+            self.stalls.append((time.time() - ms / 1000, ms, stack or ""))
+            del self.stalls[:-RECENT_STALLS]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "written": time.time(),
+                "operations": {name: histogram.summary() for name, histogram in sorted(self.operations.items())},
+                "statements": {sql: histogram.summary() for sql, histogram in
+                               sorted(self.statements.items(), key=lambda item: -item[1].total_ms)},
+                "stalls": [{"started": started, "ms": round(ms, 1), "stack": stack}
+                           for started, ms, stack in self.stalls],
+            }
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as output:
+            json.dump(self.snapshot(), output, indent=2)
+
+    def reset(self):
+        with self.lock:
+            self.operations.clear()
+            self.statements.clear()
+            del self.stalls[:]
+            self.started = time.time()
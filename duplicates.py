@@ -0,0 +1,164 @@
+import json
+import queue
+import threading
+
+import numpy as np
+from PIL import Image
+
+from repository import open_connection
+
+# Near-duplicate detection with perceptual hashes.
+#
+# Each image gets a 64-bit difference hash (dHash) that survives re-encoding and resizing.
+# Two images are near duplicates when their hashes differ in few bits (Hamming distance).
+
+# Width and height of the gradient grid; 8 gives a 64-bit hash
+HASH_SIZE = 8
+# Largest Hamming distance still reported as a near duplicate
+NEAR_DUPLICATE_DISTANCE = 6
+# Groups up to this size are compared all at once; larger ones row by row to bound memory
+PAIRWISE_GROUP_LIMIT = 1024
+# Images hashed per transaction when filling in missing hashes
+BACKFILL_BATCH_SIZE = 200
+
+# Difference hash: one bit per horizontally adjacent pixel pair of a tiny grayscale copy
+def dhash(path):
+    with Image.open(path) as image:
+        image.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))
+        small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+        pixels = list(small.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            value = value << 1 | (left > pixels[row * (HASH_SIZE + 1) + column + 1])
+    return value
+
+# SQLite integers are signed, hashes are stored as their signed 64-bit equivalent
+def to_signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+# Hamming distance from every hash in an array to one hash
+def hamming_distances(hashes, value):
+    return np.bitwise_count(np.bitwise_xor(hashes, np.uint64(value)))
+
+# Split the 64 bits into max_distance + 1 chunks: hashes within max_distance share at least one
+def chunk_widths(max_distance):
+    chunks = min(max_distance + 1, 64)
+    return [64 // chunks + (1 if index < 64 % chunks else 0) for index in range(chunks)]
+
+# In-memory copy of every stored hash for vectorized lookups
+class HashIndex:
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def build(self, cursor):
+        rows = cursor.execute("SELECT image_id, phash FROM images WHERE phash IS NOT NULL").fetchall()
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.hashes = np.array([to_unsigned(row[1]) for row in rows], dtype=np.uint64)
+
+    # Re-read the hashes of changed images
+    def update(self, cursor, image_ids):
+        image_ids = list(image_ids)
+        keep = ~np.isin(self.ids, image_ids)
+        self.ids, self.hashes = self.ids[keep], self.hashes[keep]
+        rows = cursor.execute("SELECT image_id, phash FROM images WHERE phash IS NOT NULL AND image_id IN (SELECT value FROM json_each(?))",
+                              (json.dumps(image_ids),)).fetchall()
+        if rows:
+            self.ids = np.concatenate([self.ids, np.array([row[0] for row in rows], dtype=np.int64)])
+            self.hashes = np.concatenate([self.hashes, np.array([to_unsigned(row[1]) for row in rows], dtype=np.uint64)])
+
+    # Images within max_distance of a hash, closest first, as (image_id, distance)
+    def query(self, value, max_distance=NEAR_DUPLICATE_DISTANCE):
+        if not len(self.hashes):
+            return []
+        distances = hamming_distances(self.hashes, value)
+        matches = np.flatnonzero(distances <= max_distance)
+        matches = matches[np.argsort(distances[matches], kind="stable")]
+        return [(int(self.ids[index]), int(distances[index])) for index in matches]
+
+    # Every near-duplicate pair in the library as {(image_id, image_id): distance}.
+    # Hashes are bucketed on each chunk and only compared within a bucket, which avoids
+    # comparing all n^2 pairs.
+    def duplicate_pairs(self, max_distance=NEAR_DUPLICATE_DISTANCE):
+        pairs = {}
+        shift = 0
+        for width in chunk_widths(max_distance):
+            keys = (self.hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+            shift += width
+            order = np.argsort(keys, kind="stable")
+            starts = np.flatnonzero(np.concatenate(([True], np.diff(keys[order]) != 0)))
+            ends = np.append(starts[1:], len(order))
+            shared = ends - starts > 1
+            for start, end in zip(starts[shared], ends[shared]):
+                self.compare_group(order[start:end], max_distance, pairs)
+        return pairs
+
+    def compare_group(self, group, max_distance, pairs):
+        group_hashes = self.hashes[group]
+        if len(group) <= PAIRWISE_GROUP_LIMIT:
+            distances = np.bitwise_count(np.bitwise_xor(group_hashes[:, None], group_hashes[None, :]))
+            firsts, seconds = np.nonzero(np.triu(distances <= max_distance, k=1))
+            found = zip(firsts, seconds, distances[firsts, seconds])
+        else:
+            found = []
+            for position in range(len(group) - 1):
+                distances = hamming_distances(group_hashes[position + 1:], group_hashes[position])
+                for other in np.flatnonzero(distances <= max_distance):
+                    found.append((position, position + 1 + other, distances[other]))
+
+        for first, second, distance in found:
+            image_ids = sorted((int(self.ids[group[first]]), int(self.ids[group[second]])))
+            pairs[tuple(image_ids)] = int(distance)
+
+# Builds the library-wide duplicate report on a background thread
+class DuplicateReport:
+    def __init__(self, database_path, max_distance=NEAR_DUPLICATE_DISTANCE):
+        self.database_path = database_path
+        self.max_distance = max_distance
+        # Messages for the UI thread: ("hashed", count), ("done", pairs) or ("error", message)
+        self.progress = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        conn = open_connection(self.database_path)
+        try:
+            self.backfill(conn)
+            index = HashIndex()
+            index.build(conn.cursor())
+            self.progress.put(("done", index.duplicate_pairs(self.max_distance)))
+        except Exception as error:
+            self.progress.put(("error", str(error)))
+        finally:
+            conn.close()
+
+    # Hash images catalogued before hashes were recorded
+    def backfill(self, conn):
+        cursor = conn.cursor()
+        hashed = 0
+        last_id = 0
+        while True:
+            rows = cursor.execute('''SELECT image_id, directory_path FROM images
+                                     WHERE phash IS NULL AND image_id > ? ORDER BY image_id LIMIT ?''',
+                                  (last_id, BACKFILL_BATCH_SIZE)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            updates = []
+            for image_id, directory_path in rows:
+                try:
+                    updates.append((to_signed(dhash(directory_path)), image_id))
+                except (OSError, ValueError):
+                    # Missing or unreadable files stay unhashed
+                    continue
+            cursor.executemany("UPDATE images SET phash = ? WHERE image_id = ?", updates)
+            conn.commit()
+            hashed += len(updates)
+            self.progress.put(("hashed", hashed))
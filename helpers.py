@@ -1,10 +1,59 @@
 import sqlite3
+import time
 import tkinter as tk
 from tkinter import ttk, messagebox
 from ttkwidgets.autocomplete import AutocompleteEntry
 
+from prefix_index import AUTOCOMPLETE_MAX_HITS, PrefixIndex
+
+# Autocomplete entry backed by a PrefixIndex instead of scanning a list
+class IndexedAutocompleteEntry(AutocompleteEntry):
+    # Called with the seconds each keystroke's completion took, when diagnostics are on
+    keystroke_timer = None
+
+    def handle_keyrelease(self, event):
+        if self.keystroke_timer is None:
+            return AutocompleteEntry.handle_keyrelease(self, event)
+        start = time.perf_counter()
+        result = AutocompleteEntry.handle_keyrelease(self, event)
+        self.keystroke_timer(time.perf_counter() - start)
+        return result
+
+    def set_completion_list(self, completion_list):
+        # Share an existing index so names added elsewhere show up without a rebuild
+        if not isinstance(completion_list, PrefixIndex):
+            completion_list = PrefixIndex(completion_list)
+        AutocompleteEntry.set_completion_list(self, [])
+        self._completion_list = completion_list
+
+    def update_hits(self, _hits, delta):
+        # if we have a new hit list, keep this in mind
+        if _hits != self._hits:
+            self._hit_index = 0
+            self._hits = _hits
+        # only allow cycling if we are in a known hit list
+        if _hits == self._hits and self._hits:
+            self._hit_index = (self._hit_index + delta) % len(self._hits)
+
+    def autocomplete(self, delta=0):
+        """
+        Autocomplete the Entry.
+
+        Same behaviour as the original class but hits come from the prefix index
+        """
+        if delta:  # need to delete selection otherwise we would fix the current position
+            self.delete(self.position, tk.END)
+        else:  # set position to end so selection starts where textentry ended
+            self.position = len(self.get())
+        self.update_hits(self._completion_list.matches(self.get(), limit=AUTOCOMPLETE_MAX_HITS), delta)
+        # now finally perform the auto completion
+        if self._hits:
+            self.delete(0, tk.END)
+            self.insert(0, self._hits[self._hit_index])
+            self.select_range(self.position, tk.END)
+
 # Class for entering multiple words (tags) and having each autocomplete
-class AutocompleteMultiEntry(AutocompleteEntry):
+class AutocompleteMultiEntry(IndexedAutocompleteEntry):
     def autocomplete(self, delta=0):
         """
         Autocomplete the Entry.
@@ -15,26 +64,17 @@ class AutocompleteMultiEntry(AutocompleteEntry):
             self.delete(self.position, tk.END)
         else:  # set position to end so selection starts where textentry ended
             self.position = len(self.get())
-        # collect hits
-        _hits = []
         # Get current (last) entry (comma delinated)
         all_entries = self.get()
-        # Get all current entries as list and the current entry being typed
+        # Get all current entries and the current entry being typed
         current_entry_list = [s.strip() for s in all_entries.split(",")]
-        current_entry = current_entry_list[-1].lower()
+        current_entry = current_entry_list[-1]
         # Match case-insensitively and only add to hits if not already in list
-        for element in self._completion_list:
-            if element.lower().startswith(current_entry) and element not in current_entry_list[:-1]: 
-                _hits.append(element)
-        # if we have a new hit list, keep this in mind
-        if _hits != self._hits:
-            self._hit_index = 0
-            self._hits = _hits
-        # only allow cycling if we are in a known hit list
-        if _hits == self._hits and self._hits:
-            self._hit_index = (self._hit_index + delta) % len(self._hits)
+        _hits = self._completion_list.matches(current_entry, exclude=set(current_entry_list[:-1]),
+                                              limit=AUTOCOMPLETE_MAX_HITS)
+        self.update_hits(_hits, delta)
         # now finally perform the auto completion
         if self._hits:
             self.delete(0, tk.END)
-            self.insert(0, all_entries[:-len(current_entry)]+self._hits[self._hit_index])
-            self.select_range(self.position, tk.END)
\ No newline at end of file
+            self.insert(0, all_entries[:len(all_entries)-len(current_entry)]+self._hits[self._hit_index])
+            self.select_range(self.position, tk.END)
@@ -0,0 +1,176 @@
+import itertools
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from dates import normalize_timestamp
+
+from duplicates import dhash, to_signed
+from metadata import metadata_pool, read_metadata_many
+from repository import (METADATA_COLUMNS, NAME_LOOKUP_CHUNK, ChangeSet, metadata_values, open_connection,
+                        resolve_aliases, resolve_names)
+from schema import restore_fts_triggers, suspend_fts_triggers
+from storage import STORAGE_FLAT, store_file, stored_size
+
+# Number of files copied and written to the database per transaction
+IMPORT_BATCH_SIZE = 200
+# Number of threads copying files at the same time
+IMPORT_COPY_WORKERS = 4
+# File types picked up when walking a folder
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp", ".tif", ".tiff"}
+
+# Walk a folder tree lazily, yielding image files as they are found
+def iter_image_files(folder):
+    pending = [folder]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                        yield entry.path
+        except OSError:
+            # Unreadable folders are skipped rather than aborting the whole import
+            continue
+
+# Imports every image below a folder on a background thread
+class BulkImporter:
+    def __init__(self, database_path, image_destination, folder, creator_name="", tags=(),
+                 creator_from_folder=False, storage_mode=STORAGE_FLAT):
+        self.database_path = database_path
+        self.image_destination = image_destination
+        self.storage_mode = storage_mode
+        self.folder = folder
+        self.creator_name = creator_name
+        self.tags = list(tags)
+        self.creator_from_folder = creator_from_folder
+
+        # Progress messages for the UI thread: ("batch", count, changes), ("error", path, message) or ("done", count)
+        self.progress = queue.Queue()
+        # Files left out because their content is already in the catalog
+        self.skipped = 0
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    # Creator for a file: the folder it sits in, or the name chosen for the whole import
+    def creator_for(self, filepath):
+        if self.creator_from_folder:
+            parent = os.path.dirname(filepath)
+            if os.path.normpath(parent) != os.path.normpath(self.folder):
+                return os.path.basename(parent)
+        return self.creator_name
+
+    def copy_file(self, filepath):
+        try:
+            stored = store_file(filepath, self.image_destination, self.storage_mode)
+        except OSError as error:
+            self.progress.put(("error", filepath, str(error)))
+            return None
+        try:
+            phash = to_signed(dhash(stored[0]))
+        except (OSError, ValueError):
+            # Files Pillow can't decode are still imported, just without a perceptual hash
+            phash = None
+        return (filepath,) + stored + (phash,)
+
+    def run(self):
+        conn = open_connection(self.database_path)
+        cursor = conn.cursor()
+        creator_cache = {}
+        tag_cache = {}
+        imported = 0
+        files = iter_image_files(self.folder)
+
+        try:
+            os.makedirs(self.image_destination, exist_ok=True)
+            # Copies wait on the disk and share threads; header parsing needs the CPU and gets processes
+            with ThreadPoolExecutor(max_workers=IMPORT_COPY_WORKERS) as pool, metadata_pool() as processes:
+                # Stop between batches so every written batch is complete
+                while not self.cancelled.is_set():
+                    batch = list(itertools.islice(files, IMPORT_BATCH_SIZE))
+                    if not batch:
+                        break
+                    copied = [result for result in pool.map(self.copy_file, batch) if result]
+                    metadata = read_metadata_many(processes, [dest for _, dest, _, _, _ in copied])
+                    copied = [stored + (file_metadata,) for stored, file_metadata in zip(copied, metadata)]
+                    changes = self.write_batch(cursor, copied, creator_cache, tag_cache)
+                    conn.commit()
+                    imported += len(changes.images)
+                    self.progress.put(("batch", imported, changes))
+        except Exception as error:
+            conn.rollback()
+            self.progress.put(("error", self.folder, str(error)))
+        finally:
+            conn.close()
+            self.progress.put(("done", imported))
+
+    # Write one batch of copied files in the current transaction
+    def write_batch(self, cursor, copied, creator_cache, tag_cache):
+        changes = ChangeSet()
+        if not copied:
+            return changes
+        current_datetime = normalize_timestamp(datetime.now(timezone.utc))
+
+        # Hold the write lock for the whole batch so the new image ids form one range
+        cursor.execute("BEGIN IMMEDIATE")
+        copied = self.drop_known_content(cursor, copied)
+        if not copied:
+            return changes
+
+        creator_names = [self.creator_for(src) for src, _, _, _, _, _ in copied]
+        creator_ids = resolve_names(cursor, "creators", "creator_id", "creator_name",
+                                    creator_names, creator_cache, changes.creators)
+        tag_ids = resolve_names(cursor, "tags", "tag_id", "tag_name",
+                                resolve_aliases(cursor, self.tags), tag_cache, changes.tags)
+
+        # Each image's document is built and logged once, after its tags are linked
+        suspend_fts_triggers(cursor)
+        # Ids are allocated sequentially inside the transaction, so they can be read back by range
+        cursor.execute("SELECT COALESCE(MAX(image_id), 0) FROM images")
+        first_id = cursor.fetchone()[0] + 1
+        cursor.executemany("INSERT INTO images (filename, creator_id, directory_path, date_added, content_hash, phash, file_size, {}) VALUES (?, ?, ?, ?, ?, ?, ?, {})".format(
+                               ", ".join(METADATA_COLUMNS), ", ".join("?" * len(METADATA_COLUMNS))),
+                           [(os.path.basename(dest), creator_id, dest, current_datetime, content_hash, phash, stored_size(dest))
+                            + metadata_values(file_metadata)
+                            for (_, dest, content_hash, _, phash, file_metadata), creator_id in zip(copied, creator_ids)])
+        cursor.execute("SELECT image_id FROM images WHERE image_id >= ? ORDER BY image_id", (first_id,))
+        image_ids = [row[0] for row in cursor.fetchall()]
+
+        cursor.executemany("INSERT OR IGNORE INTO image_tags (image_id, tag_id) VALUES (?, ?)",
+                           [(image_id, tag_id) for image_id in image_ids for tag_id in set(tag_ids)])
+        changes.images.update(image_ids)
+        if image_ids:
+            changes.tag_counts.update(tag_ids)
+        restore_fts_triggers(cursor, image_ids, changes.tag_counts)
+        return changes
+
+    # Leave out files whose content is already catalogued (or repeated within the batch)
+    def drop_known_content(self, cursor, copied):
+        hashes = list({content_hash for _, _, content_hash, _, _, _ in copied})
+        known = set()
+        for start in range(0, len(hashes), NAME_LOOKUP_CHUNK):
+            chunk = hashes[start:start + NAME_LOOKUP_CHUNK]
+            cursor.execute("SELECT content_hash FROM images WHERE content_hash IN ({})".format(
+                ",".join("?" * len(chunk))), chunk)
+            known.update(row[0] for row in cursor.fetchall())
+
+        kept = []
+        for stored in copied:
+            _, dest, content_hash, is_new, _, _ = stored
+            if content_hash in known:
+                self.skipped += 1
+                # A flat copy of known content is a redundant file; hashed storage shares one file
+                if is_new and self.storage_mode == STORAGE_FLAT:
+                    os.remove(dest)
+            else:
+                known.add(content_hash)
+                kept.append(stored)
+        return kept
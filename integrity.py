@@ -0,0 +1,286 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from repository import NAME_LOOKUP_CHUNK, ChangeSet, open_connection
+from storage import COPY_CHUNK_SIZE
+
+# Checks that the catalog and the image folder agree.
+#
+# The folder is walked with one os.scandir per directory, spread over a thread pool, and
+# every catalogued image is compared with what was found: missing files, files no image
+# points at (orphans) and files whose size or content no longer match the catalog are
+# reported; files of deleted images waiting in the trash are not orphans. Stored files are
+# hashed to compare their content; the size, mtime and hash of each file are kept in
+# file_checks, so an incremental scan only reads files that changed.
+
+# Threads listing folders and hashing files at the same time
+SCAN_WORKERS = 8
+# Image rows compared per fetch
+SCAN_FETCH_ROWS = 1000
+# Orphans changed more recently may belong to an import still copying files, and are
+# not deleted by fix_problems
+ORPHAN_MIN_AGE_SECONDS = 60 * 60
+
+MISSING = "missing"
+ORPHAN = "orphan"
+SIZE_MISMATCH = "size"
+CONTENT_MISMATCH = "content"
+MOVED = "moved"
+
+# Paths compare equal however they were written when stored
+def file_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as source_file:
+        while True:
+            chunk = source_file.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                return hasher.hexdigest()
+            hasher.update(chunk)
+
+# Files directly in a folder as (path, size, mtime_ns), and its subfolders. Hidden entries
+# such as .DS_Store are left out; unreadable folders count as empty.
+def scan_directory(directory):
+    files = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, subdirectories
+
+# Every file below a folder, keyed by file_key; folders are listed in parallel
+def walk_files(directory, pool):
+    found = {}
+    pending = {pool.submit(scan_directory, directory)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            files, subdirectories = future.result()
+            for path, size, mtime_ns in files:
+                found[file_key(path)] = (path, size, mtime_ns)
+            pending.update(pool.submit(scan_directory, subdirectory) for subdirectory in subdirectories)
+    return found
+
+def stat_file(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_size, stat.st_mtime_ns
+
+# Problems found by a scan
+class IntegrityReport:
+    def __init__(self):
+        self.missing = []       # (image_id, path) of images whose file is gone
+        self.orphans = []       # (path, size, mtime_ns) of files no image points at
+        self.mismatched = []    # (image_id, path, SIZE_MISMATCH or CONTENT_MISMATCH)
+        self.moved = {}         # image_id -> orphan path holding the missing image's content
+        self.images = 0
+        self.files = 0
+        self.hashed = 0
+
+    def problems(self):
+        return len(self.missing) + len(self.orphans) + len(self.mismatched)
+
+    # (kind, image_id or None, path) rows for display, moved files in place of their missing and orphan rows
+    def rows(self):
+        moved_paths = set(self.moved.values())
+        rows = [(MOVED, image_id, path) for image_id, path in sorted(self.moved.items())]
+        rows += [(MISSING, image_id, path) for image_id, path in self.missing if image_id not in self.moved]
+        rows += [(kind, image_id, path) for image_id, path, kind in self.mismatched]
+        rows += [(ORPHAN, None, path) for path, _, _ in self.orphans if path not in moved_paths]
+        return rows
+
+# Compares the catalog with the image folder, on a background thread or called directly
+class IntegrityScan:
+    def __init__(self, database_path, image_destination, incremental=False):
+        self.database_path = database_path
+        self.image_destination = image_destination
+        # Reuse the stored hash of files whose size and mtime are unchanged
+        self.incremental = incremental
+        # Messages for the UI thread: ("walked", files), ("hashed", done, total), ("done", report) or ("error", message)
+        self.progress = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        conn = open_connection(self.database_path)
+        try:
+            self.progress.put(("done", self.scan(conn)))
+        except Exception as error:
+            conn.rollback()
+            self.progress.put(("error", str(error)))
+        finally:
+            conn.close()
+
+    def scan(self, conn):
+        report = IntegrityReport()
+        cursor = conn.cursor()
+        with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+            found = walk_files(self.image_destination, pool)
+            report.files = len(found)
+            self.progress.put(("walked", len(found)))
+
+            referenced = set()
+            # file key -> (path, size, mtime_ns, image_ids and the hashes they expect)
+            to_verify = {}
+            sizes = []
+            outside = []
+            cursor.execute("SELECT image_id, directory_path, file_size, content_hash FROM images")
+            while True:
+                rows = cursor.fetchmany(SCAN_FETCH_ROWS)
+                if not rows:
+                    break
+                report.images += len(rows)
+                for image_id, directory_path, file_size, content_hash in rows:
+                    key = file_key(directory_path or "")
+                    if key in found:
+                        referenced.add(key)
+                        self.compare(report, image_id, found[key], file_size, content_hash, to_verify, sizes)
+                    else:
+                        # Stored outside the image folder, or gone
+                        outside.append((image_id, directory_path, file_size, content_hash))
+
+            stats = pool.map(stat_file, [directory_path or "" for _, directory_path, _, _ in outside])
+            for (image_id, directory_path, file_size, content_hash), stat in zip(outside, stats):
+                if stat is None:
+                    report.missing.append((image_id, directory_path))
+                else:
+                    self.compare(report, image_id, stat, file_size, content_hash, to_verify, sizes)
+
+            # Files of deleted images stay until the trash is reclaimed
+            referenced.update(file_key(row[0]) for row in cursor.execute("SELECT path FROM trash_files"))
+            report.orphans = sorted(found[key] for key in found.keys() - referenced)
+            hashes = self.hash_files(conn, pool, report, to_verify)
+
+        # Content that went missing from one path and turned up as an orphan was moved
+        missing_ids = [image_id for image_id, _ in report.missing]
+        expected = expected_hashes(cursor, missing_ids)
+        orphans_by_hash = {hashes[file_key(path)]: path for path, _, _ in report.orphans if file_key(path) in hashes}
+        for image_id in missing_ids:
+            if expected.get(image_id) in orphans_by_hash:
+                report.moved[image_id] = orphans_by_hash[expected[image_id]]
+
+        # Images catalogued before sizes were recorded get them now
+        cursor.executemany("UPDATE images SET file_size = ? WHERE image_id = ? AND file_size IS NULL", sizes)
+        # Forget files that are gone
+        checked = [row[0] for row in cursor.execute("SELECT path FROM file_checks").fetchall()]
+        cursor.executemany("DELETE FROM file_checks WHERE path = ?",
+                           [(key,) for key in checked if key not in found and key not in hashes])
+        conn.commit()
+        return report
+
+    def compare(self, report, image_id, stat, file_size, content_hash, to_verify, sizes):
+        path, size, mtime_ns = stat
+        if file_size is None:
+            sizes.append((size, image_id))
+        elif file_size != size:
+            report.mismatched.append((image_id, path, SIZE_MISMATCH))
+            return
+        if content_hash:
+            to_verify.setdefault(file_key(path), [path, size, mtime_ns, []])[3].append((image_id, content_hash))
+
+    # Hash the referenced files (and the orphans, when images are missing) that changed since
+    # they were last hashed, and record content mismatches. Returns file key -> hash.
+    def hash_files(self, conn, pool, report, to_verify):
+        candidates = {key: (path, size, mtime_ns) for key, (path, size, mtime_ns, _) in to_verify.items()}
+        if report.missing:
+            candidates.update((file_key(path), (path, size, mtime_ns)) for path, size, mtime_ns in report.orphans)
+
+        cursor = conn.cursor()
+        cached = load_checks(cursor, candidates) if self.incremental else {}
+        hashes = {}
+        stale = []
+        for key, (path, size, mtime_ns) in candidates.items():
+            if cached.get(key, (None, None, None))[:2] == (size, mtime_ns):
+                hashes[key] = cached[key][2]
+            else:
+                stale.append(key)
+
+        for done, (key, content_hash) in enumerate(zip(stale, pool.map(self.try_hash, [candidates[key][0] for key in stale])), start=1):
+            if content_hash is not None:
+                hashes[key] = content_hash
+            if done % SCAN_FETCH_ROWS == 0 or done == len(stale):
+                self.progress.put(("hashed", done, len(stale)))
+        report.hashed = len(stale)
+
+        cursor.executemany("INSERT OR REPLACE INTO file_checks (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)",
+                           [(key,) + candidates[key][1:] + (hashes[key],) for key in stale if key in hashes])
+        conn.commit()
+
+        for key, (path, _, _, expected) in to_verify.items():
+            for image_id, content_hash in expected:
+                if key in hashes and hashes[key] != content_hash:
+                    report.mismatched.append((image_id, path, CONTENT_MISMATCH))
+        return hashes
+
+    @staticmethod
+    def try_hash(path):
+        try:
+            return hash_file(path)
+        except OSError:
+            return None
+
+# Cached (size, mtime_ns, content_hash) of the given file keys
+def load_checks(cursor, keys):
+    keys = list(keys)
+    cached = {}
+    for start in range(0, len(keys), NAME_LOOKUP_CHUNK):
+        chunk = keys[start:start + NAME_LOOKUP_CHUNK]
+        cursor.execute("SELECT path, size, mtime_ns, content_hash FROM file_checks WHERE path IN ({})".format(
+            ",".join("?" * len(chunk))), chunk)
+        cached.update((row[0], row[1:]) for row in cursor.fetchall())
+    return cached
+
+def expected_hashes(cursor, image_ids):
+    hashes = {}
+    for start in range(0, len(image_ids), NAME_LOOKUP_CHUNK):
+        chunk = image_ids[start:start + NAME_LOOKUP_CHUNK]
+        cursor.execute("SELECT image_id, content_hash FROM images WHERE content_hash IS NOT NULL AND image_id IN ({})".format(
+            ",".join("?" * len(chunk))), chunk)
+        hashes.update(cursor.fetchall())
+    return hashes
+
+# Repair what can be repaired without losing anything catalogued: images whose file moved
+# inside the folder are pointed at it again, and other orphans older than
+# ORPHAN_MIN_AGE_SECONDS are deleted. Missing and mismatched images are only reported.
+# Returns (ChangeSet of relinked images, paths of deleted files).
+def fix_problems(cursor, report):
+    changes = ChangeSet(images=report.moved)
+    cursor.executemany("UPDATE images SET directory_path = ?, file_size = ? WHERE image_id = ?",
+                       [(path, os.path.getsize(path), image_id) for image_id, path in report.moved.items()])
+
+    moved_paths = set(report.moved.values())
+    cutoff = (time.time() - ORPHAN_MIN_AGE_SECONDS) * 1e9
+    deleted = []
+    for path, _, mtime_ns in report.orphans:
+        if path in moved_paths or mtime_ns > cutoff:
+            continue
+        try:
+            os.remove(path)
+        except OSError as error:
+            print("Could not delete {}: {}".format(path, error))
+            continue
+        deleted.append(path)
+    cursor.executemany("DELETE FROM file_checks WHERE path = ?", [(file_key(path),) for path in deleted])
+    return changes, deleted
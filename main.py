@@ -1,80 +1,126 @@
-import sqlite3
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-from ttkwidgets.autocomplete import AutocompleteEntry
 from helpers import *
-import os
-import shutil
+import json
+import queue
 from datetime import datetime, timezone
 from tkcalendar import DateEntry
+from importer import BulkImporter
+from storage import STORAGE_FLAT
+from repository import (CHANGE_RELOAD_THRESHOLD, CHANGES_RELOAD, DATABASE_PATH, DATE_COLUMNS, IMAGE_DESTINATION, IMAGE_FILTER_SOURCE,
+                        IMAGE_ROW_SELECT, IMAGE_SORT_COLUMNS, IMAGE_SOURCE, add_creator, add_image, add_tag,
+                        delete_unused_tags, ChangeFeed, ImageRecordCache, create_tables, date_range_clause,
+                        date_timeline, delete_creators, delete_images, edit_image, fetch_image_records,
+                        image_page_query, prune_change_log, remove_stored, restore_trash, store_image, tag_images,
+                        UNUSED_TAGS, add_tag_alias, add_tag_implication, remove_tag_alias, remove_tag_implication,
+                        tag_rules)
+from dates import PERIOD_MONTH, PERIOD_YEAR, day_range, parse_date, period_days
+from thumbnails import THUMBNAIL_CACHE_DIR, THUMBNAIL_CACHE_MAX_BYTES, THUMBNAIL_SIZE, ThumbnailCache
+from search import TagIndex, QueryError, bits_to_ids, fts_query, parse_query
+from duplicates import DuplicateReport, HashIndex, dhash, to_signed
+from integrity import IntegrityScan, fix_problems
+from metadata import MetadataBackfill, try_read_metadata
+from trash import TRASH_RETENTION_SECONDS, TrashCollector
+from preview import PREVIEW_NEIGHBORS, PREVIEW_SIZE, PreviewLoader
+from dbworker import DatabaseWorker
+from diagnostics import Diagnostics, enabled_from_environment
+
+# Milliseconds between checks for progress from background jobs
+PROGRESS_POLL_MS = 100
+# Milliseconds between checks for changes made by other instances sharing the catalog
+CHANGE_POLL_MS = 1000
+# Files listed when an import finishes with errors; the rest are only counted
+IMPORT_ERRORS_SHOWN = 10
+
+# Rows fetched beyond the visible part of the image table on each page
+IMAGE_PREFETCH_ROWS = 50
+# Load the next page once the scrollbar passes this fraction of the loaded rows
+IMAGE_SCROLL_THRESHOLD = 0.9
+# Rows kept in the image table; rows far from the view are dropped and fetched again when
+# scrolled back to, so the table stays the same size however far the user scrolls
+IMAGE_MAX_LOADED_ROWS = 1000
+# Widths of the image table columns, leaving room for the preview beside it
+IMAGE_COLUMN_WIDTHS = {"image_id": 60, "filename": 160, "creator": 120, "source_url": 160, "tags": 160,
+                       "date_added": 150, "date_uploaded": 100}
+# Kinds of search offered by the search box
+SEARCH_MODES = ("Tags", "Text")
+# Thumbnails shown per gallery page
+GALLERY_COLUMNS = 6
+GALLERY_ROWS = 4
 
 class DatabaseApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Image Keeper")
-        root.geometry('900x600')
+        root.geometry('1280x640')
         
-        # Create connection to db
-        self.conn = sqlite3.connect('image_database.db')
-        self.cursor = self.conn.cursor()
+        # Latency instrumentation, only collected when IMAGE_KEEPER_DIAGNOSTICS is set
+        self.diagnostics = Diagnostics(enabled=enabled_from_environment())
+
+        # All SQL runs on the database worker thread, which owns the connection
+        self.db = DatabaseWorker(self.root, DATABASE_PATH, on_error=self.show_database_error,
+                                 diagnostics=self.diagnostics)
+
+        # Create table if not exist; startup waits for these before the window is shown
+        self.db.call(self.create_tables)
+        # Follow changes from other instances from here on; what is loaded below already shows earlier ones
+        self.change_feed = ChangeFeed()
+        self.db.call(prune_change_log)
+        self.db.call(self.change_feed.start)
+        self.change_poll_failing = False
+        self.db.call(self.init_lookup_lists)
+
+        # Build the inverted tag index used by searches; no search is active at first.
+        # Like the hash index below, it is only touched from the worker thread.
+        self.tag_index = TagIndex()
+        self.db.call(self.tag_index.build)
+        self.image_filter = None
+
+        # Records of recently opened images; changes invalidate them in apply_changes
+        self.image_records = ImageRecordCache()
+        # Trash batches of the deletes made in this window, newest last, for Undo Delete
+        self.undo_batches = []
+
+        # Perceptual hashes of every image, used to warn about near duplicates
+        self.hash_index = HashIndex()
+        self.db.call(self.hash_index.build)
 
-        # Create table if not exist
-        self.create_tables()
-        self.init_lookup_lists()
+        # Init settings
+        self.image_destination = IMAGE_DESTINATION
+        # STORAGE_FLAT keeps original filenames; STORAGE_HASHED stores files by content hash
+        self.storage_mode = STORAGE_FLAT
+        self.thumbnail_cache_dir = THUMBNAIL_CACHE_DIR
+        self.thumbnail_cache_max_bytes = THUMBNAIL_CACHE_MAX_BYTES
+        # Previews of the selected image are decoded off the Tk thread
+        self.preview_loader = PreviewLoader(self.root)
 
         # Initalize UI elements
         self.init_ui_elements()
 
-        # Init settings
-        self.image_destination = "images"
-
-    def create_tables(self):
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS creators (
-                creator_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                creator_name TEXT NOT NULL UNIQUE
-            )
-        ''' )
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS images (
-                image_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                filename TEXT NOT NULL,
-                directory_path TEXT,
-                creator_id INTEGER,
-                source_url TEXT,
-                date_added TEXT,
-                date_uploaded TEXT,
-                FOREIGN KEY (creator_id) REFERENCES creators (creator_id)
-            )
-        ''')
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tags (
-                tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tag_name TEXT NOT NULL,
-                tag_description TEXT,
-                category TEXT
-            )
-        ''' )
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS image_tags (
-                image_id INTEGER,
-                tag_id INTEGER,
-                PRIMARY KEY (image_id, tag_id),
-                FOREIGN KEY (image_id) REFERENCES images (image_id),
-                FOREIGN KEY (tag_id) REFERENCES tags (tag_id)
-            )
-        ''' )
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS socials (
-                social_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                creator_id INTEGER,
-                social_handle TEXT,
-                social_type TEXT,
-                FOREIGN KEY (creator_id) REFERENCES creators (creator_id)
-            )
-        ''' )
-
-        self.conn.commit()
+        # Images catalogued before their dimensions and format were recorded are read in the background
+        self.metadata_backfill = MetadataBackfill(DATABASE_PATH)
+        self.metadata_backfill.start()
+        self.root.after(PROGRESS_POLL_MS, self.poll_metadata_backfill)
+        # Files of images deleted longer ago than the undo period are removed in the background
+        self.trash_collector = TrashCollector(DATABASE_PATH)
+        self.trash_collector.start()
+        self.root.after(PROGRESS_POLL_MS, self.poll_trash_collector)
+        self.root.after(CHANGE_POLL_MS, self.poll_changes)
+
+        if self.diagnostics.enabled:
+            self.diagnostics.watch_mainloop(self.root)
+            IndexedAutocompleteEntry.keystroke_timer = lambda seconds: self.diagnostics.record("autocomplete", seconds)
+
+    # Create the tables, or upgrade an existing database to the current schema
+    def create_tables(self, cursor):
+        create_tables(cursor.connection)
+
+    def show_database_error(self, error):
+        messagebox.showerror(title="Error", message="Database error: {}".format(error))
+
+    # Runs on the database worker: every row of a query
+    def fetch_rows(self, cursor, query, params=()):
+        return cursor.execute(query, params).fetchall()
 
     def init_ui_elements(self):
         # Create notebook for tabs
@@ -85,76 +131,538 @@ class DatabaseApp:
         self.tab_images = ttk.Frame(self.notebook)
         self.tab_creators = ttk.Frame(self.notebook)
         self.tab_tags = ttk.Frame(self.notebook)
+        self.tab_gallery = ttk.Frame(self.notebook)
 
         self.tab_images.pack(fill='both', expand=True)
         self.tab_creators.pack(fill='both', expand=True)
         self.tab_tags.pack(fill='both', expand=True)
+        self.tab_gallery.pack(fill='both', expand=True)
         
         # Add tabs to notebook
         self.notebook.add(self.tab_images, text= "Images")
         self.notebook.add(self.tab_creators, text= "Creators")
         self.notebook.add(self.tab_tags, text= "Tags")
+        self.notebook.add(self.tab_gallery, text= "Gallery")
 
         # Run functions for initalizing each table
         self.init_image_table()
         self.init_creator_table()
         self.init_tags_table()
+        self.init_gallery()
+
+        if self.diagnostics.enabled:
+            self.tab_diagnostics = ttk.Frame(self.notebook)
+            self.tab_diagnostics.pack(fill='both', expand=True)
+            self.notebook.add(self.tab_diagnostics, text= "Diagnostics")
+            self.init_diagnostics_tab()
 
     def display_data(self, data_object, table_name):
-        # Clear existing data in the treeview
-        for row in data_object.get_children():
-            data_object.delete(row)
+        # Fetch data from the database and display it in the treeview once it arrives
+        self.db.submit(self.fetch_rows, "SELECT * FROM '{}'".format(table_name),
+                       callback=lambda rows: self.show_rows(data_object, rows))
 
-        # Fetch data from the database and display it in the treeview
-        self.cursor.execute("SELECT * FROM '{}'".format(table_name))
-        rows = self.cursor.fetchall()
+    def show_rows(self, data_object, rows):
+        # Clear existing data in the treeview
+        data_object.delete(*data_object.get_children())
 
         for row in rows:
             data_object.insert("", "end", iid=row[0], values=row)
 
     def display_image_data(self):
         # Clear existing data in the treeview
-        for row in self.image_tree.get_children():
-            self.image_tree.delete(row)
-
-        # Fetch data from the database and display it in the treeview
-        self.cursor.execute('''SELECT i.image_id, i.filename,
-                            c.creator_name, i.source_url,
-                            GROUP_CONCAT(tags.tag_name) as tags,
-                            i.date_added
-                            FROM images as i
-                            LEFT JOIN creators as c
-                            ON i.creator_id = c.creator_id
-                            LEFT JOIN image_tags
-                            ON i.image_id = image_tags.image_id
-                            LEFT JOIN tags ON image_tags.tag_id = tags.tag_id
-                            GROUP BY i.image_id, i.filename, i.creator_id, i.source_url
-                            ''')
-        rows = self.cursor.fetchall()
-
+        self.image_tree.delete(*self.image_tree.get_children())
+
+        # Sort keys of the loaded rows, in display order, used for paging and patching
+        self.image_row_keys = []
+        self.image_pages_done = False
+        # Whether rows before the first loaded one were dropped
+        self.image_rows_dropped = False
+        # Pages requested for an earlier sort or search are dropped when they arrive
+        self.image_table_generation += 1
+        self.image_page_pending = True
+        # Timed until the first page is shown
+        self.diagnostics.begin("display_image_data")
+        self.load_image_page()
+
+    # Fetch the next page of images after the last loaded row (keyset pagination)
+    def load_image_page(self):
+        if self.image_pages_done:
+            self.image_page_pending = False
+            return
+
+        page_size = int(self.image_tree.cget("height")) + IMAGE_PREFETCH_ROWS
+        query, params = image_page_query(self.image_sort_column, self.image_sort_descending, self.image_source(),
+                                         self.image_row_keys[-1] if self.image_row_keys else None, page_size,
+                                         self.image_date_range)
+        self.db.submit(self.fetch_rows, query, params,
+                       callback=lambda rows, generation=self.image_table_generation:
+                           self.show_image_page(rows, page_size, generation))
+
+    def show_image_page(self, rows, page_size, generation):
+        if generation != self.image_table_generation:
+            return
+        self.image_page_pending = False
+
+        # Read before the table changes, since the view's position is only updated when it is redrawn
+        top = self.image_top_row()
+        for row in rows:
+            self.image_tree.insert("", "end", iid=row[0], values=row[:-1])
+            self.image_row_keys.append((row[-1], row[0]))
+        self.diagnostics.end("display_image_data")
+
+        if len(rows) < page_size:
+            self.image_pages_done = True
+        # Drop the rows furthest above the view
+        excess = len(self.image_row_keys) - IMAGE_MAX_LOADED_ROWS
+        if excess > 0:
+            self.drop_image_rows(0, excess)
+            self.image_tree.yview_moveto(max(top - excess, 0) / len(self.image_row_keys))
+            self.image_rows_dropped = True
+
+    # Fetch the page of images before the first loaded row, when scrolling back to dropped rows
+    def load_previous_image_page(self):
+        page_size = int(self.image_tree.cget("height")) + IMAGE_PREFETCH_ROWS
+        query, params = image_page_query(self.image_sort_column, self.image_sort_descending, self.image_source(),
+                                         self.image_row_keys[0], page_size, self.image_date_range, backward=True)
+        self.db.submit(self.fetch_rows, query, params,
+                       callback=lambda rows, generation=self.image_table_generation:
+                           self.show_previous_image_page(rows, page_size, generation))
+
+    def show_previous_image_page(self, rows, page_size, generation):
+        if generation != self.image_table_generation:
+            return
+        self.image_page_pending = False
+
+        # Rows arrive nearest first; the view stays on the rows it showed
+        top = self.image_top_row()
         for row in rows:
-            self.image_tree.insert("", "end", iid=row[0], values=row)
+            self.image_tree.insert("", 0, iid=row[0], values=row[:-1])
+            self.image_row_keys.insert(0, (row[-1], row[0]))
+
+        if len(rows) < page_size:
+            self.image_rows_dropped = False
+        # Drop the rows furthest below the view; they are loaded again as the next pages
+        excess = len(self.image_row_keys) - IMAGE_MAX_LOADED_ROWS
+        if excess > 0:
+            self.drop_image_rows(len(self.image_row_keys) - excess, excess)
+            self.image_pages_done = False
+        self.image_tree.yview_moveto((top + len(rows)) / len(self.image_row_keys))
+
+    # Index of the first row shown in the image table
+    def image_top_row(self):
+        return round(float(self.image_tree.yview()[0]) * len(self.image_row_keys))
+
+    def drop_image_rows(self, position, count):
+        self.image_tree.delete(*self.image_tree.get_children()[position:position + count])
+        del self.image_row_keys[position:position + count]
+
+    # Position of a sort key among the loaded rows (binary search in display order)
+    def image_row_position(self, key):
+        low, high = 0, len(self.image_row_keys)
+        while low < high:
+            middle = (low + high) // 2
+            if self.image_sort_descending:
+                before = self.image_row_keys[middle] > key
+            else:
+                before = self.image_row_keys[middle] < key
+            if before:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Insert, update or remove a single row of the image table
+    def patch_image_row(self, image_id, row):
+        # Drop the old row; it is re-inserted below if it still exists
+        if self.image_tree.exists(image_id):
+            position = self.image_tree.index(image_id)
+            self.image_tree.delete(image_id)
+            del self.image_row_keys[position]
+
+        if row:
+            key = (row[-1], row[0])
+            position = self.image_row_position(key)
+            # Rows past either end of the loaded ones arrive with a later page instead
+            if ((position < len(self.image_row_keys) or self.image_pages_done)
+                    and (position > 0 or not self.image_rows_dropped)):
+                self.image_tree.insert("", position, iid=row[0], values=row[:-1])
+                self.image_row_keys.insert(position, key)
+
+    # Insert, update or remove a single row of a table shown with display_data
+    def patch_row(self, data_object, row_id, row):
+        if not row:
+            if data_object.exists(row_id):
+                data_object.delete(row_id)
+        elif data_object.exists(row_id):
+            data_object.item(row_id, values=row)
+        else:
+            data_object.insert("", "end", iid=row_id, values=row)
+
+    # Keep a lookup index in sync with the current name of one row
+    def patch_lookup(self, lookup, names_by_id, row_id, name):
+        old_name = names_by_id.pop(row_id, None)
+        if old_name is not None:
+            lookup.discard(old_name)
+        if name is not None:
+            names_by_id[row_id] = name
+            lookup.add(name)
+
+    # Patch the tables and lookup lists for the rows touched by an operation
+    def apply_changes(self, changes):
+        self.image_records.invalidate(changes)
+        sort_expr = IMAGE_SORT_COLUMNS[self.image_sort_column]
+        self.db.submit(self.fetch_changes, changes, self.image_filter, sort_expr, self.image_source(),
+                       self.image_date_range,
+                       callback=lambda rows, generation=self.image_table_generation:
+                           self.patch_changes(rows, generation))
+
+    # Runs on the database worker: update the indexes and read back every touched row
+    def fetch_changes(self, cursor, changes, image_filter, sort_expr, source, date_range):
+        self.tag_index.update(cursor, changes)
+        if changes.images:
+            self.hash_index.update(cursor, changes.images)
+
+        # Changed images may now enter or leave the current search results
+        if image_filter is not None and changes.images:
+            matches = self.filter_matches(cursor, image_filter, changes.images)
+            cursor.executemany("DELETE FROM temp.image_filter WHERE image_id = ?",
+                               [(image_id,) for image_id in changes.images - matches])
+            # Results that are new to a text search are ranked after the existing ones
+            cursor.executemany('''INSERT OR IGNORE INTO temp.image_filter (image_id, position)
+                               SELECT ?, COALESCE(MAX(position), 0) + 1 FROM temp.image_filter''',
+                               [(image_id,) for image_id in matches])
+
+        # Rows outside the date range come back as None and are removed from the table
+        conditions, params = date_range_clause(date_range)
+        row_query = IMAGE_ROW_SELECT.format(sort_expr, source) + "WHERE " + " AND ".join(conditions + ["i.image_id = ?"])
+        image_rows = {image_id: cursor.execute(row_query, params + [image_id]).fetchone()
+                      for image_id in changes.images}
+        tag_rows = {tag_id: cursor.execute("SELECT * FROM tags WHERE tag_id = ?", (tag_id,)).fetchone()
+                    for tag_id in changes.tags | changes.tag_counts}
+        creator_rows = {creator_id: cursor.execute("SELECT * FROM creators WHERE creator_id = ?", (creator_id,)).fetchone()
+                        for creator_id in changes.creators}
+        return image_rows, tag_rows, creator_rows
+
+    def patch_changes(self, rows, generation):
+        image_rows, tag_rows, creator_rows = rows
+
+        # After a reload the image table already shows the changed rows
+        if generation == self.image_table_generation:
+            for image_id, row in image_rows.items():
+                self.patch_image_row(image_id, row)
+
+        for tag_id, row in tag_rows.items():
+            self.patch_row(self.tag_tree, tag_id, row)
+            self.patch_lookup(self.all_tags, self.tag_names, tag_id, row[1] if row else None)
+            if row:
+                self.all_tags.set_weight(row[1], row[4])
+
+        for creator_id, row in creator_rows.items():
+            self.patch_row(self.creator_tree, creator_id, row)
+            self.patch_lookup(self.all_creators, self.creator_names, creator_id, row[1] if row else None)
+
+    # Check for rows changed by other instances; the next check is scheduled once this one is answered
+    def poll_changes(self):
+        self.db.submit(self.change_feed.poll, callback=self.on_external_changes, errback=self.on_change_poll_failed)
+
+    def on_external_changes(self, changes):
+        if changes == CHANGES_RELOAD:
+            self.reload_catalog()
+        elif changes is not None:
+            self.apply_changes(changes)
+        self.change_poll_failing = False
+        self.root.after(CHANGE_POLL_MS, self.poll_changes)
+
+    # Checks keep being retried; the error is shown once rather than on every failed check
+    def on_change_poll_failed(self, error):
+        if not self.change_poll_failing:
+            self.change_poll_failing = True
+            messagebox.showerror(title="Error", message="Could not check for changes: {}".format(error))
+        self.root.after(CHANGE_POLL_MS, self.poll_changes)
+
+    # Batch edits, deletes and their undo can touch more images than are worth patching one by one
+    def apply_bulk_changes(self, changes):
+        if len(changes.images) > CHANGE_RELOAD_THRESHOLD:
+            self.reload_catalog()
+        else:
+            self.apply_changes(changes)
+
+    # Show the catalog afresh after more changes than are worth patching row by row
+    def reload_catalog(self):
+        self.image_records = ImageRecordCache()
+        self.db.submit(self.rebuild_indexes, self.image_filter, callback=lambda result: self.on_catalog_reloaded())
+
+    # Runs on the database worker. Windows already open keep completing from the old lookup lists.
+    def rebuild_indexes(self, cursor, image_filter):
+        self.tag_index.build(cursor)
+        self.hash_index.build(cursor)
+        self.init_lookup_lists(cursor)
+        if image_filter is not None:
+            self.fill_image_filter(cursor, image_filter)
+
+    def on_catalog_reloaded(self):
+        self.display_image_data()
+        self.display_data(self.creator_tree, "creators")
+        self.display_tags()
+
+    def image_source(self):
+        return IMAGE_SOURCE if self.image_filter is None else IMAGE_FILTER_SOURCE
+
+    # Show only the images matching the search box.
+    # Tags mode takes tag queries (AND/OR/NOT, creator:name, format:png, width>=3840); Text mode searches
+    # filenames, source URLs, creators and tags and orders results by relevance.
+    def search_images(self):
+        query = self.entry_search.get().strip()
+        if not query:
+            self.clear_search()
+            return
+
+        try:
+            if self.search_mode.get() == "Text":
+                image_filter = ("text", fts_query(query))
+            else:
+                image_filter = ("tags", parse_query(query))
+        except QueryError as error:
+            messagebox.showerror(title="Error", message="Invalid search: {}".format(error))
+            return
+
+        # Pages are loaded after the filter is filled, since the worker runs work in order
+        self.image_filter = image_filter
+        self.db.submit(self.fill_image_filter, image_filter)
+        if image_filter[0] == "text":
+            self.image_sort_column = "rank"
+            self.image_sort_descending = False
+        elif self.image_sort_column == "rank":
+            self.image_sort_column = "image_id"
+        self.display_image_data()
+
+    def clear_search(self):
+        self.entry_search.delete(0, "end")
+        self.image_filter = None
+        if self.image_sort_column == "rank":
+            self.image_sort_column = "image_id"
+            self.image_sort_descending = False
+        self.display_image_data()
+
+    # Store the matching image ids and their result order in a temp table the pages join against
+    def fill_image_filter(self, cursor, image_filter):
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS image_filter (image_id INTEGER PRIMARY KEY, position INTEGER)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS temp.idx_image_filter_position ON image_filter (position, image_id)")
+        cursor.execute("DELETE FROM temp.image_filter")
+
+        kind, query = image_filter
+        if kind == "text":
+            # Ranking happens inside SQLite; only the ids and their positions are stored
+            cursor.execute('''INSERT INTO temp.image_filter (image_id, position)
+                              SELECT rowid, ROW_NUMBER() OVER (ORDER BY rank)
+                              FROM images_fts WHERE images_fts MATCH ?''', (query,))
+        else:
+            matches = self.tag_index.evaluate(query, cursor)
+            cursor.executemany("INSERT INTO temp.image_filter (image_id, position) VALUES (?, ?)",
+                               [(image_id, image_id) for image_id in bits_to_ids(matches)])
+
+    # Which of the given images match a search
+    def filter_matches(self, cursor, image_filter, image_ids):
+        kind, query = image_filter
+        if kind == "text":
+            cursor.execute("SELECT rowid FROM images_fts WHERE images_fts MATCH ? AND rowid IN (SELECT value FROM json_each(?))",
+                           (query, json.dumps(list(image_ids))))
+            return {row[0] for row in cursor.fetchall()}
+        matches = self.tag_index.evaluate(query, cursor)
+        return {image_id for image_id in image_ids if matches >> image_id & 1}
+
+    # Show only images dated within the From/To days, sorted by that date
+    def filter_dates(self):
+        try:
+            lower, upper = day_range(self.entry_date_from.get().strip(), self.entry_date_to.get().strip())
+        except ValueError as error:
+            messagebox.showerror(title="Error", message="Invalid date range: {}".format(error))
+            return
+        if lower is None and upper is None:
+            self.clear_date_filter()
+            return
+        self.set_date_range((self.date_column.get(), lower, upper))
+
+    def set_date_range(self, date_range):
+        self.image_date_range = date_range
+        # Sorting by the filtered column makes each page one range scan of its index
+        if self.image_sort_column != date_range[0]:
+            self.image_sort_column = date_range[0]
+            self.image_sort_descending = False
+        self.display_image_data()
+
+    def clear_date_filter(self):
+        self.entry_date_from.delete(0, "end")
+        self.entry_date_to.delete(0, "end")
+        self.image_date_range = None
+        self.display_image_data()
+
+    # Keep the scrollbar in sync and load more rows when nearing either end
+    def on_image_tree_scroll(self, first, last):
+        self.image_scrollbar.set(first, last)
+        if self.image_page_pending:
+            return
+        if float(last) >= IMAGE_SCROLL_THRESHOLD and not self.image_pages_done:
+            self.image_page_pending = True
+            self.root.after_idle(self.load_image_page)
+        elif float(first) <= 1 - IMAGE_SCROLL_THRESHOLD and self.image_rows_dropped and self.image_row_keys:
+            self.image_page_pending = True
+            self.root.after_idle(self.load_previous_image_page)
+
+    # The selected row the preview shows: the one with keyboard focus, or else the first
+    def preview_item(self):
+        item = self.image_tree.focus()
+        selection = self.image_tree.selection()
+        if item not in selection:
+            item = selection[0] if selection else ""
+        return item
+
+    # Preview the selected row and decode the rows around it ahead of time
+    def on_image_selected(self, event=None):
+        item = self.preview_item()
+        if not item:
+            self.set_preview(None, "")
+            return
+
+        items = [item]
+        before = after = item
+        for _ in range(PREVIEW_NEIGHBORS):
+            before = self.image_tree.prev(before) if before else ""
+            after = self.image_tree.next(after) if after else ""
+            items += [neighbor for neighbor in (after, before) if neighbor]
+        image_ids = [int(neighbor) for neighbor in items]
+
+        self.diagnostics.begin("preview")
+        missing = [image_id for image_id in image_ids if self.image_records.get(image_id) is None]
+        if missing:
+            self.db.submit(fetch_image_records, missing,
+                           callback=lambda records: self.show_preview(image_ids, records))
+        else:
+            self.show_preview(image_ids, {})
+
+    def show_preview(self, image_ids, records):
+        self.image_records.update(records)
+        # The selection may have moved on while the records were fetched
+        if self.preview_item() != str(image_ids[0]):
+            return
+        records = [self.image_records.get(image_id) for image_id in image_ids]
+        if records[0] is None:
+            self.set_preview(None, "")
+            return
+        # Records hold the stored path third
+        self.preview_loader.show(records[0][2], self.on_preview_decoded,
+                                 neighbors=[record[2] for record in records[1:] if record])
+
+    def on_preview_decoded(self, photo):
+        self.diagnostics.end("preview")
+        self.set_preview(photo, "No preview")
+
+    def set_preview(self, photo, text):
+        # The label keeps the only reference to the photo, so the previous one is freed
+        self.preview_photo = photo
+        self.preview_label.configure(image=photo or self.blank_preview(), text="" if photo else text)
+
+    # Transparent placeholder keeping the label at its pixel size while nothing is shown
+    def blank_preview(self):
+        if getattr(self, "preview_blank", None) is None:
+            self.preview_blank = tk.PhotoImage(width=PREVIEW_SIZE[0], height=PREVIEW_SIZE[1])
+        return self.preview_blank
+
+    # Sort the image table by a column, toggling direction on repeated clicks
+    def sort_image_table(self, column):
+        if column == self.image_sort_column:
+            self.image_sort_descending = not self.image_sort_descending
+        else:
+            self.image_sort_column = column
+            self.image_sort_descending = False
+        self.display_image_data()
 
     def init_image_table(self):
         # Init Inputs
         self.button_insert_image_window = tk.Button(self.tab_images, text="Add Image", command=self.windowAddImage)
+        self.button_import_folder_window = tk.Button(self.tab_images, text="Import Folder", command=self.windowImportFolder)
+        self.button_duplicates_window = tk.Button(self.tab_images, text="Find Duplicates", command=self.windowDuplicates)
+
+        self.image_table_cols = ("image_id", "filename", "creator", "source_url", "tags", "date_added", "date_uploaded")
+        self.image_tree = ttk.Treeview(self.tab_images, columns=self.image_table_cols, show="headings",
+                                       yscrollcommand=self.on_image_tree_scroll)
+        self.image_scrollbar = ttk.Scrollbar(self.tab_images, orient="vertical", command=self.image_tree.yview)
+        self.image_sort_column = "image_id"
+        self.image_sort_descending = False
+        self.image_table_generation = 0
+        # (column, lower, upper) bounds from the date filter, or None to show every date
+        self.image_date_range = None
 
-        self.image_table_cols = ("image_id", "filename", "creator", "source_url", "tags", "date_added")
-        self.image_tree = ttk.Treeview(self.tab_images, columns=self.image_table_cols, show="headings")
-        
         for col in self.image_table_cols:
-            self.image_tree.heading(col, text=col)
+            self.image_tree.column(col, width=IMAGE_COLUMN_WIDTHS[col])
+            if col in IMAGE_SORT_COLUMNS:
+                self.image_tree.heading(col, text=col, command=lambda c=col: self.sort_image_table(c))
+            else:
+                self.image_tree.heading(col, text=col)
 
         self.button_edit_image = tk.Button(self.tab_images, text="Edit Entry", command=self.editImageWindow)
         self.button_delete_image = tk.Button(self.tab_images, text="Delete Entry", command=self.delete_image_data)
+        self.button_undo_delete = tk.Button(self.tab_images, text="Undo Delete", command=self.undo_delete_images,
+                                            state="disabled")
+        self.button_integrity_window = tk.Button(self.tab_images, text="Check Files", command=self.windowIntegrity)
 
         # For table
         self.button_insert_image_window.grid(row=0, column=0, columnspan=2, pady=10)
-        self.image_tree.grid(row=1, column=0, columnspan=4, padx=10, pady=10)
+        self.button_import_folder_window.grid(row=0, column=2, pady=10)
+        self.button_duplicates_window.grid(row=0, column=3, pady=10)
+        self.image_tree.grid(row=1, column=0, columnspan=4, padx=(10, 0), pady=10)
+        self.image_scrollbar.grid(row=1, column=4, sticky="ns", pady=10)
+
+        # Preview of the selected image
+        self.preview_label = tk.Label(self.tab_images, width=PREVIEW_SIZE[0], height=PREVIEW_SIZE[1], image=self.blank_preview(),
+                                      compound="center")
+        self.preview_label.grid(row=1, column=5, padx=10, pady=10, sticky="n")
+        self.image_tree.bind("<<TreeviewSelect>>", self.on_image_selected)
 
         # For Editing and Deleting buttons
         self.button_edit_image.grid(row=2, column=0, padx=10, pady=10)
+        self.button_undo_delete.grid(row=2, column=1, padx=10, pady=10)
         self.button_delete_image.grid(row=2, column=2, padx=10, pady=10)
+        self.button_integrity_window.grid(row=2, column=3, padx=10, pady=10)
+
+        # For searching
+        self.search_frame = tk.Frame(self.tab_images)
+        self.label_search = tk.Label(self.search_frame, text="Search")
+        self.search_mode = ttk.Combobox(self.search_frame, values=SEARCH_MODES, state="readonly", width=6)
+        self.search_mode.set(SEARCH_MODES[0])
+        self.entry_search = tk.Entry(self.search_frame, width=50)
+        self.entry_search.bind("<Return>", lambda event: self.search_images())
+        self.button_search = tk.Button(self.search_frame, text="Search", command=self.search_images)
+        self.button_clear_search = tk.Button(self.search_frame, text="Clear", command=self.clear_search)
+
+        self.search_frame.grid(row=3, column=0, columnspan=4, padx=10, pady=5)
+        self.label_search.pack(side="left", padx=5)
+        self.search_mode.pack(side="left", padx=5)
+        self.entry_search.pack(side="left", padx=5)
+        self.button_search.pack(side="left", padx=5)
+        self.button_clear_search.pack(side="left", padx=5)
+
+        # For filtering by date (YYYY-MM-DD, either end may be left empty)
+        self.date_frame = tk.Frame(self.tab_images)
+        self.date_column = ttk.Combobox(self.date_frame, values=DATE_COLUMNS, state="readonly", width=13)
+        self.date_column.set(DATE_COLUMNS[0])
+        self.label_date_from = tk.Label(self.date_frame, text="From")
+        self.entry_date_from = tk.Entry(self.date_frame, width=12)
+        self.label_date_to = tk.Label(self.date_frame, text="To")
+        self.entry_date_to = tk.Entry(self.date_frame, width=12)
+        self.button_date_filter = tk.Button(self.date_frame, text="Filter", command=self.filter_dates)
+        self.button_clear_dates = tk.Button(self.date_frame, text="All Dates", command=self.clear_date_filter)
+        self.button_timeline_window = tk.Button(self.date_frame, text="Timeline", command=self.windowTimeline)
+
+        self.date_frame.grid(row=4, column=0, columnspan=4, padx=10, pady=5)
+        self.date_column.pack(side="left", padx=5)
+        self.label_date_from.pack(side="left", padx=5)
+        self.entry_date_from.pack(side="left", padx=5)
+        self.label_date_to.pack(side="left", padx=5)
+        self.entry_date_to.pack(side="left", padx=5)
+        self.button_date_filter.pack(side="left", padx=5)
+        self.button_clear_dates.pack(side="left", padx=5)
+        self.button_timeline_window.pack(side="left", padx=5)
 
         # Fetch and display existing data
         self.display_image_data()
@@ -167,6 +675,7 @@ class DatabaseApp:
         self.creator_name_list = ttk.Combobox(self.tab_creators, value=[" "])
 
         self.button_insert_creator = tk.Button(self.tab_creators, text="Insert Data", command=self.insert_creator_data)
+        self.button_delete_creator = tk.Button(self.tab_creators, text="Delete Creator", command=self.delete_creator_data)
         self.creator_tree = ttk.Treeview(self.tab_creators, columns=("creator_id", "creator"), show="headings")
 
         self.creator_headers = ("creator_id", "creator_name")
@@ -182,7 +691,8 @@ class DatabaseApp:
         self.creator_name_list.grid(row=1, column=1, padx=10, pady=10)
 
         # For table
-        self.button_insert_creator.grid(row=2, column=0, columnspan=2, pady=10)
+        self.button_insert_creator.grid(row=2, column=0, pady=10)
+        self.button_delete_creator.grid(row=2, column=1, pady=10)
         self.creator_tree.grid(row=3, column=0, columnspan=2, padx=10, pady=10)
 
         self.display_data(self.creator_tree, "creators")
@@ -199,9 +709,11 @@ class DatabaseApp:
         self.entry_description = tk.Text(self.tab_tags, width=20, height=3)
 
         self.button_insert_tag = tk.Button(self.tab_tags, text="Insert Data", command=self.insert_tag_data)
-        self.tag_tree = ttk.Treeview(self.tab_tags, columns=("tag_id", "tag_name", "tag_description", "category"), show="headings")
+        self.button_delete_unused_tags = tk.Button(self.tab_tags, text="Remove Unused Tags",
+                                                   command=self.delete_unused_tag_data)
+        self.button_tag_rules = tk.Button(self.tab_tags, text="Aliases & Implications", command=self.windowTagRules)
 
-        self.tag_headers = ("tag_id", "tag_name", "tag_description", "category")
+        self.tag_headers = ("tag_id", "tag_name", "tag_description", "category", "use_count")
         self.tag_tree = ttk.Treeview(self.tab_tags, columns=self.tag_headers, show="headings")
         
         for col in self.tag_headers:
@@ -219,10 +731,90 @@ class DatabaseApp:
 
         # For table
         self.button_insert_tag.grid(row=2, column=0, columnspan=2, pady=10)
-        self.tag_tree.grid(row=3, column=0, columnspan=2, padx=10, pady=10)
+        self.button_delete_unused_tags.grid(row=2, column=2, padx=10, pady=10)
+        self.button_tag_rules.grid(row=1, column=2, padx=10, pady=10)
+        self.tag_tree.grid(row=3, column=0, columnspan=3, padx=10, pady=10)
+
+        self.display_tags()
+
+    # Fetch and display existing tags, most used first
+    def display_tags(self):
+        self.db.submit(self.fetch_rows, "SELECT * FROM tags ORDER BY use_count DESC, tag_name",
+                       callback=lambda rows: self.show_rows(self.tag_tree, rows))
+
+    def init_gallery(self):
+        self.thumbnail_cache = ThumbnailCache(self.root, cache_dir=self.thumbnail_cache_dir,
+                                              max_bytes=self.thumbnail_cache_max_bytes)
+        # Blank image so empty cells keep the thumbnail size
+        self.gallery_placeholder = tk.PhotoImage(width=THUMBNAIL_SIZE[0], height=THUMBNAIL_SIZE[1])
+        self.gallery_ids = []
+
+        self.gallery_frame = tk.Frame(self.tab_gallery)
+        self.gallery_cells = []
+        for index in range(GALLERY_COLUMNS * GALLERY_ROWS):
+            cell = tk.Label(self.gallery_frame, image=self.gallery_placeholder, compound="top",
+                            wraplength=THUMBNAIL_SIZE[0])
+            cell.image_id = None
+            cell.grid(row=index // GALLERY_COLUMNS, column=index % GALLERY_COLUMNS, padx=5, pady=5)
+            self.gallery_cells.append(cell)
+
+        self.button_gallery_previous = tk.Button(self.tab_gallery, text="Previous",
+                                                 command=lambda: self.gallery_ids and self.load_gallery_page(before_id=self.gallery_ids[0]))
+        self.button_gallery_next = tk.Button(self.tab_gallery, text="Next",
+                                             command=lambda: self.gallery_ids and self.load_gallery_page(after_id=self.gallery_ids[-1]))
 
-        # Fetch and display existing data
-        self.display_data(self.tag_tree, "tags")
+        # Place on widget
+        self.gallery_frame.grid(row=0, column=0, columnspan=2, padx=10, pady=10)
+        self.button_gallery_previous.grid(row=1, column=0, padx=10, pady=10)
+        self.button_gallery_next.grid(row=1, column=1, padx=10, pady=10)
+
+        # Thumbnails are only requested once the gallery is actually shown
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+
+    def on_tab_changed(self, event):
+        if self.diagnostics.enabled and self.notebook.select() == str(self.tab_diagnostics):
+            self.refresh_diagnostics()
+        if self.notebook.select() == str(self.tab_gallery):
+            # Reload the current page, which follows the image table's search
+            self.load_gallery_page(after_id=self.gallery_ids[0] - 1 if self.gallery_ids else 0)
+
+    # Show one page of thumbnails in image_id order (keyset pagination in both directions)
+    def load_gallery_page(self, after_id=0, before_id=None):
+        page_size = GALLERY_COLUMNS * GALLERY_ROWS
+        query = "SELECT i.image_id, i.filename, i.directory_path FROM {} WHERE ".format(self.image_source())
+        conditions, params = date_range_clause(self.image_date_range)
+        if before_id is None:
+            self.db.submit(self.fetch_rows, query + " AND ".join(conditions + ["i.image_id > ? ORDER BY i.image_id LIMIT ?"]),
+                           params + [after_id, page_size],
+                           callback=lambda rows: self.show_gallery_page(rows, after_id, before_id))
+        else:
+            self.db.submit(self.fetch_rows, query + " AND ".join(conditions + ["i.image_id < ? ORDER BY i.image_id DESC LIMIT ?"]),
+                           params + [before_id, page_size],
+                           callback=lambda rows: self.show_gallery_page(rows[::-1], after_id, before_id))
+
+    def show_gallery_page(self, rows, after_id, before_id):
+        # Stay on the current page at either end of the catalog
+        if not rows and self.gallery_ids and (before_id is not None or after_id >= self.gallery_ids[-1]):
+            return
+
+        self.gallery_ids = [row[0] for row in rows]
+        for index, cell in enumerate(self.gallery_cells):
+            cell.photo = None
+            if index >= len(rows):
+                cell.image_id = None
+                cell.configure(image=self.gallery_placeholder, text="")
+                continue
+            image_id, filename, directory_path = rows[index]
+            cell.image_id = image_id
+            cell.configure(image=self.gallery_placeholder, text=filename)
+            self.thumbnail_cache.request(directory_path,
+                                         lambda photo, cell=cell, image_id=image_id: self.show_thumbnail(cell, image_id, photo))
+
+    def show_thumbnail(self, cell, image_id, photo):
+        # The cell may show a different image by the time the thumbnail is ready
+        if photo and cell.image_id == image_id:
+            cell.photo = photo
+            cell.configure(image=photo)
 
     def insert_creator_data(self):
         # Fetch name as string
@@ -234,203 +826,167 @@ class DatabaseApp:
             messagebox.showerror(title="Error",
                                   message="Creator name cannot be empty.")
         else:
-            # Check if name is not listed in table yet
-            self.cursor.execute("SELECT creator_id FROM creators WHERE creator_name = ?", (creator_name,))
-            id_result = self.cursor.fetchone()
-
-            # Only write data if creator name doesn't already exist
-            if id_result:
-                messagebox.showerror(title="Error",
-                                      message="Creator already exists.")
-            else:
-                # Insert the data
-                self.cursor.execute("INSERT INTO creators (creator_name) VALUES (?)", (creator_name,))
-
-                # Commit the change
-                self.conn.commit()
+            self.db.submit(add_creator, creator_name, callback=self.on_creator_written)
 
-        self.display_data(self.creator_tree, "creators")      
+    def on_creator_written(self, changes):
+        # Only written if creator name didn't already exist
+        if changes is None:
+            messagebox.showerror(title="Error",
+                                  message="Creator already exists.")
+        else:
+            self.apply_changes(changes)
 
-    # Deletes images by on press of "Delete" button on "creators" tab
-    # NOT IMPLEMENTED
+    # Deletes creators on press of "Delete Creator" button on "creators" tab, asking whether
+    # their images go with them or to another creator
     def delete_creator_data(self):
 
-        # Retrieve id of selected image entry/entries
+        # Retrieve id of selected creator entry/entries
         selected_creators = self.creator_tree.selection()
         number_selected = len(selected_creators)
 
         if (number_selected > 0):
-            # Warning message: Only proceed if user answers "yes"
-            try:
-                delete_confirm = messagebox.askquestion(title="Warning",
-                                                        message='''You are about to delete {} creator(s). This operation cannot be undone. Are you sure?'''.format(number_selected))
-                if delete_confirm=='yes':
-                    # For all images selected, iterate and delete all
-                    for creator in selected_creators:
-                        self.creator_tree.delete(creator)
-                        self.cursor.execute("DELETE FROM creators WHERE creator_id = ?", (creator,))
-                    
-                    # Commit change and refresh table
-                    self.conn.commit()
-                    self.display_data(self.creator_tree, "creators")
-            except:
-                pass
-                # If rows not selected, notify user
+            self.delete_creator_ids = [int(creator) for creator in selected_creators]
+            self.delete_creator_window = tk.Toplevel(root)
+            self.delete_creator_window.title("Delete {} Creator(s)".format(number_selected))
+            self.delete_creator_window.attributes('-topmost', True)
+
+            self.delete_creator_mode = tk.StringVar(value="reassign")
+            self.radio_reassign_images = tk.Radiobutton(self.delete_creator_window, text="Give their images to",
+                                                        variable=self.delete_creator_mode, value="reassign")
+            self.entry_reassign_creator = IndexedAutocompleteEntry(self.delete_creator_window,
+                                                                   completevalues=self.all_creators)
+            self.radio_cascade_images = tk.Radiobutton(self.delete_creator_window, text="Delete their images too",
+                                                       variable=self.delete_creator_mode, value="cascade")
+            self.button_confirm_delete_creator = tk.Button(self.delete_creator_window, text="Delete",
+                                                           command=self.confirm_delete_creators)
+
+            # Place on widget
+            self.radio_reassign_images.grid(row=0, column=0, padx=10, pady=10, sticky="w")
+            self.entry_reassign_creator.grid(row=0, column=1, padx=10, pady=10)
+            self.radio_cascade_images.grid(row=1, column=0, padx=10, pady=10, sticky="w")
+            self.button_confirm_delete_creator.grid(row=2, column=0, padx=10, pady=10)
+        # If rows not selected, notify user
         else:
             messagebox.showerror(title="Error", message="No rows selected to delete.")
 
+    def confirm_delete_creators(self):
+        reassign_to = None
+        if self.delete_creator_mode.get() == "reassign":
+            reassign_to = self.entry_reassign_creator.get().strip()
+            if not reassign_to:
+                messagebox.showerror(title="Error", message="Enter the creator to give the images to.",
+                                     parent=self.delete_creator_window)
+                return
+        # Delete on the worker, then refresh the deleted rows
+        self.db.submit(delete_creators, self.delete_creator_ids, reassign_to,
+                       callback=self.on_images_deleted, errback=self.show_delete_creator_error)
+        self.delete_creator_window.destroy()
+
+    # Images can't be given to one of the creators being deleted
+    def show_delete_creator_error(self, error):
+        messagebox.showerror(title="Error", message=str(error))
+
 # Basic CRUD Operations: image data
 
     def insert_image_data(self):
         # Fetch information from inputs for new image
-        filepath = self.browse_label.cget("text").split(':')[-1]
+        filepath = self.browse_filepath
         creator_name = self.entry_creator.get()
         source = self.entry_source.get()
-        tags = [s.strip() for s in self.entry_image_tags.get().split(",")]
+        tags = [s.strip() for s in self.entry_image_tags.get().split(",") if s.strip()]
         current_datetime = datetime.now(timezone.utc)
-        upload_date = self.entry_dateadd.get()
+        upload_date = self.selected_upload_date()
 
         # Check if name is a non-empty string
         if not creator_name:
             messagebox.showerror(title="Error",
                                   message="Creator name cannot be empty.")
-            
+            return
         elif not filepath:
             messagebox.showerror(title="Error",
                                   message="You must select an image.")
+            return
+
+        # Copying and hashing run on the worker, confirmation and the insert follow from there
+        values = (creator_name, source, tags, current_datetime, upload_date)
+        self.diagnostics.begin("insert_image_data")
+        self.db.submit(self.prepare_image, filepath, callback=lambda stored: self.confirm_image(stored, values))
+
+    # Runs on the database worker: copy the file and look for copies already in the catalog
+    def prepare_image(self, cursor, filepath):
+        # Its content hash tells us if the image is already catalogued
+        destination_path, content_hash, is_new, duplicate = store_image(cursor, filepath, self.image_destination,
+                                                                        self.storage_mode)
+
+        # A similar looking image (resized, re-encoded) may be catalogued under different bytes
+        try:
+            phash = to_signed(dhash(destination_path))
+        except (OSError, ValueError):
+            phash = None
+        similar = self.hash_index.query(phash) if phash is not None and not duplicate else []
+        # One header is quick to read here; bulk imports use a process pool
+        metadata = try_read_metadata(destination_path)
+        return destination_path, content_hash, is_new, phash, metadata, duplicate, similar
+
+    def confirm_image(self, stored, values):
+        destination_path, content_hash, is_new, phash, metadata, duplicate, similar = stored
+        if duplicate:
+            add_confirm = messagebox.askyesno(title="Duplicate",
+                                              message="This image is already in the catalog (image {}). Add it again?".format(duplicate),
+                                              parent=self.image_window)
+        elif similar:
+            add_confirm = messagebox.askyesno(title="Possible Duplicate",
+                                              message="This image looks like {} catalogued image(s), closest is image {}. Add it anyway?".format(
+                                                  len(similar), similar[0][0]),
+                                              parent=self.image_window)
         else:
-            # Look up the creator id by using given creator name
-            self.cursor.execute("SELECT creator_id FROM creators WHERE creator_name = ?", (creator_name,))
-            id_result = self.cursor.fetchone()
-
-            # If the creator_id doesn't exist for a creator name, make an entry in the creator table
-            #    and use this new id when creating the entry
-            if not id_result:
-                self.cursor.execute("INSERT INTO creators (creator_name) VALUES (?)", (creator_name,))
-                self.cursor.execute("SELECT creator_id FROM creators WHERE creator_name = ?", (creator_name,))
-                id_result = self.cursor.fetchone()
-            
-            # Convert creator_id result to integer from tuple object
-            id_result = id_result[0]
-
-            destination_path = self.addToDirectory(filepath)
-            filename = os.path.basename(destination_path)
-
-            # Insert the image data
-            self.cursor.execute("INSERT INTO images (filename, creator_id, source_url, directory_path, date_added, date_uploaded) VALUES (?, ?, ?, ?, ?, ?)",
-                                (filename, id_result, source, destination_path, current_datetime, upload_date))
-
-            # Commit the change
-            self.conn.commit()
-
-        # Handling tag data only if a tag was submitted
-        # Get image id for the entry we just submitted
-        self.cursor.execute("SELECT image_id from images WHERE filename = ? AND creator_id = ?", (filename, id_result))
-        image_id_result = self.cursor.fetchone()[0]
-        # Get the tag id
-        for tag in tags:
-            self.cursor.execute("SELECT tag_id from tags WHERE tag_name = ?", (tag,))
-            tag_output = self.cursor.fetchone()
-            print(tag_output)
-            if tag_output:
-                tag_id = tag_output[0]
-                self.cursor.execute("INSERT INTO image_tags (image_id, tag_id) VALUES (?, ?)", (image_id_result, tag_id))
-                print((image_id_result, tag_id))
-            else:
-                self.cursor.execute("INSERT INTO tags (tag_name) VALUES (?)", (tag,))
-                self.cursor.execute("SELECT tag_id from tags WHERE tag_name = ?", (tag,))
-                tag_id = self.cursor.fetchone()[0]
-                print(tag_id)
-                self.cursor.execute("INSERT INTO image_tags (image_id, tag_id) VALUES (?, ?)", (image_id_result, tag_id))
-                print((image_id_result, tag_id))
-            # Commit changes
-            self.conn.commit()
+            add_confirm = True
 
-        self.display_image_data()
-        self.display_data(self.tag_tree, "tags")
+        if not add_confirm:
+            # Hashed storage shares an existing file, flat storage made a redundant copy
+            remove_stored(destination_path, is_new)
+            return
+
+        self.db.submit(add_image, destination_path, *values, content_hash, phash, metadata,
+                       callback=self.on_image_written)
+
+    def on_image_written(self, changes):
+        self.diagnostics.end("insert_image_data")
+
+        # Patch the rows that were touched
+        self.apply_changes(changes)
 
         # Clear inputs
-        self.entry_filename.delete(0, "end")
-        self.entry_creator.delete(0, "end")
-        self.entry_image_tags.delete(0, "end")
-        self.entry_source.delete(0, "end")
-        self.browse_label.configure(text="Select File")
+        if self.image_window.winfo_exists():
+            self.entry_filename.delete(0, "end")
+            self.entry_creator.delete(0, "end")
+            self.entry_image_tags.delete(0, "end")
+            self.entry_source.delete(0, "end")
+            self.browse_filepath = ""
+            self.browse_label.configure(text="Select File")
 
     def edit_image_data(self):
         # Fetch information from inputs for new image
         image_id = self.selected_image_id
         creator_name = self.entry_creator.get()
         source = self.entry_source.get()
-        tags = [s.strip() for s in self.entry_image_tags.get().split(",")]
+        tags = [s.strip() for s in self.entry_image_tags.get().split(",") if s.strip()]
         current_datetime = datetime.now(timezone.utc)
-        upload_date = self.entry_dateadd.get()
+        upload_date = self.selected_upload_date()
 
         # Check if name is a non-empty string
         if not creator_name:
             messagebox.showerror(title="Error",
                                   message="Creator name cannot be empty.")
-        else:
-            # Look up the creator id by using given creator name
-            self.cursor.execute("SELECT creator_id FROM creators WHERE creator_name = ?", (creator_name,))
-            id_result = self.cursor.fetchone()
-
-            # If the creator_id doesn't exist for a creator name, make an entry in the creator table
-            #    and use this new id when creating the entry
-            if not id_result:
-                self.cursor.execute("INSERT INTO creators (creator_name) VALUES (?)", (creator_name,))
-                self.cursor.execute("SELECT creator_id FROM creators WHERE creator_name = ?", (creator_name,))
-                id_result = self.cursor.fetchone()
-            
-            # Convert creator_id result to integer from tuple object
-            id_result = id_result[0]
-
-            # Insert the image data
-            self.cursor.execute("UPDATE images SET creator_id = ?, source_url = ?, date_added = ?, date_uploaded = ? WHERE image_id = ?",
-                                (id_result, source, current_datetime, upload_date, image_id))
-
-            # Commit the change
-            self.conn.commit()
-
-        new_tag_ind = []
-        # Check if any tags must be added to image_tags
-        for tag in tags:
-            self.cursor.execute("SELECT tag_id FROM tags WHERE tag_name = ?", (tag,))
-            tag_output = self.cursor.fetchone()
-            print(tag_output)
-            # If tag doesn't exist, add to both tables
-            if not tag_output:
-                self.cursor.execute("INSERT INTO tags (tag_name) VALUES (?)", (tag,))
-                self.cursor.execute("SELECT tag_id from tags WHERE tag_name = ?", (tag,))
-                tag_id = self.cursor.fetchone()[0]
-                new_tag_ind += [tag_id]
-            else:
-            # If tag exists in tag table, check if in image_tags
-                tag_id = tag_output[0]
-                new_tag_ind += [tag_id]
-            
-            # Commit changes
-            self.conn.commit()
-        
-        # Build list of tag indicies
-        self.cursor.execute("SELECT tag_id FROM image_tags WHERE image_id = ?", (image_id,))
-        existing_tags = self.cursor.fetchall()
-        existing_tags = [x[0] for x in existing_tags]
-        print("existing tags: " + str(existing_tags))
-        print(new_tag_ind)
-
-        # If tag is listed in existing but not new, delete
-        for tag in existing_tags:
-            if tag not in new_tag_ind:
-                self.cursor.execute("DELETE FROM image_tags WHERE image_id = ? AND tag_id = ?", (image_id, tag))
-
-        # If tag is listed in new but not existing, add
-        for tag in new_tag_ind:
-            if tag not in existing_tags:
-                self.cursor.execute("INSERT INTO image_tags (image_id, tag_id) VALUES (?, ?)", (image_id, tag_id))
-        self.conn.commit()
+            return
 
-        self.display_image_data()
-        self.display_data(self.tag_tree, "tags")
+        self.diagnostics.begin("edit_image_data")
+        self.db.submit(edit_image, image_id, creator_name, source, tags, current_datetime, upload_date,
+                       callback=self.on_image_edited)
+
+    def on_image_edited(self, changes):
+        self.diagnostics.end("edit_image_data")
+        self.apply_changes(changes)
 
     # Deletes images by on press of "Delete" button on "images" tab
     def delete_image_data(self):
@@ -444,62 +1000,165 @@ class DatabaseApp:
             # Warning message: Only proceed if user answers "yes"
             try:
                 delete_confirm = messagebox.askquestion(title="Warning",
-                                                        message='''You are about to delete {} image(s). This operation cannot be undone. Are you sure?'''.format(number_selected))
+                                                        message='''You are about to delete {} image(s). Undo Delete can bring them back for {} days. Are you sure?'''.format(
+                                                            number_selected, TRASH_RETENTION_SECONDS // (24 * 60 * 60)))
                 if delete_confirm=='yes':
-                    # For all images selected, iterate and delete all
-                    for image in selected_images:
-                        self.image_tree.delete(image)
-                        self.cursor.execute("DELETE FROM images WHERE image_id = ?", (image,))
-                        self.cursor.execute("DELETE FROM image_tags WHERE image_id = ?", (image,))
-                    
-                    # Commit change and refresh table
-                    self.conn.commit()
-                    self.display_image_data()
+                    # Delete on the worker, then remove the deleted rows
+                    self.db.submit(delete_images, [int(image) for image in selected_images],
+                                   callback=self.on_images_deleted)
             except:
                 pass
         # If rows not selected, notify user
         else:
             messagebox.showerror(title="Error", message="No rows selected to delete.")
 
+    def on_images_deleted(self, changes):
+        if changes.trash_batch is not None:
+            self.undo_batches.append(changes.trash_batch)
+            self.button_undo_delete.config(state="normal")
+        self.apply_bulk_changes(changes)
+
+    # Bring back the images of the last delete made in this window
+    def undo_delete_images(self):
+        if self.undo_batches:
+            self.db.submit(restore_trash, self.undo_batches.pop(), callback=self.apply_bulk_changes,
+                           errback=self.show_undo_error)
+        if not self.undo_batches:
+            self.button_undo_delete.config(state="disabled")
+
+    # The batch was already restored or emptied, by another instance or the command line
+    def show_undo_error(self, error):
+        messagebox.showerror(title="Undo Delete", message=str(error))
+
     # Add tag data by pressing "submit"
     def insert_tag_data(self):
         tag_name = self.entry_tagname.get()
         tag_description = self.entry_description.get("1.0", 'end-1c')
         tag_category = self.entry_category.get()
 
-        error_count = 0
-
         # Check tag name is not empty
         if tag_name == "":
             messagebox.showerror(title="Error",
                                   message="Tag name cannot be empty.")
-            error_count += 1
         else:
-            # Check tag name is not taken
-            self.cursor.execute("SELECT tag_id FROM tags WHERE tag_name = ?", (tag_name,))
-            id_result = self.cursor.fetchone()
-
-            if id_result:
-                messagebox.showerror(title="Error",
-                                     message="Tag name already taken.")
-                error_count += 1
-        
-        if error_count == 0:
-            # Insert the data
-            self.cursor.execute("INSERT INTO tags (tag_name, tag_description, category) VALUES (?, ?, ?)", (tag_name, tag_description, tag_category))
+            self.db.submit(add_tag, tag_name, tag_description, tag_category, callback=self.on_tag_written)
+
+    def on_tag_written(self, changes):
+        if changes is None:
+            messagebox.showerror(title="Error",
+                                 message="Tag name already taken.")
+        else:
+            self.apply_changes(changes)
+
+    # Ask before deleting every tag that no image uses
+    def delete_unused_tag_data(self):
+        self.db.submit(self.fetch_rows, "SELECT COUNT(*) FROM ({})".format(UNUSED_TAGS),
+                       callback=self.confirm_delete_unused_tags)
+
+    def confirm_delete_unused_tags(self, rows):
+        unused = rows[0][0]
+        if unused == 0:
+            messagebox.showinfo(title="Remove Unused Tags", message="Every tag is used by at least one image.")
+        elif messagebox.askyesno(title="Remove Unused Tags",
+                                 message="Delete {} tag(s) that no image uses?".format(unused)):
+            self.db.submit(delete_unused_tags, callback=self.apply_changes)
+
+    # Aliases (another name stored as the tag) and implications (searching for the implied tag also
+    # finds images of the tag) between tags
+    def windowTagRules(self):
+        self.rules_window = tk.Toplevel(root)
+        self.rules_window.title("Aliases & Implications")
+        self.rules_window.geometry("560x420")
+
+        self.label_rule_tag = tk.Label(self.rules_window, text="Tag")
+        self.entry_rule_tag = IndexedAutocompleteEntry(self.rules_window, completevalues=self.all_tags)
+        self.label_rule_other = tk.Label(self.rules_window, text="Alias or Implied Tag")
+        self.entry_rule_other = IndexedAutocompleteEntry(self.rules_window, completevalues=self.all_tags)
+        self.button_add_alias = tk.Button(self.rules_window, text="Add Alias", command=self.insert_tag_alias)
+        self.button_add_implication = tk.Button(self.rules_window, text="Add Implication",
+                                                command=self.insert_tag_implication)
+        self.button_remove_rules = tk.Button(self.rules_window, text="Remove Selected",
+                                             command=self.delete_selected_tag_rules)
+        self.rules_tree = ttk.Treeview(self.rules_window, columns=("rule", "name", "tag"), show="headings")
+        for col, heading in (("rule", "Rule"), ("name", "Name / Tag"), ("tag", "Tag / Implied Tag")):
+            self.rules_tree.heading(col, text=heading)
+
+        # Place on widget
+        self.label_rule_tag.grid(row=0, column=0, padx=10, pady=5)
+        self.entry_rule_tag.grid(row=0, column=1, padx=10, pady=5)
+        self.label_rule_other.grid(row=1, column=0, padx=10, pady=5)
+        self.entry_rule_other.grid(row=1, column=1, padx=10, pady=5)
+        self.button_add_alias.grid(row=2, column=0, padx=10, pady=10)
+        self.button_add_implication.grid(row=2, column=1, padx=10, pady=10)
+        self.button_remove_rules.grid(row=2, column=2, padx=10, pady=10)
+        self.rules_tree.grid(row=3, column=0, columnspan=3, padx=10, pady=10)
+
+        self.db.submit(tag_rules, callback=self.show_tag_rules)
+
+    def show_tag_rules(self, rules):
+        if not self.rules_window.winfo_exists():
+            return
+        aliases, implications = rules
+        self.rules_tree.delete(*self.rules_tree.get_children())
+        for alias_name, tag_name in aliases:
+            self.rules_tree.insert("", "end", values=("alias", alias_name, tag_name))
+        for tag_name, implied_name in implications:
+            self.rules_tree.insert("", "end", values=("implies", tag_name, implied_name))
+
+    def rule_names(self):
+        tag_name = self.entry_rule_tag.get().strip()
+        other_name = self.entry_rule_other.get().strip()
+        if not tag_name or not other_name:
+            messagebox.showerror(title="Error", message="Enter both tag names.", parent=self.rules_window)
+            return None
+        return tag_name, other_name
+
+    def insert_tag_alias(self):
+        names = self.rule_names()
+        if names:
+            self.db.submit(add_tag_alias, names[1], names[0], callback=self.on_tag_rules_written,
+                           errback=self.show_tag_rule_error)
+
+    def insert_tag_implication(self):
+        names = self.rule_names()
+        if names:
+            self.db.submit(add_tag_implication, names[0], names[1], callback=self.on_tag_rules_written,
+                           errback=self.show_tag_rule_error)
+
+    def delete_selected_tag_rules(self):
+        for item in self.rules_tree.selection():
+            rule, name, tag_name = self.rules_tree.item(item, "values")
+            if rule == "alias":
+                self.db.submit(remove_tag_alias, name, callback=self.on_tag_rules_written)
+            else:
+                self.db.submit(remove_tag_implication, name, tag_name, callback=self.on_tag_rules_written)
 
-            # Commit the change
-            self.conn.commit()
+    def on_tag_rules_written(self, changes):
+        self.apply_changes(changes)
+        if self.rules_window.winfo_exists():
+            self.db.submit(tag_rules, callback=self.show_tag_rules)
 
-        self.display_data(self.tag_tree, "tags")
+    # Rules that would merge a tag with implications or make a tag imply itself are refused
+    def show_tag_rule_error(self, error):
+        parent = self.rules_window if self.rules_window.winfo_exists() else None
+        messagebox.showerror(title="Error", message=str(error), parent=parent)
 
     # Creates lookup lists for confirming if certain items already exist
-    def init_lookup_lists(self):
-        self.all_creators = [creator[0] for creator in self.cursor.execute("SELECT creator_name from creators")]
-        self.all_tags = [tag[0] for tag in self.cursor.execute("SELECT tag_name from tags")]
+    def init_lookup_lists(self, cursor):
+        self.creator_names = dict(cursor.execute("SELECT creator_id, creator_name from creators"))
+        tag_rows = cursor.execute("SELECT tag_id, tag_name, use_count from tags").fetchall()
+        self.tag_names = {tag_id: tag_name for tag_id, tag_name, _ in tag_rows}
+        self.all_creators = PrefixIndex(self.creator_names.values())
+        # Tag completions offer the most used tags first
+        self.all_tags = PrefixIndex(self.tag_names.values(),
+                                    weights={tag_name: use_count for _, tag_name, use_count in tag_rows})
+
+    # The date picked in the image window; DateEntry shows it in the user's locale
+    def selected_upload_date(self):
+        return self.entry_dateadd.get_date() if self.entry_dateadd.get() else None
 
     # Add Image function (can switch to edit mode)
-    def windowAddImage(self, mode="Add", selection = None):
+    def windowAddImage(self, mode="Add", image_info = None):
         self.image_window = tk.Toplevel(root)
 
         if mode == "Add":
@@ -514,6 +1173,7 @@ class DatabaseApp:
         if mode == "Add":
             row_offset = 1
 
+            self.browse_filepath = ""
             self.browse_label = tk.Label(self.image_window, text="Select File")
             self.browse_button = tk.Button(self.image_window, text="Browse", command=self.browseForImage)
 
@@ -521,7 +1181,7 @@ class DatabaseApp:
             self.entry_filename = tk.Entry(self.image_window)
 
         self.label_creator = tk.Label(self.image_window, text="Creator")
-        self.entry_creator = AutocompleteEntry(self.image_window,
+        self.entry_creator = IndexedAutocompleteEntry(self.image_window,
                                                completevalues=self.all_creators)
 
         self.label_source = tk.Label(self.image_window, text="Source URL")
@@ -535,13 +1195,16 @@ class DatabaseApp:
                                                  completevalues=self.all_tags)
 
         # If editing an existing image, fill in existing information
-        if selection:
-            image_info = self.fetchImage(selection)
+        if image_info:
             self.selected_image_id = image_info[0]
-            self.entry_creator.insert(0, image_info[3])
-            self.entry_source.insert(0, image_info[4])
+            self.entry_creator.insert(0, image_info[3] or "")
+            self.entry_source.insert(0, image_info[4] or "")
             self.entry_dateadd.delete(0, tk.END)
-            self.entry_dateadd.insert(0, image_info[6])
+            if image_info[6]:
+                try:
+                    self.entry_dateadd.set_date(parse_date(image_info[6]))
+                except ValueError:
+                    self.entry_dateadd.insert(0, image_info[6])
             self.entry_image_tags.insert(0, image_info[-1])         
   
         if mode == "Add":
@@ -576,25 +1239,336 @@ class DatabaseApp:
                                                             ("JPEG",
                                                              "*.jpeg")],
                                                parent=self.image_window)
+        self.browse_filepath = filename
         self.browse_label.configure(text="File location: {}".format(filename))
 
-    # Copy file to images directory and return the new path of the file
-    def addToDirectory(self, filepath):
-        filename = os.path.basename(filepath)
-        filename_noext, extension = os.path.splitext(filename)
-        final_destination = os.path.join(self.image_destination, filename)
-        temp_filename = filename
+    # Bulk import window: copies every image below a folder in the background
+    def windowImportFolder(self):
+        self.import_window = tk.Toplevel(root)
+        self.import_window.title("Import Folder")
+        self.import_window.geometry("600x300")
+        self.import_window.attributes('-topmost', True)
+        self.import_folder = ""
+        self.importer = None
+        self.import_window.protocol("WM_DELETE_WINDOW", self.close_import_window)
+
+        self.import_folder_label = tk.Label(self.import_window, text="Select Folder")
+        self.import_folder_button = tk.Button(self.import_window, text="Browse", command=self.browseForFolder)
+
+        self.label_import_creator = tk.Label(self.import_window, text="Creator")
+        self.entry_import_creator = IndexedAutocompleteEntry(self.import_window,
+                                                             completevalues=self.all_creators)
+        self.import_creator_from_folder = tk.BooleanVar(value=False)
+        self.check_import_creator = tk.Checkbutton(self.import_window, text="Use subfolder names as creators",
+                                                   variable=self.import_creator_from_folder)
+
+        self.label_import_tags = tk.Label(self.import_window, text="Tags")
+        self.entry_import_tags = AutocompleteMultiEntry(self.import_window,
+                                                        completevalues=self.all_tags)
+
+        self.import_progressbar = ttk.Progressbar(self.import_window, mode="indeterminate", length=300)
+        self.import_status_label = tk.Label(self.import_window, text="")
+        self.button_start_import = tk.Button(self.import_window, text="Start Import", command=self.start_folder_import)
+        self.button_cancel_import = tk.Button(self.import_window, text="Cancel", command=self.cancel_folder_import,
+                                              state="disabled")
 
-        counter = 1
-        while os.path.exists(final_destination):
-            temp_filename = "{}_{}{}".format(filename_noext, counter, extension)
-            final_destination = os.path.join(self.image_destination, temp_filename)
-            counter += 1
+        # Place on widget
+        self.import_folder_label.grid(row=0, column=0, columnspan=3, padx=10, pady=10)
+        self.import_folder_button.grid(row=0, column=3, padx=10, pady=10)
+        self.label_import_creator.grid(row=1, column=0, padx=10, pady=10)
+        self.entry_import_creator.grid(row=1, column=1, padx=10, pady=10)
+        self.check_import_creator.grid(row=1, column=2, columnspan=2, padx=10, pady=10)
+        self.label_import_tags.grid(row=2, column=0, padx=10, pady=10)
+        self.entry_import_tags.grid(row=2, column=1, padx=10, pady=10)
+        self.import_progressbar.grid(row=3, column=0, columnspan=4, padx=10, pady=10)
+        self.import_status_label.grid(row=4, column=0, columnspan=4, padx=10, pady=5)
+        self.button_start_import.grid(row=5, column=0, padx=10, pady=10)
+        self.button_cancel_import.grid(row=5, column=1, padx=10, pady=10)
+
+    def browseForFolder(self):
+        folder = filedialog.askdirectory(initialdir="/",
+                                         title="Select a Folder",
+                                         parent=self.import_window)
+        self.import_folder = folder
+        self.import_folder_label.configure(text="Folder location: {}".format(folder))
+
+    def start_folder_import(self):
+        creator_name = self.entry_import_creator.get()
+        tags = [s.strip() for s in self.entry_import_tags.get().split(",") if s.strip()]
+
+        if not self.import_folder:
+            messagebox.showerror(title="Error", message="You must select a folder.", parent=self.import_window)
+            return
+        elif not creator_name:
+            messagebox.showerror(title="Error", message="Creator name cannot be empty.", parent=self.import_window)
+            return
+
+        self.importer = BulkImporter(DATABASE_PATH, self.image_destination, self.import_folder,
+                                     creator_name=creator_name, tags=tags,
+                                     creator_from_folder=self.import_creator_from_folder.get(),
+                                     storage_mode=self.storage_mode)
+        self.import_errors = []
+        self.button_start_import.configure(state="disabled")
+        self.button_cancel_import.configure(state="normal")
+        self.import_progressbar.start()
+        self.importer.start()
+        self.root.after(PROGRESS_POLL_MS, self.poll_folder_import)
+
+    # Closing the window cancels a running import; its progress is still applied
+    def close_import_window(self):
+        self.cancel_folder_import()
+        self.import_window.destroy()
+
+    def cancel_folder_import(self):
+        if self.importer:
+            self.importer.cancel()
+            self.import_status_label.configure(text="Cancelling after the current batch...")
+
+    # Drain progress messages from the importer thread without blocking the mainloop
+    def poll_folder_import(self):
+        while True:
+            try:
+                message = self.importer.progress.get_nowait()
+            except queue.Empty:
+                break
+
+            window_open = self.import_window.winfo_exists()
+            if message[0] == "batch":
+                self.apply_changes(message[2])
+                if window_open:
+                    self.import_status_label.configure(text="Imported {} file(s)".format(message[1]))
+            elif message[0] == "error":
+                self.import_errors.append("{}: {}".format(message[1], message[2]))
+            elif message[0] == "done":
+                if window_open:
+                    self.import_progressbar.stop()
+                    self.button_cancel_import.configure(state="disabled")
+                    self.button_start_import.configure(state="normal")
+                    status = "Cancelled" if self.importer.cancelled.is_set() else "Finished"
+                    self.import_status_label.configure(text="{}: imported {} file(s), {} already catalogued, {} error(s)".format(
+                        status, message[1], self.importer.skipped, len(self.import_errors)))
+                if self.import_errors:
+                    messagebox.showerror(title="Error", message="Could not import:\n" + "\n".join(
+                        self.import_errors[:IMPORT_ERRORS_SHOWN]))
+                self.importer = None
+                return
+
+        self.root.after(PROGRESS_POLL_MS, self.poll_folder_import)
+
+    # Image counts per year and month; choosing a period filters the image table to it
+    def windowTimeline(self):
+        self.timeline_window = tk.Toplevel(root)
+        self.timeline_window.title("Timeline")
+        self.timeline_window.geometry("400x400")
+        self.timeline_column = self.date_column.get()
+
+        self.label_timeline = tk.Label(self.timeline_window, text="Images by {}".format(self.timeline_column))
+        self.timeline_tree = ttk.Treeview(self.timeline_window, columns=("images",), height=15)
+        self.timeline_tree.heading("#0", text="Period")
+        self.timeline_tree.heading("images", text="Images")
+        timeline_scrollbar = ttk.Scrollbar(self.timeline_window, orient="vertical", command=self.timeline_tree.yview)
+        self.timeline_tree.configure(yscrollcommand=timeline_scrollbar.set)
+        # Months are fetched when their year is opened
+        self.timeline_tree.bind("<<TreeviewOpen>>", self.open_timeline_year)
+        self.timeline_tree.bind("<Double-1>", self.choose_timeline_period)
+
+        self.label_timeline.grid(row=0, column=0, padx=10, pady=10)
+        self.timeline_tree.grid(row=1, column=0, padx=(10, 0), pady=10)
+        timeline_scrollbar.grid(row=1, column=1, sticky="ns", pady=10)
+
+        self.db.submit(date_timeline, self.timeline_column, PERIOD_YEAR, self.image_source(),
+                       callback=self.show_timeline_years)
+
+    def show_timeline_years(self, periods):
+        if not self.timeline_window.winfo_exists():
+            return
+        for year, count in periods:
+            self.timeline_tree.insert("", "end", iid=year, text=year, values=(count,))
+            # Placeholder child so the year can be opened
+            self.timeline_tree.insert(year, "end", text="...")
+
+    def open_timeline_year(self, event):
+        year = self.timeline_tree.focus()
+        children = self.timeline_tree.get_children(year)
+        if not year.isdigit() or len(children) != 1 or self.timeline_tree.item(children[0], "text") != "...":
+            return
+        self.db.submit(date_timeline, self.timeline_column, PERIOD_MONTH, self.image_source(),
+                       (self.timeline_column,) + day_range(*period_days(year)),
+                       callback=lambda periods: self.show_timeline_months(year, periods))
+
+    def show_timeline_months(self, year, periods):
+        if not self.timeline_window.winfo_exists():
+            return
+        self.timeline_tree.delete(*self.timeline_tree.get_children(year))
+        for month, count in periods:
+            self.timeline_tree.insert(year, "end", iid=month, text=month, values=(count,))
+
+    def choose_timeline_period(self, event):
+        period = self.timeline_tree.focus()
+        # Skips the placeholder rows and dates that were never readable
+        if not period[:PERIOD_YEAR].isdigit():
+            return
+        first, last = period_days(period)
+        self.entry_date_from.delete(0, "end")
+        self.entry_date_from.insert(0, first)
+        self.entry_date_to.delete(0, "end")
+        self.entry_date_to.insert(0, last)
+        self.date_column.set(self.timeline_column)
+        self.filter_dates()
+
+    # Near-duplicate report: hashes any images still missing one, then lists similar pairs
+    def windowDuplicates(self):
+        self.duplicates_window = tk.Toplevel(root)
+        self.duplicates_window.title("Find Duplicates")
+        self.duplicates_window.geometry("600x400")
+
+        self.duplicates_status_label = tk.Label(self.duplicates_window, text="Hashing images...")
+        self.duplicates_tree = ttk.Treeview(self.duplicates_window, columns=("image_a", "image_b", "distance"),
+                                            show="headings")
+        for col, text in (("image_a", "Image"), ("image_b", "Similar Image"), ("distance", "Distance")):
+            self.duplicates_tree.heading(col, text=text)
+        duplicates_scrollbar = ttk.Scrollbar(self.duplicates_window, orient="vertical",
+                                             command=self.duplicates_tree.yview)
+        self.duplicates_tree.configure(yscrollcommand=duplicates_scrollbar.set)
+
+        self.duplicates_status_label.grid(row=0, column=0, padx=10, pady=10)
+        self.duplicates_tree.grid(row=1, column=0, padx=(10, 0), pady=10)
+        duplicates_scrollbar.grid(row=1, column=1, sticky="ns", pady=10)
+
+        self.duplicate_report = DuplicateReport(DATABASE_PATH)
+        self.duplicate_report.start()
+        self.root.after(PROGRESS_POLL_MS, self.poll_duplicate_report)
+
+    def poll_duplicate_report(self):
+        while True:
+            try:
+                message = self.duplicate_report.progress.get_nowait()
+            except queue.Empty:
+                break
+
+            window_open = self.duplicates_window.winfo_exists()
+            if message[0] == "hashed":
+                if window_open:
+                    self.duplicates_status_label.configure(text="Hashed {} image(s)...".format(message[1]))
+            elif message[0] == "error":
+                if window_open:
+                    self.duplicates_status_label.configure(text="Error: {}".format(message[1]))
+                return
+            elif message[0] == "done":
+                # Backfilled hashes are picked up by reloading the index
+                self.db.submit(self.hash_index.build)
+                if window_open:
+                    pairs = sorted(message[1].items(), key=lambda pair: (pair[1], pair[0]))
+                    for (image_a, image_b), distance in pairs:
+                        self.duplicates_tree.insert("", "end", values=(image_a, image_b, distance))
+                    self.duplicates_status_label.configure(text="Found {} similar pair(s)".format(len(pairs)))
+                return
+
+        self.root.after(PROGRESS_POLL_MS, self.poll_duplicate_report)
+
+    def poll_metadata_backfill(self):
+        while True:
+            try:
+                message = self.metadata_backfill.progress.get_nowait()
+            except queue.Empty:
+                break
+
+            if message[0] == "error":
+                messagebox.showerror(title="Error", message="Could not read image metadata: {}".format(message[1]))
+                return
+            elif message[0] == "done":
+                return
 
-        shutil.copy2(filepath, final_destination)
+        self.root.after(PROGRESS_POLL_MS, self.poll_metadata_backfill)
+
+    def poll_trash_collector(self):
+        while True:
+            try:
+                message = self.trash_collector.progress.get_nowait()
+            except queue.Empty:
+                break
+
+            if message[0] == "error":
+                messagebox.showerror(title="Error", message="Could not empty the trash: {}".format(message[1]))
+                return
+            elif message[0] == "done":
+                return
+
+        self.root.after(PROGRESS_POLL_MS, self.poll_trash_collector)
+
+    def windowIntegrity(self):
+        self.integrity_window = tk.Toplevel(root)
+        self.integrity_window.title("Check Files")
+        self.integrity_window.geometry("700x400")
+
+        self.integrity_status_label = tk.Label(self.integrity_window, text="Listing files...")
+        self.integrity_tree = ttk.Treeview(self.integrity_window, columns=("problem", "image_id", "path"),
+                                           show="headings")
+        for col, text in (("problem", "Problem"), ("image_id", "Image"), ("path", "File")):
+            self.integrity_tree.heading(col, text=text)
+        self.integrity_tree.column("path", width=450)
+        integrity_scrollbar = ttk.Scrollbar(self.integrity_window, orient="vertical",
+                                            command=self.integrity_tree.yview)
+        self.integrity_tree.configure(yscrollcommand=integrity_scrollbar.set)
+        self.button_fix_integrity = tk.Button(self.integrity_window, text="Clean Up", state="disabled",
+                                              command=self.fix_integrity_problems)
+
+        self.integrity_status_label.grid(row=0, column=0, padx=10, pady=10)
+        self.integrity_tree.grid(row=1, column=0, padx=(10, 0), pady=10)
+        integrity_scrollbar.grid(row=1, column=1, sticky="ns", pady=10)
+        self.button_fix_integrity.grid(row=2, column=0, pady=10)
+
+        # Files hashed by an earlier check are only read again if they changed
+        self.integrity_scan = IntegrityScan(DATABASE_PATH, self.image_destination, incremental=True)
+        self.integrity_scan.start()
+        self.root.after(PROGRESS_POLL_MS, self.poll_integrity_scan)
+
+    def poll_integrity_scan(self):
+        while True:
+            try:
+                message = self.integrity_scan.progress.get_nowait()
+            except queue.Empty:
+                break
+
+            window_open = self.integrity_window.winfo_exists()
+            if message[0] == "walked":
+                if window_open:
+                    self.integrity_status_label.configure(text="Found {} file(s), checking...".format(message[1]))
+            elif message[0] == "hashed":
+                if window_open:
+                    self.integrity_status_label.configure(text="Hashed {} of {} file(s)...".format(message[1], message[2]))
+            elif message[0] == "error":
+                if window_open:
+                    self.integrity_status_label.configure(text="Error: {}".format(message[1]))
+                return
+            elif message[0] == "done":
+                self.integrity_report = message[1]
+                if window_open:
+                    for kind, image_id, path in self.integrity_report.rows():
+                        self.integrity_tree.insert("", "end", values=(kind, "" if image_id is None else image_id, path))
+                    self.integrity_status_label.configure(text="Checked {} image(s) and {} file(s): {} problem(s)".format(
+                        self.integrity_report.images, self.integrity_report.files, self.integrity_report.problems()))
+                    if self.integrity_report.moved or self.integrity_report.orphans:
+                        self.button_fix_integrity.configure(state="normal")
+                return
+
+        self.root.after(PROGRESS_POLL_MS, self.poll_integrity_scan)
+
+    def fix_integrity_problems(self):
+        report = self.integrity_report
+        fix_confirm = messagebox.askquestion(title="Warning",
+                                             message='''Relink {} moved image(s) and delete orphan files (files no image uses, unchanged for an hour)? Deleted files cannot be recovered.'''.format(len(report.moved)))
+        if fix_confirm == 'yes':
+            self.button_fix_integrity.configure(state="disabled")
+            self.db.submit(fix_problems, report, callback=self.on_integrity_fixed)
+
+    def on_integrity_fixed(self, result):
+        changes, deleted = result
+        self.apply_changes(changes)
+        if self.integrity_window.winfo_exists():
+            self.integrity_status_label.configure(text="Relinked {} image(s), deleted {} file(s)".format(
+                len(changes.images), len(deleted)))
 
-        return final_destination
-    
     def editImageWindow(self):
 
         # Retrieve id of selected image entry/entries
@@ -603,31 +1577,146 @@ class DatabaseApp:
         number_selected = len(selected_image)
 
         if (number_selected > 1):
-            messagebox.showerror(title="Error",
-                                  message="Must select only one image.")
+            self.windowBatchTags([int(image_id) for image_id in selected_image])
         elif (number_selected == 0):
             messagebox.showerror(title="Error",
                                   message="You must select an image entry to edit.")
         else:
-            self.windowAddImage(mode="Edit", selection = selected_image[0])
-
-    def fetchImage(self, image_id):
-        im_info = self.cursor.execute("SELECT * FROM images WHERE image_id = ?", (image_id,)).fetchone()
-        image_info = list(im_info)
-        creator_id = image_info[3]
-        creator_info = self.cursor.execute("SELECT creator_name FROM creators WHERE creator_id = ?", (creator_id,)).fetchone()
-        image_info[3] = creator_info[0]
-        tag_ids = self.cursor.execute("SELECT tag_id FROM image_tags where image_id = ?", (image_id,)).fetchall()
-        tag_string = ''
-        for tag in tag_ids:
-            tag_name = self.cursor.execute("SELECT tag_name FROM tags where tag_id = ?", (tag[0],)).fetchone()
-            tag_string += tag_name[0] + ','
-        if len(tag_string) > 0:
-            tag_string = tag_string[:-1]
-        image_info = image_info + [tag_string]
-        return image_info
+            image_id = int(selected_image[0])
+            image_info = self.image_records.get(image_id)
+            if image_info:
+                self.windowAddImage(mode="Edit", image_info=image_info)
+            else:
+                # The window opens once the image's details arrive from the worker
+                self.db.submit(fetch_image_records, [image_id],
+                               callback=lambda records: self.open_fetched_image(image_id, records))
+
+    def open_fetched_image(self, image_id, records):
+        self.image_records.update(records)
+        if image_id in records:
+            self.windowAddImage(mode="Edit", image_info=records[image_id][0])
+
+    # Add, remove or replace tags (and optionally the creator) on several images at once
+    def windowBatchTags(self, image_ids):
+        self.batch_image_ids = image_ids
+        self.batch_window = tk.Toplevel(root)
+        self.batch_window.title("Edit {} Images".format(len(image_ids)))
+        self.batch_window.geometry("600x250")
+        self.batch_window.attributes('-topmost', True)
+
+        self.batch_mode = tk.StringVar(value="add")
+        self.label_batch_mode = tk.Label(self.batch_window, text="Tags")
+        self.radio_batch_add = tk.Radiobutton(self.batch_window, text="Add", variable=self.batch_mode, value="add")
+        self.radio_batch_remove = tk.Radiobutton(self.batch_window, text="Remove", variable=self.batch_mode,
+                                                 value="remove")
+        self.radio_batch_replace = tk.Radiobutton(self.batch_window, text="Replace", variable=self.batch_mode,
+                                                  value="replace")
+        self.entry_batch_tags = AutocompleteMultiEntry(self.batch_window, completevalues=self.all_tags)
+
+        self.label_batch_creator = tk.Label(self.batch_window, text="Creator")
+        self.entry_batch_creator = IndexedAutocompleteEntry(self.batch_window, completevalues=self.all_creators)
+        self.label_batch_creator_hint = tk.Label(self.batch_window, text="Leave empty to keep each image's creator")
+
+        self.button_batch_apply = tk.Button(self.batch_window, text="Apply", command=self.apply_batch_tags)
+
+        # Place on widget
+        self.label_batch_mode.grid(row=0, column=0, padx=10, pady=10)
+        self.radio_batch_add.grid(row=0, column=1, padx=10, pady=10)
+        self.radio_batch_remove.grid(row=0, column=2, padx=10, pady=10)
+        self.radio_batch_replace.grid(row=0, column=3, padx=10, pady=10)
+        self.entry_batch_tags.grid(row=1, column=1, columnspan=3, padx=10, pady=10)
+        self.label_batch_creator.grid(row=2, column=0, padx=10, pady=10)
+        self.entry_batch_creator.grid(row=2, column=1, columnspan=3, padx=10, pady=10)
+        self.label_batch_creator_hint.grid(row=3, column=1, columnspan=3, padx=10, pady=5)
+        self.button_batch_apply.grid(row=4, column=0, padx=10, pady=10)
+
+    def apply_batch_tags(self):
+        mode = self.batch_mode.get()
+        tags = [s.strip() for s in self.entry_batch_tags.get().split(",") if s.strip()]
+        creator_name = self.entry_batch_creator.get().strip()
+
+        if not tags and mode != "replace" and not creator_name:
+            messagebox.showerror(title="Error", message="Enter tags or a creator to apply.", parent=self.batch_window)
+            return
+        if mode == "replace" and not tags and not messagebox.askyesno(
+                title="Remove All Tags", message="Remove every tag from the selected images?",
+                parent=self.batch_window):
+            return
+
+        # One transaction on the worker; the table is patched from the returned changes, or reloaded after large edits
+        if mode == "add":
+            self.db.submit(tag_images, self.batch_image_ids, tags, (), None, creator_name,
+                           callback=self.apply_bulk_changes)
+        elif mode == "remove":
+            self.db.submit(tag_images, self.batch_image_ids, (), tags, None, creator_name,
+                           callback=self.apply_bulk_changes)
+        else:
+            self.db.submit(tag_images, self.batch_image_ids, (), (), tags, creator_name,
+                           callback=self.apply_bulk_changes)
+        self.batch_window.destroy()
+
+    # Timings collected by diagnostics.py; the tab only exists when they are enabled
+    def init_diagnostics_tab(self):
+        self.diagnostics_headers = ("name", "count", "mean_ms", "p50_ms", "p95_ms", "max_ms", "total_ms")
+        self.label_operations = tk.Label(self.tab_diagnostics, text="Operations")
+        self.operation_tree = ttk.Treeview(self.tab_diagnostics, columns=self.diagnostics_headers,
+                                           show="headings", height=8)
+        self.label_statements = tk.Label(self.tab_diagnostics, text="SQL statements (slowest total first)")
+        self.statement_tree = ttk.Treeview(self.tab_diagnostics, columns=self.diagnostics_headers,
+                                           show="headings", height=8)
+        for tree in (self.operation_tree, self.statement_tree):
+            for col in self.diagnostics_headers:
+                tree.heading(col, text=col)
+                tree.column(col, width=400 if col == "name" else 70)
+        self.label_stalls = tk.Label(self.tab_diagnostics, text="", justify="left", anchor="w")
+
+        self.button_refresh_diagnostics = tk.Button(self.tab_diagnostics, text="Refresh", command=self.refresh_diagnostics)
+        self.button_save_diagnostics = tk.Button(self.tab_diagnostics, text="Save JSON", command=self.save_diagnostics)
+        self.button_reset_diagnostics = tk.Button(self.tab_diagnostics, text="Reset", command=self.reset_diagnostics)
+
+        # Place on widget
+        self.label_operations.grid(row=0, column=0, columnspan=3, padx=10, pady=5)
+        self.operation_tree.grid(row=1, column=0, columnspan=3, padx=10, pady=5)
+        self.label_statements.grid(row=2, column=0, columnspan=3, padx=10, pady=5)
+        self.statement_tree.grid(row=3, column=0, columnspan=3, padx=10, pady=5)
+        self.label_stalls.grid(row=4, column=0, columnspan=3, padx=10, pady=5)
+        self.button_refresh_diagnostics.grid(row=5, column=0, padx=10, pady=10)
+        self.button_save_diagnostics.grid(row=5, column=1, padx=10, pady=10)
+        self.button_reset_diagnostics.grid(row=5, column=2, padx=10, pady=10)
+
+    def refresh_diagnostics(self):
+        snapshot = self.diagnostics.snapshot()
+        for tree, histograms in ((self.operation_tree, snapshot["operations"]),
+                                 (self.statement_tree, snapshot["statements"])):
+            tree.delete(*tree.get_children())
+            for name, summary in histograms.items():
+                tree.insert("", "end", values=(name,) + tuple(summary[col] for col in self.diagnostics_headers[1:]))
+
+        stalls = snapshot["stalls"]
+        if stalls:
+            last = stalls[-1]
+            # Innermost frame of the stack the mainloop was blocked in
+            where = last["stack"].strip().splitlines()[-2:] if last["stack"] else []
+            self.label_stalls.configure(text="{} mainloop stall(s); last {:.0f} ms\n{}".format(
+                len(stalls), last["ms"], "\n".join(line.strip() for line in where)))
+        else:
+            self.label_stalls.configure(text="No mainloop stalls")
+
+    def save_diagnostics(self):
+        path = filedialog.asksaveasfilename(title="Save Diagnostics", defaultextension=".json",
+                                            initialfile="diagnostics.json", filetypes=(("JSON", "*.json"),))
+        if path:
+            self.diagnostics.dump(path)
+
+    def reset_diagnostics(self):
+        self.diagnostics.reset()
+        self.refresh_diagnostics()
 
 if __name__ == "__main__":
     root = tk.Tk()
     app = DatabaseApp(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    app.metadata_backfill.cancel()
+    app.db.shutdown()
+    app.thumbnail_cache.shutdown()
+    app.preview_loader.shutdown()
\ No newline at end of file
@@ -0,0 +1,144 @@
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from PIL import Image
+
+from dates import LOCAL_TIMESTAMP_FORMAT
+from repository import METADATA_COLUMNS, metadata_values, open_connection
+
+# Dimensions, format and EXIF details of stored images.
+#
+# Pillow reads these from the file header when it opens an image, without decoding the
+# pixels, so a file costs a few small reads. Bulk work spreads the files over worker
+# processes, since parsing headers and EXIF is Python code holding the GIL.
+
+# Worker processes reading headers (None uses one per CPU)
+METADATA_WORKERS = None
+# The pools are started from the importer's and the backfill's own threads, where a fork
+# could inherit locks other threads hold, so workers start from a fresh interpreter instead
+METADATA_START_METHOD = "spawn"
+# Files handed to a worker process at a time
+METADATA_CHUNK_SIZE = 16
+# Images read per transaction when filling in metadata
+BACKFILL_BATCH_SIZE = 500
+# Stored as image_format for files Pillow can't identify, so they are not read again
+UNKNOWN_FORMAT = ""
+
+# EXIF tags: the IFD holding the camera's own fields, and the fields read
+EXIF_IFD = 0x8769
+EXIF_DATE_TIME_ORIGINAL = 0x9003
+EXIF_DATE_TIME = 0x0132
+EXIF_MODEL = 0x0110
+EXIF_ORIENTATION = 0x0112
+# Orientations that turn the image a quarter, swapping its displayed width and height
+ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+EXIF_DATE_FORMAT = "%Y:%m:%d %H:%M:%S"
+
+# Metadata of one file as a dict of METADATA_COLUMNS. Raises OSError if the file can't be read;
+# files that aren't images Pillow knows get UNKNOWN_FORMAT and no dimensions.
+def read_metadata(path):
+    try:
+        image = Image.open(path)
+    except Image.UnidentifiedImageError:
+        return dict(dict.fromkeys(METADATA_COLUMNS), image_format=UNKNOWN_FORMAT)
+    with image:
+        width, height = image.size
+        exif = image.getexif()
+        image_format = image.format
+
+    # Width and height as the image is shown, after the camera's rotation
+    if exif.get(EXIF_ORIENTATION) in ROTATED_ORIENTATIONS:
+        width, height = height, width
+    taken = exif.get_ifd(EXIF_IFD).get(EXIF_DATE_TIME_ORIGINAL) or exif.get(EXIF_DATE_TIME)
+    model = exif.get(EXIF_MODEL)
+    if isinstance(model, str):
+        model = model.strip("\0 ") or None
+    return {
+        "width": width,
+        "height": height,
+        "image_format": image_format,
+        "date_taken": exif_timestamp(taken),
+        "camera_model": model if isinstance(model, str) else None,
+    }
+
+# Camera clocks have no time zone, so the time is kept as the camera recorded it
+def exif_timestamp(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.strptime(value.strip("\0 "), EXIF_DATE_FORMAT).strftime(LOCAL_TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+
+# read_metadata for a worker process: None when the file can't be read, leaving it for a later try
+def try_read_metadata(path):
+    try:
+        return read_metadata(path)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        return None
+
+def metadata_pool():
+    return ProcessPoolExecutor(max_workers=METADATA_WORKERS, mp_context=multiprocessing.get_context(METADATA_START_METHOD))
+
+# Metadata of many files, in order, read on a process pool
+def read_metadata_many(pool, paths):
+    return list(pool.map(try_read_metadata, paths, chunksize=METADATA_CHUNK_SIZE))
+
+# Fills in metadata of images catalogued before it was recorded, on a background thread.
+# Each batch is committed, so a cancelled or interrupted run continues where it stopped.
+class MetadataBackfill:
+    def __init__(self, database_path):
+        self.database_path = database_path
+        # Messages for the UI thread: ("read", count), ("done", count) or ("error", message)
+        self.progress = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        conn = open_connection(self.database_path)
+        try:
+            self.progress.put(("done", self.backfill(conn)))
+        except Exception as error:
+            conn.rollback()
+            self.progress.put(("error", str(error)))
+        finally:
+            conn.close()
+
+    def backfill(self, conn):
+        cursor = conn.cursor()
+        read = 0
+        last_id = 0
+        pool = None
+        try:
+            while not self.cancelled.is_set():
+                rows = cursor.execute('''SELECT image_id, directory_path FROM images
+                                         WHERE image_format IS NULL AND image_id > ? ORDER BY image_id LIMIT ?''',
+                                      (last_id, BACKFILL_BATCH_SIZE)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                # Worker processes are only started once there is something to read
+                if pool is None:
+                    pool = metadata_pool()
+                results = read_metadata_many(pool, [directory_path for _, directory_path in rows])
+                # Files that can't be read now stay unfilled
+                cursor.executemany("UPDATE images SET {} WHERE image_id = ?".format(
+                    ", ".join("{} = ?".format(column) for column in METADATA_COLUMNS)),
+                    [metadata_values(metadata) + (image_id,)
+                     for (image_id, _), metadata in zip(rows, results) if metadata is not None])
+                conn.commit()
+                read += sum(metadata is not None for metadata in results)
+                self.progress.put(("read", read))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return read
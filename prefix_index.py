@@ -0,0 +1,101 @@
+import bisect
+import heapq
+
+# Tag and creator name lookups behind the autocomplete entries in helpers.py, kept free of
+# Tk so the benchmarks and tests can use them without a display.
+
+# Maximum number of completions kept for cycling with the arrow keys
+AUTOCOMPLETE_MAX_HITS = 200
+
+# Sorts after every character, closing the range of names that start with a prefix
+PREFIX_END = "\U0010ffff"
+
+# Sorted, case-folded name index for O(log n + k) prefix lookups.
+# Given weights (e.g. tag use counts), matches come back heaviest first instead of alphabetically.
+# A second list keeps every name in that order, so a limited lookup for a common prefix (or none,
+# right after a comma) stops after the first limit matches instead of ranking every name.
+class PrefixIndex:
+    def __init__(self, names=(), weights=None):
+        self._counts = {}
+        for name in names:
+            self._counts[name] = self._counts.get(name, 0) + 1
+        self._entries = sorted((name.casefold(), name) for name in self._counts)
+        self.ranked = weights is not None
+        self._weights = dict(weights or {})
+        # (-weight, folded name, name): heaviest first, ties alphabetical like _entries
+        self._ranked = sorted(self._rank_key(name) for name in self._counts) if self.ranked else []
+
+    def _rank_key(self, name):
+        return (-self._weights.get(name, 0), name.casefold(), name)
+
+    def set_weight(self, name, weight):
+        if self.ranked and name in self._counts:
+            del self._ranked[bisect.bisect_left(self._ranked, self._rank_key(name))]
+            self._weights[name] = weight
+            bisect.insort(self._ranked, self._rank_key(name))
+        else:
+            self._weights[name] = weight
+
+    def add(self, name):
+        # Names can be added repeatedly (e.g. duplicate rows); the entry is kept once
+        if name in self._counts:
+            self._counts[name] += 1
+        else:
+            self._counts[name] = 1
+            bisect.insort(self._entries, (name.casefold(), name))
+            if self.ranked:
+                bisect.insort(self._ranked, self._rank_key(name))
+
+    def discard(self, name):
+        if name not in self._counts:
+            return
+        self._counts[name] -= 1
+        if self._counts[name] == 0:
+            del self._counts[name]
+            if self.ranked:
+                del self._ranked[bisect.bisect_left(self._ranked, self._rank_key(name))]
+            self._weights.pop(name, None)
+            entry = (name.casefold(), name)
+            del self._entries[bisect.bisect_left(self._entries, entry)]
+
+    def matches(self, prefix, exclude=(), limit=None):
+        # Binary search to the first candidate, then walk forward while the prefix matches
+        folded = prefix.casefold()
+        start = bisect.bisect_left(self._entries, (folded,))
+        if self.ranked:
+            end = bisect.bisect_left(self._entries, (folded + PREFIX_END,), start)
+            # Ranking the names with the prefix costs about (end - start); walking the names
+            # heaviest first until limit of them match costs about limit * n / (end - start).
+            # Few names share a long prefix and many share a short one, so take the cheaper.
+            if limit is None or (end - start) ** 2 <= limit * len(self._entries):
+                candidates = [name for _, name in self._entries[start:end] if name not in exclude]
+                weight = lambda name: -self._weights.get(name, 0)
+                return heapq.nsmallest(limit, candidates, weight) if limit is not None else sorted(candidates, key=weight)
+            hits = []
+            for index in range(len(self._ranked)):
+                _, folded_name, name = self._ranked[index]
+                if folded_name.startswith(folded) and name not in exclude:
+                    hits.append(name)
+                    if len(hits) >= limit:
+                        break
+            return hits
+
+        hits = []
+        for index in range(start, len(self._entries)):
+            folded_name, name = self._entries[index]
+            if not folded_name.startswith(folded):
+                break
+            if name not in exclude:
+                hits.append(name)
+                if limit is not None and len(hits) >= limit:
+                    break
+        return hits
+
+    def __contains__(self, name):
+        return name in self._counts
+
+    def __iter__(self):
+        return (name for _, name in self._entries)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps, ImageTk
+
+from thumbnails import thumbnail_key
+
+# Bounding box of the preview shown next to the image table
+PREVIEW_SIZE = (320, 320)
+# Threads decoding previews; Pillow lets go of the GIL while it decodes
+PREVIEW_WORKERS = 2
+# Rows above and below the selected one decoded ahead, so arrowing through the table finds them ready
+PREVIEW_NEIGHBORS = 2
+# Decoded previews kept in memory (at most PREVIEW_SIZE each)
+PREVIEW_MEMORY_ITEMS = 24
+# Milliseconds between checks for finished decodes
+PREVIEW_POLL_MS = 20
+
+# Decode a reduced copy of an image; runs on a worker thread
+def decode_preview(path, size=PREVIEW_SIZE):
+    with Image.open(path) as image:
+        # JPEGs decode straight to 1/2, 1/4 or 1/8 scale, the smallest still covering size
+        image.draft("RGB", size)
+        image = ImageOps.exif_transpose(image)
+    image.thumbnail(size)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    return image
+
+# Previews for the Tk UI, decoded off the Tk thread. Only the latest request is shown.
+# Decodes wait in a queue of our own, the selected image first, and are handed to the
+# workers one per free thread; each request replaces the queue, so images that are no
+# longer selected or next to the selection are dropped, and decodes already running
+# finish into the cache without being shown.
+class PreviewLoader:
+    def __init__(self, root, size=PREVIEW_SIZE, memory_items=PREVIEW_MEMORY_ITEMS):
+        self.root = root
+        self.size = size
+        self.memory_items = memory_items
+
+        self.images = OrderedDict()   # key -> decoded PIL image, least recently used first
+        self.queued = OrderedDict()   # key -> path waiting for a worker, next first
+        self.pending = {}             # key -> future of a running decode
+        self.wanted = None            # (key, callback) of the preview waiting to be shown
+        self.pool = None
+        self.polling = False
+
+    def key(self, path):
+        try:
+            return thumbnail_key(path, self.size)
+        except OSError:
+            return None
+
+    # Call callback(photo) with the preview of path, photo None if it can't be read,
+    # and decode the neighbor paths ahead of time
+    def show(self, path, callback, neighbors=()):
+        key = self.key(path)
+        self.queued.clear()
+        self.wanted = None
+        if key is None:
+            callback(None)
+        elif key in self.images:
+            self.images.move_to_end(key)
+            callback(ImageTk.PhotoImage(self.images[key]))
+        else:
+            self.wanted = (key, callback)
+            self.queued[key] = path
+
+        for neighbor in neighbors:
+            neighbor_key = self.key(neighbor)
+            if neighbor_key is not None and neighbor_key not in self.images:
+                self.queued.setdefault(neighbor_key, neighbor)
+        self.dispatch()
+        if self.pending and not self.polling:
+            self.polling = True
+            self.root.after(PREVIEW_POLL_MS, self.poll)
+
+    # Hand queued decodes to free workers
+    def dispatch(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS)
+        while self.queued and len(self.pending) < PREVIEW_WORKERS:
+            key, path = self.queued.popitem(last=False)
+            if key not in self.pending:
+                self.pending[key] = self.pool.submit(decode_preview, path, self.size)
+
+    # Store finished decodes and show the wanted one, on the Tk thread
+    def poll(self):
+        for key, future in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[key]
+            image = None
+            if future.exception() is None:
+                image = future.result()
+                self.images[key] = image
+                while len(self.images) > self.memory_items:
+                    self.images.popitem(last=False)
+            if self.wanted and self.wanted[0] == key:
+                callback = self.wanted[1]
+                self.wanted = None
+                callback(ImageTk.PhotoImage(image) if image is not None else None)
+
+        self.dispatch()
+        self.polling = bool(self.pending)
+        if self.polling:
+            self.root.after(PREVIEW_POLL_MS, self.poll)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,740 @@
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+
+from dates import TIMESTAMP_FORMAT, normalize_date, normalize_timestamp
+from schema import migrate, restore_fts_triggers, suspend_fts_triggers
+from storage import STORAGE_FLAT, store_file, stored_size
+
+# Catalog data access without any GUI dependencies.
+#
+# Functions take a cursor and leave committing to the caller, so the same code runs on the
+# GUI's database worker, from the command line or inside a larger transaction. Writes
+# return a ChangeSet naming the rows they touched.
+
+# Location of the catalog database
+DATABASE_PATH = 'image_database.db'
+# Folder images are copied into
+IMAGE_DESTINATION = "images"
+# Largest number of names or ids used in a single IN (...) query
+NAME_LOOKUP_CHUNK = 500
+# Number of image records kept by an ImageRecordCache
+IMAGE_RECORD_CACHE_ITEMS = 1000
+
+# Sort expressions for the image table columns (tags are not sortable)
+IMAGE_SORT_COLUMNS = {"image_id": "i.image_id",
+                      "filename": "i.filename",
+                      "creator": "COALESCE(c.creator_name, '')",
+                      "source_url": "COALESCE(i.source_url, '')",
+                      "date_added": "COALESCE(i.date_added, '')",
+                      "date_uploaded": "COALESCE(i.date_uploaded, '')",
+                      # Search result order, only available while a search is active
+                      "rank": "f.position"}
+# Columns shown in the image table followed by the sort key of the row
+IMAGE_ROW_SELECT = '''SELECT i.image_id, i.filename,
+                      c.creator_name, i.source_url,
+                      (SELECT GROUP_CONCAT(t.tag_name)
+                       FROM image_tags AS it
+                       JOIN tags AS t ON it.tag_id = t.tag_id
+                       WHERE it.image_id = i.image_id) AS tags,
+                      i.date_added, i.date_uploaded,
+                      {} AS sort_key
+                      FROM {}
+                      LEFT JOIN creators as c
+                      ON i.creator_id = c.creator_id
+                      '''
+# Image rows come from every image, or only those in the results of the current search
+IMAGE_SOURCE = "images as i"
+IMAGE_FILTER_SOURCE = "temp.image_filter AS f JOIN images AS i ON i.image_id = f.image_id"
+# Seconds a connection waits for another instance's write lock before failing with "database is locked"
+BUSY_TIMEOUT_SECONDS = 30
+# Write-ahead logging lets instances keep reading while one writes. It relies on shared memory,
+# so every instance must run on the machine holding the catalog; on a network share use "DELETE".
+JOURNAL_MODE = "WAL"
+# Page cache of each connection, in KiB
+CACHE_SIZE_KIB = 16384
+# More changes than this from other instances reload the views instead of patching each row
+CHANGE_RELOAD_THRESHOLD = 2000
+# Rows of change_log kept when it is pruned; instances further behind than this reload
+CHANGE_LOG_KEEP_ROWS = 100000
+# Rows logged beyond CHANGE_LOG_KEEP_ROWS before pruning, so the delete runs now and then
+CHANGE_LOG_PRUNE_SLACK = 20000
+# Tags no image uses and no alias or implication refers to
+UNUSED_TAGS = '''SELECT tag_id FROM tags WHERE use_count = 0
+                 AND tag_id NOT IN (SELECT tag_id FROM tag_aliases)
+                 AND tag_id NOT IN (SELECT tag_id FROM tag_implications)
+                 AND tag_id NOT IN (SELECT implied_tag_id FROM tag_implications)'''
+# Returned by ChangeFeed.poll when the changes are better shown by reloading everything
+CHANGES_RELOAD = "reload"
+# Columns read from an image file's header by metadata.py; file_size is recorded when the file is stored
+METADATA_COLUMNS = ("width", "height", "image_format", "date_taken", "camera_model")
+# Columns images can be filtered and grouped by date on, as (column, lower, upper) date ranges
+DATE_COLUMNS = ("date_added", "date_uploaded")
+
+# Collects the ids touched by a database operation so views can patch just those rows
+class ChangeSet:
+    def __init__(self, images=(), tags=(), creators=(), tag_counts=(), tag_rules=(), trash_batch=None):
+        self.images = set(images)
+        self.tags = set(tags)
+        self.creators = set(creators)
+        # Tags whose use_count changed because images were linked to or unlinked from them
+        self.tag_counts = set(tag_counts)
+        # Tags whose aliases or implications changed
+        self.tag_rules = set(tag_rules)
+        # Trash batch the deleted images went to, for undoing the delete
+        self.trash_batch = trash_batch
+
+    def update(self, other):
+        self.images |= other.images
+        self.tags |= other.tags
+        self.creators |= other.creators
+        self.tag_counts |= other.tag_counts
+        self.tag_rules |= other.tag_rules
+        self.trash_batch = other.trash_batch or self.trash_batch
+        return self
+
+    def __bool__(self):
+        return bool(self.images or self.tags or self.creators or self.tag_rules)
+
+# Follows the change_log written by triggers, so changes committed by other instances (or
+# background jobs) can be patched into this one's views. PRAGMA data_version only moves when
+# another connection commits, so an idle catalog costs one small query per poll.
+class ChangeFeed:
+    def __init__(self, reload_threshold=CHANGE_RELOAD_THRESHOLD):
+        self.reload_threshold = reload_threshold
+        self.last_seen = 0
+        self.data_version = None
+
+    # Start following from the current state, which the views already show
+    def start(self, cursor):
+        self.last_seen, _, self.data_version = self.position(cursor)
+
+    # Newest and oldest logged change, and the data version, read in one statement so they agree
+    @staticmethod
+    def position(cursor):
+        return cursor.execute('''SELECT COALESCE((SELECT MAX(change_id) FROM change_log), 0),
+                                        COALESCE((SELECT MIN(change_id) FROM change_log), 0),
+                                        (SELECT data_version FROM pragma_data_version)''').fetchone()
+
+    # Changes committed since the last poll: None if there are none, CHANGES_RELOAD if there
+    # are too many or some were pruned before being seen, otherwise a ChangeSet. It includes
+    # this connection's own changes when others wrote too; patching those again is harmless.
+    def poll(self, cursor):
+        # Long-running instances keep the log from growing, whoever wrote to it
+        prune_change_log(cursor)
+        last_change, first_change, data_version = self.position(cursor)
+        last_seen, self.last_seen = self.last_seen, last_change
+        if data_version == self.data_version or last_change == last_seen:
+            # Nothing, or only changes made through this connection and already shown
+            self.data_version = data_version
+            return None
+        self.data_version = data_version
+        if last_change - last_seen > self.reload_threshold or first_change > last_seen + 1:
+            return CHANGES_RELOAD
+
+        changes = ChangeSet()
+        for kind, row_id in cursor.execute("SELECT kind, row_id FROM change_log WHERE change_id > ? AND change_id <= ?",
+                                           (last_seen, last_change)):
+            getattr(changes, kind).add(row_id)
+        return changes
+
+# Forget all but the newest changes once the log is CHANGE_LOG_PRUNE_SLACK rows past keep;
+# instances that fell further behind reload. Only reads two ends of the key otherwise.
+def prune_change_log(cursor, keep=CHANGE_LOG_KEEP_ROWS):
+    last_change, first_change, _ = ChangeFeed.position(cursor)
+    if last_change - first_change >= keep + CHANGE_LOG_PRUNE_SLACK:
+        cursor.execute("DELETE FROM change_log WHERE change_id <= ?", (last_change - keep,))
+
+# Values of METADATA_COLUMNS from a dict returned by metadata.read_metadata, all None without one
+def metadata_values(metadata):
+    return tuple((metadata or {}).get(column) for column in METADATA_COLUMNS)
+
+# Open a connection set up for several instances sharing one catalog
+def open_connection(database_path=DATABASE_PATH):
+    conn = sqlite3.connect(database_path, timeout=BUSY_TIMEOUT_SECONDS)
+    try:
+        journal_mode = conn.execute("PRAGMA journal_mode = {}".format(JOURNAL_MODE)).fetchone()[0]
+    except sqlite3.OperationalError:
+        # Switching needs the catalog to itself; the mode is stored in the file, so whichever
+        # connection manages it first switches every later one too
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    # In WAL mode a crash can lose the last commits but can't corrupt the file, so syncing at checkpoints is enough
+    if journal_mode.lower() == "wal":
+        conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA cache_size = -{}".format(CACHE_SIZE_KIB))
+    # Search results and sorts go to temp tables; keep them off the disk
+    conn.execute("PRAGMA temp_store = MEMORY")
+    # Deleting an image or tag takes its links with it, and deleting a creator still used by images fails
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+# Open a catalog, creating or upgrading its tables
+def connect(database_path=DATABASE_PATH, report=print):
+    conn = open_connection(database_path)
+    create_tables(conn, report)
+    # Command-line runs never poll a ChangeFeed, so the log is also pruned here
+    prune_change_log(conn.cursor())
+    conn.commit()
+    return conn
+
+# Create the tables, or upgrade an existing database to the current schema
+def create_tables(conn, report=print):
+    return migrate(conn, report)
+
+# Resolve names to ids for a lookup table, inserting the missing names in one statement
+def resolve_names(cursor, table, id_column, name_column, names, cache, changes_ids):
+    missing = list({name for name in names if name not in cache})
+
+    def lookup(chunk):
+        cursor.execute("SELECT {}, {} FROM {} WHERE {} IN ({})".format(
+            name_column, id_column, table, name_column, ",".join("?" * len(chunk))), chunk)
+        cache.update(cursor.fetchall())
+
+    for start in range(0, len(missing), NAME_LOOKUP_CHUNK):
+        lookup(missing[start:start + NAME_LOOKUP_CHUNK])
+
+    new_names = [name for name in missing if name not in cache]
+    if new_names:
+        cursor.executemany("INSERT INTO {} ({}) VALUES (?)".format(table, name_column),
+                           [(name,) for name in new_names])
+        for start in range(0, len(new_names), NAME_LOOKUP_CHUNK):
+            lookup(new_names[start:start + NAME_LOOKUP_CHUNK])
+        changes_ids.update(cache[name] for name in new_names)
+
+    return [cache[name] for name in names]
+
+# Look up a creator id by name, adding the creator if it doesn't exist yet
+def resolve_creator(cursor, creator_name, changes):
+    cursor.execute("SELECT creator_id FROM creators WHERE creator_name = ?", (creator_name,))
+    id_result = cursor.fetchone()
+    if id_result:
+        return id_result[0]
+
+    cursor.execute("INSERT INTO creators (creator_name) VALUES (?)", (creator_name,))
+    changes.creators.add(cursor.lastrowid)
+    return cursor.lastrowid
+
+# Tag names with aliases replaced by the name of their tag, in order and without repeats
+def resolve_aliases(cursor, tag_names):
+    tag_names = list(tag_names)
+    aliases = {}
+    for start in range(0, len(tag_names), NAME_LOOKUP_CHUNK):
+        chunk = tag_names[start:start + NAME_LOOKUP_CHUNK]
+        cursor.execute('''SELECT a.alias_name, t.tag_name FROM tag_aliases AS a JOIN tags AS t ON a.tag_id = t.tag_id
+                          WHERE a.alias_name IN ({})'''.format(",".join("?" * len(chunk))), chunk)
+        aliases.update(cursor.fetchall())
+    return list(dict.fromkeys(aliases.get(name, name) for name in tag_names))
+
+# Look up tag ids by name, adding the tags that don't exist yet
+def resolve_tags(cursor, tag_names, changes):
+    return resolve_names(cursor, "tags", "tag_id", "tag_name", resolve_aliases(cursor, tag_names), {}, changes.tags)
+
+# Copy a file into the image folder.
+# Returns (path, content hash, whether a new file was written, id of an image with the same content or None)
+def store_image(cursor, filepath, directory=IMAGE_DESTINATION, storage_mode=STORAGE_FLAT):
+    destination_path, content_hash, is_new = store_file(filepath, directory, storage_mode)
+    cursor.execute("SELECT image_id FROM images WHERE content_hash = ?", (content_hash,))
+    duplicate = cursor.fetchone()
+    return destination_path, content_hash, is_new, duplicate[0] if duplicate else None
+
+# Undo store_image for a file that won't be catalogued after all
+def remove_stored(path, is_new):
+    # An existing file shared by identical content stays
+    if is_new:
+        os.remove(path)
+
+def add_image(cursor, path, creator_name, source_url="", tags=(), date_added=None, date_uploaded="",
+              content_hash=None, phash=None, metadata=None):
+    changes = ChangeSet()
+    creator_id = resolve_creator(cursor, creator_name, changes)
+    cursor.execute("INSERT INTO images (filename, creator_id, source_url, directory_path, date_added, date_uploaded, content_hash, phash, file_size, {}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, {})".format(
+                       ", ".join(METADATA_COLUMNS), ", ".join("?" * len(METADATA_COLUMNS))),
+                   (os.path.basename(path), creator_id, source_url, path, normalize_timestamp(date_added),
+                    normalize_date(date_uploaded), content_hash, phash, stored_size(path)) + metadata_values(metadata))
+    image_id = cursor.lastrowid
+    changes.images.add(image_id)
+
+    # Link each tag to the new image, creating tags that don't exist yet
+    tag_ids = set(resolve_tags(cursor, tags, changes))
+    cursor.executemany("INSERT INTO image_tags (image_id, tag_id) VALUES (?, ?)",
+                       [(image_id, tag_id) for tag_id in tag_ids])
+    changes.tag_counts.update(tag_ids)
+    return changes
+
+# Replace an image's details and tags
+def edit_image(cursor, image_id, creator_name, source_url, tags, date_added, date_uploaded):
+    changes = ChangeSet(images=[image_id])
+    creator_id = resolve_creator(cursor, creator_name, changes)
+    cursor.execute("UPDATE images SET creator_id = ?, source_url = ?, date_added = ?, date_uploaded = ? WHERE image_id = ?",
+                   (creator_id, source_url, normalize_timestamp(date_added), normalize_date(date_uploaded), image_id))
+
+    # Only the tags that changed are written
+    new_tags = set(resolve_tags(cursor, tags, changes))
+    cursor.execute("SELECT tag_id FROM image_tags WHERE image_id = ?", (image_id,))
+    existing_tags = {row[0] for row in cursor.fetchall()}
+    cursor.executemany("DELETE FROM image_tags WHERE image_id = ? AND tag_id = ?",
+                       [(image_id, tag_id) for tag_id in existing_tags - new_tags])
+    cursor.executemany("INSERT INTO image_tags (image_id, tag_id) VALUES (?, ?)",
+                       [(image_id, tag_id) for tag_id in new_tags - existing_tags])
+    changes.tag_counts.update(new_tags ^ existing_tags)
+    return changes
+
+# Ids of the tags with these names; names without a tag are left out
+def lookup_tag_ids(cursor, tag_names):
+    tag_names = resolve_aliases(cursor, tag_names)
+    tag_ids = set()
+    for start in range(0, len(tag_names), NAME_LOOKUP_CHUNK):
+        chunk = tag_names[start:start + NAME_LOOKUP_CHUNK]
+        cursor.execute("SELECT tag_id FROM tags WHERE tag_name IN ({})".format(",".join("?" * len(chunk))), chunk)
+        tag_ids.update(row[0] for row in cursor.fetchall())
+    return tag_ids
+
+# Add and remove tags on many images at once, or replace their tags with exactly the
+# tags in replace, and optionally give them all one creator. Only links that actually
+# change are written, with one executemany each.
+def tag_images(cursor, image_ids, add=(), remove=(), replace=None, creator_name=None):
+    image_ids = list(image_ids)
+    changes = ChangeSet(images=image_ids)
+    suspend_fts_triggers(cursor)
+
+    if creator_name:
+        creator_id = resolve_creator(cursor, creator_name, changes)
+        cursor.executemany("UPDATE images SET creator_id = ? WHERE image_id = ? AND creator_id IS NOT ?",
+                           [(creator_id, image_id, creator_id) for image_id in image_ids])
+
+    # Current (image_id, tag_id) links of the images
+    existing = set()
+    for start in range(0, len(image_ids), NAME_LOOKUP_CHUNK):
+        chunk = image_ids[start:start + NAME_LOOKUP_CHUNK]
+        cursor.execute("SELECT image_id, tag_id FROM image_tags WHERE image_id IN ({})".format(
+            ",".join("?" * len(chunk))), chunk)
+        existing.update(cursor.fetchall())
+
+    if replace is not None:
+        wanted_ids = set(resolve_tags(cursor, replace, changes))
+        wanted = {(image_id, tag_id) for image_id in image_ids for tag_id in wanted_ids}
+    else:
+        add_ids = set(resolve_tags(cursor, add, changes))
+        remove_ids = lookup_tag_ids(cursor, remove) - add_ids
+        wanted = {link for link in existing if link[1] not in remove_ids}
+        wanted.update((image_id, tag_id) for image_id in image_ids for tag_id in add_ids)
+
+    cursor.executemany("DELETE FROM image_tags WHERE image_id = ? AND tag_id = ?", existing - wanted)
+    cursor.executemany("INSERT INTO image_tags (image_id, tag_id) VALUES (?, ?)", wanted - existing)
+    changes.tag_counts.update(tag_id for _, tag_id in existing ^ wanted)
+    restore_fts_triggers(cursor, image_ids, changes.tag_counts)
+    return changes
+
+# Move images to the trash as one batch, which restore_trash can bring back until trash.py
+# reclaims it. Their links go with them through the foreign keys; their files stay where they
+# are until then, recorded in trash_files unless another image still uses them.
+def delete_images(cursor, image_ids):
+    image_ids = json.dumps(list(image_ids))
+    # Their tags lose a use each
+    changes = ChangeSet(tag_counts=[row[0] for row in cursor.execute(
+        "SELECT DISTINCT tag_id FROM image_tags WHERE image_id IN (SELECT value FROM json_each(?))", (image_ids,))])
+    changes.images.update(row[0] for row in cursor.execute(
+        "SELECT image_id FROM images WHERE image_id IN (SELECT value FROM json_each(?))", (image_ids,)))
+    if not changes.images:
+        return changes
+
+    cursor.execute("INSERT INTO trash_batches (deleted_at) VALUES (strftime(?, 'now'))", (TIMESTAMP_FORMAT,))
+    changes.trash_batch = cursor.lastrowid
+    # Each image's row, with its creator and tags by name since they may be gone by the time it is restored
+    columns = [column[1] for column in cursor.execute("PRAGMA table_info(images)")]
+    cursor.execute('''INSERT INTO trash_images (image_id, batch_id, record)
+                      SELECT i.image_id, ?, json_object('image', json_object({}), 'creator_name', c.creator_name,
+                                                        'tags', (SELECT json_group_array(t.tag_name) FROM image_tags AS it
+                                                                 JOIN tags AS t ON it.tag_id = t.tag_id
+                                                                 WHERE it.image_id = i.image_id))
+                      FROM images AS i LEFT JOIN creators AS c ON i.creator_id = c.creator_id
+                      WHERE i.image_id IN (SELECT value FROM json_each(?))'''.format(
+                          ", ".join("'{0}', i.{0}".format(column) for column in columns)),
+                   (changes.trash_batch, image_ids))
+    # A file already in an older batch moves to this one, so it gets the full grace period again
+    cursor.execute('''INSERT OR REPLACE INTO trash_files (path, batch_id)
+                      SELECT DISTINCT i.directory_path, ?2 FROM images AS i
+                      WHERE i.image_id IN (SELECT value FROM json_each(?1)) AND i.directory_path IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM images AS other WHERE other.directory_path = i.directory_path
+                                      AND other.image_id NOT IN (SELECT value FROM json_each(?1)))''',
+                   (image_ids, changes.trash_batch))
+
+    # Removing each full-text document by id is cheaper than the per-link refreshes
+    suspend_fts_triggers(cursor)
+    cursor.execute("DELETE FROM images_fts WHERE rowid IN (SELECT value FROM json_each(?))", (image_ids,))
+    cursor.execute("DELETE FROM images WHERE image_id IN (SELECT value FROM json_each(?))", (image_ids,))
+    restore_fts_triggers(cursor, (), changes.tag_counts)
+    return changes
+
+# Bring back the images of a trash batch with their original ids, creators and tags.
+# Creators and tags deleted since are added again; tag names that became aliases resolve to their tag.
+def restore_trash(cursor, batch_id):
+    changes = ChangeSet(images=[row[0] for row in cursor.execute(
+        "SELECT image_id FROM trash_images WHERE batch_id = ?", (batch_id,))])
+    if not changes.images:
+        raise ValueError("Trash batch {} no longer exists".format(batch_id))
+
+    cursor.execute('''INSERT INTO creators (creator_name)
+                      SELECT DISTINCT json_extract(record, '$.creator_name') FROM trash_images
+                      WHERE batch_id = ? AND json_extract(record, '$.creator_name') IS NOT NULL
+                      AND json_extract(record, '$.creator_name') NOT IN (SELECT creator_name FROM creators)''',
+                   (batch_id,))
+    cursor.execute('''INSERT INTO tags (tag_name)
+                      SELECT DISTINCT tag.value FROM trash_images AS ti, json_each(ti.record, '$.tags') AS tag
+                      WHERE ti.batch_id = ? AND tag.value NOT IN (SELECT tag_name FROM tags)
+                      AND tag.value NOT IN (SELECT alias_name FROM tag_aliases)''', (batch_id,))
+
+    columns = [column[1] for column in cursor.execute("PRAGMA table_info(images)") if column[1] != "creator_id"]
+    suspend_fts_triggers(cursor)
+    cursor.execute('''INSERT INTO images (creator_id, {})
+                      SELECT (SELECT creator_id FROM creators WHERE creator_name = json_extract(record, '$.creator_name')), {}
+                      FROM trash_images WHERE batch_id = ?'''.format(
+                          ", ".join(columns), ", ".join("json_extract(record, '$.image.{}')".format(column) for column in columns)),
+                   (batch_id,))
+    cursor.execute('''INSERT OR IGNORE INTO image_tags (image_id, tag_id)
+                      SELECT ti.image_id, COALESCE((SELECT tag_id FROM tag_aliases WHERE alias_name = tag.value),
+                                                   (SELECT tag_id FROM tags WHERE tag_name = tag.value))
+                      FROM trash_images AS ti, json_each(ti.record, '$.tags') AS tag WHERE ti.batch_id = ?''',
+                   (batch_id,))
+
+    image_ids = json.dumps(list(changes.images))
+    changes.creators.update(row[0] for row in cursor.execute(
+        "SELECT DISTINCT creator_id FROM images WHERE creator_id IS NOT NULL AND image_id IN (SELECT value FROM json_each(?))",
+        (image_ids,)))
+    changes.tag_counts.update(row[0] for row in cursor.execute(
+        "SELECT DISTINCT tag_id FROM image_tags WHERE image_id IN (SELECT value FROM json_each(?))", (image_ids,)))
+    restore_fts_triggers(cursor, changes.images, changes.tag_counts)
+    # Tags added back need their rows shown as well as their counts
+    changes.tags.update(changes.tag_counts)
+    # The files are in use again
+    cursor.execute("DELETE FROM trash_batches WHERE batch_id = ?", (batch_id,))
+    return changes
+
+# Trash batches, newest first, as (batch_id, deleted_at, images, files)
+def trash_batches(cursor):
+    return cursor.execute('''SELECT b.batch_id, b.deleted_at,
+                                    (SELECT COUNT(*) FROM trash_images AS ti WHERE ti.batch_id = b.batch_id),
+                                    (SELECT COUNT(*) FROM trash_files AS tf WHERE tf.batch_id = b.batch_id)
+                             FROM trash_batches AS b ORDER BY b.batch_id DESC''').fetchall()
+
+# Returns None if the creator already exists
+def add_creator(cursor, creator_name):
+    cursor.execute("SELECT creator_id FROM creators WHERE creator_name = ?", (creator_name,))
+    if cursor.fetchone():
+        return None
+    cursor.execute("INSERT INTO creators (creator_name) VALUES (?)", (creator_name,))
+    return ChangeSet(creators=[cursor.lastrowid])
+
+# Delete creators and their social handles. Their images go to the trash with them, or
+# with reassign_to they are given to the creator of that name, who also gets the handles.
+def delete_creators(cursor, creator_ids, reassign_to=None):
+    changes = ChangeSet(creators=creator_ids)
+    deleted_ids = set(changes.creators)
+    creator_ids = json.dumps(list(deleted_ids))
+    image_ids = [row[0] for row in cursor.execute(
+        "SELECT image_id FROM images WHERE creator_id IN (SELECT value FROM json_each(?))", (creator_ids,))]
+    if reassign_to:
+        target_id = resolve_creator(cursor, reassign_to, changes)
+        if target_id in deleted_ids:
+            raise ValueError("Images can't be moved to {}, who is being deleted".format(reassign_to))
+        suspend_fts_triggers(cursor)
+        cursor.execute("UPDATE images SET creator_id = ? WHERE creator_id IN (SELECT value FROM json_each(?))",
+                       (target_id, creator_ids))
+        restore_fts_triggers(cursor, image_ids)
+        cursor.execute("UPDATE socials SET creator_id = ? WHERE creator_id IN (SELECT value FROM json_each(?))",
+                       (target_id, creator_ids))
+        changes.images.update(image_ids)
+    elif image_ids:
+        changes.update(delete_images(cursor, image_ids))
+    cursor.execute("DELETE FROM creators WHERE creator_id IN (SELECT value FROM json_each(?))", (creator_ids,))
+    return changes
+
+# Returns None if the tag name is taken, by a tag or an alias
+def add_tag(cursor, tag_name, tag_description="", category=""):
+    cursor.execute("SELECT tag_id FROM tags WHERE tag_name = ? UNION ALL SELECT tag_id FROM tag_aliases WHERE alias_name = ?",
+                   (tag_name, tag_name))
+    if cursor.fetchone():
+        return None
+    cursor.execute("INSERT INTO tags (tag_name, tag_description, category) VALUES (?, ?, ?)",
+                   (tag_name, tag_description, category))
+    return ChangeSet(tags=[cursor.lastrowid])
+
+# Tag names with the number of images using them, most used first
+def tag_usage(cursor, limit=None):
+    cursor.execute("SELECT tag_name, use_count FROM tags ORDER BY use_count DESC, tag_name LIMIT ?",
+                   (-1 if limit is None else limit,))
+    return cursor.fetchall()
+
+# Delete the tags no image uses any more, except those aliases or implications refer to
+def delete_unused_tags(cursor):
+    tag_ids = [row[0] for row in cursor.execute(UNUSED_TAGS)]
+    cursor.executemany("DELETE FROM tags WHERE tag_id = ?", [(tag_id,) for tag_id in tag_ids])
+    return ChangeSet(tags=tag_ids)
+
+# Make alias_name another name for tag_name: entering it stores tag_name, and searches for it
+# find tag_name's images. A tag already called alias_name is merged into tag_name.
+def add_tag_alias(cursor, alias_name, tag_name):
+    changes = ChangeSet()
+    tag_name = resolve_aliases(cursor, [tag_name])[0]
+    if alias_name == tag_name:
+        raise ValueError("{} can't be an alias of itself".format(alias_name))
+    tag_id = resolve_tags(cursor, [tag_name], changes)[0]
+
+    row = cursor.execute("SELECT tag_id FROM tags WHERE tag_name = ?", (alias_name,)).fetchone()
+    if row:
+        changes.update(merge_tag(cursor, row[0], tag_id))
+    # An alias that named another tag is pointed at this one
+    row = cursor.execute("SELECT tag_id FROM tag_aliases WHERE alias_name = ?", (alias_name,)).fetchone()
+    if row:
+        changes.tag_rules.add(row[0])
+    cursor.execute("INSERT OR REPLACE INTO tag_aliases (alias_name, tag_id) VALUES (?, ?)", (alias_name, tag_id))
+    changes.tag_rules.add(tag_id)
+    return changes
+
+# Move a tag's images and aliases onto another tag and delete it. Tags in implications
+# aren't merged, since their rules could conflict.
+def merge_tag(cursor, old_id, new_id):
+    if cursor.execute("SELECT 1 FROM tag_implications WHERE tag_id = ?1 OR implied_tag_id = ?1 LIMIT 1",
+                      (old_id,)).fetchone():
+        raise ValueError("Remove the implications of a tag before making its name an alias")
+    image_ids = [row[0] for row in cursor.execute("SELECT image_id FROM image_tags WHERE tag_id = ?", (old_id,))]
+    suspend_fts_triggers(cursor)
+    cursor.execute("INSERT OR IGNORE INTO image_tags (image_id, tag_id) SELECT image_id, ? FROM image_tags WHERE tag_id = ?",
+                   (new_id, old_id))
+    cursor.execute("DELETE FROM image_tags WHERE tag_id = ?", (old_id,))
+    restore_fts_triggers(cursor, image_ids, (old_id, new_id))
+    cursor.execute("UPDATE tag_aliases SET tag_id = ? WHERE tag_id = ?", (new_id, old_id))
+    cursor.execute("DELETE FROM tags WHERE tag_id = ?", (old_id,))
+    return ChangeSet(images=image_ids, tags=[old_id], tag_counts=[new_id], tag_rules=[new_id])
+
+def remove_tag_alias(cursor, alias_name):
+    row = cursor.execute("SELECT tag_id FROM tag_aliases WHERE alias_name = ?", (alias_name,)).fetchone()
+    if not row:
+        return ChangeSet()
+    cursor.execute("DELETE FROM tag_aliases WHERE alias_name = ?", (alias_name,))
+    return ChangeSet(tag_rules=[row[0]])
+
+# Make images tagged tag_name also match searches for implied_name, e.g. kitten implies cat.
+# Tags are created if needed. Raises ValueError if the rule would make a tag imply itself.
+def add_tag_implication(cursor, tag_name, implied_name):
+    changes = ChangeSet()
+    tag_id = resolve_tags(cursor, [tag_name], changes)[0]
+    implied_id = resolve_tags(cursor, [implied_name], changes)[0]
+    if tag_id == implied_id or implies(cursor, implied_id, tag_id):
+        raise ValueError("{} already implies {}".format(implied_name, tag_name))
+    add_implication_ids(cursor, tag_id, implied_id)
+    changes.tag_rules.update((tag_id, implied_id))
+    return changes
+
+def implies(cursor, tag_id, implied_id):
+    return cursor.execute("SELECT 1 FROM tag_closure WHERE tag_id = ? AND ancestor_id = ?",
+                          (tag_id, implied_id)).fetchone() is not None
+
+# Record an implication between tag ids and extend the closure with it; the caller checks for cycles
+def add_implication_ids(cursor, tag_id, implied_id):
+    cursor.execute("INSERT OR IGNORE INTO tag_implications (tag_id, implied_tag_id) VALUES (?, ?)", (tag_id, implied_id))
+    # The tag and the tags implying it now also imply implied_name and everything it implies
+    cursor.execute('''INSERT OR IGNORE INTO tag_closure (tag_id, ancestor_id)
+                      SELECT below.tag_id, above.ancestor_id
+                      FROM (SELECT ?1 AS tag_id UNION SELECT tag_id FROM tag_closure WHERE ancestor_id = ?1) AS below,
+                           (SELECT ?2 AS ancestor_id UNION SELECT ancestor_id FROM tag_closure WHERE tag_id = ?2) AS above''',
+                   (tag_id, implied_id))
+
+def remove_tag_implication(cursor, tag_name, implied_name):
+    tag_ids = lookup_tag_ids(cursor, [tag_name])
+    implied_ids = lookup_tag_ids(cursor, [implied_name])
+    cursor.executemany("DELETE FROM tag_implications WHERE tag_id = ? AND implied_tag_id = ?",
+                       [(tag_id, implied_id) for tag_id in tag_ids for implied_id in implied_ids])
+    if cursor.rowcount <= 0:
+        return ChangeSet()
+    # Only the tag and the tags implying it can lose implied tags; other paths may still connect them
+    affected = list(tag_ids) + [row[0] for row in cursor.execute(
+        "SELECT tag_id FROM tag_closure WHERE ancestor_id IN ({})".format(",".join("?" * len(tag_ids))), list(tag_ids))]
+    refresh_tag_closure(cursor, affected)
+    return ChangeSet(tag_rules=tag_ids | implied_ids)
+
+# Recompute the closure rows of some tags by following tag_implications
+def refresh_tag_closure(cursor, tag_ids):
+    tag_ids = json.dumps(list(tag_ids))
+    cursor.execute("DELETE FROM tag_closure WHERE tag_id IN (SELECT value FROM json_each(?))", (tag_ids,))
+    cursor.execute('''WITH RECURSIVE implied (tag_id, ancestor_id) AS (
+                          SELECT tag_id, implied_tag_id FROM tag_implications
+                          WHERE tag_id IN (SELECT value FROM json_each(?))
+                          UNION
+                          SELECT implied.tag_id, i.implied_tag_id
+                          FROM implied JOIN tag_implications AS i ON i.tag_id = implied.ancestor_id)
+                      INSERT INTO tag_closure (tag_id, ancestor_id) SELECT tag_id, ancestor_id FROM implied''', (tag_ids,))
+
+# Aliases as (alias, tag name) and implications as (tag name, implied tag name), sorted by name
+def tag_rules(cursor):
+    aliases = cursor.execute('''SELECT a.alias_name, t.tag_name FROM tag_aliases AS a
+                                JOIN tags AS t ON a.tag_id = t.tag_id ORDER BY a.alias_name''').fetchall()
+    implications = cursor.execute('''SELECT t.tag_name, implied.tag_name FROM tag_implications AS i
+                                     JOIN tags AS t ON i.tag_id = t.tag_id
+                                     JOIN tags AS implied ON i.implied_tag_id = implied.tag_id
+                                     ORDER BY t.tag_name, implied.tag_name''').fetchall()
+    return aliases, implications
+
+# Images with their creator and tags in one query per chunk, as image_id -> (record, creator_id, tag_ids).
+# A record is the images row with the creator name in place of its id and the tag names
+# appended, comma separated.
+def fetch_image_records(cursor, image_ids):
+    image_ids = list(image_ids)
+    records = {}
+    for start in range(0, len(image_ids), NAME_LOOKUP_CHUNK):
+        chunk = image_ids[start:start + NAME_LOOKUP_CHUNK]
+        cursor.execute('''SELECT i.*, c.creator_name, GROUP_CONCAT(t.tag_id), GROUP_CONCAT(t.tag_name)
+                          FROM images AS i
+                          LEFT JOIN creators AS c ON i.creator_id = c.creator_id
+                          LEFT JOIN image_tags AS it ON it.image_id = i.image_id
+                          LEFT JOIN tags AS t ON t.tag_id = it.tag_id
+                          WHERE i.image_id IN ({})
+                          GROUP BY i.image_id'''.format(",".join("?" * len(chunk))), chunk)
+        for row in cursor.fetchall():
+            record = list(row[:-3])
+            creator_id = record[3]
+            record[3] = row[-3]
+            tag_ids = frozenset(int(tag_id) for tag_id in row[-2].split(",")) if row[-2] else frozenset()
+            records[record[0]] = (record + [row[-1] or ""], creator_id, tag_ids)
+    return records
+
+# Record of one image as described above, or None if it doesn't exist
+def fetch_image(cursor, image_id):
+    entry = fetch_image_records(cursor, [image_id]).get(image_id)
+    return entry[0] if entry else None
+
+# Recently used image records, so reopening an image doesn't go back to the database.
+# Not thread safe: use it from one thread only.
+class ImageRecordCache:
+    def __init__(self, max_items=IMAGE_RECORD_CACHE_ITEMS):
+        self.max_items = max_items
+        self.entries = OrderedDict()   # image_id -> (record, creator_id, tag_ids), least recently used first
+
+    def get(self, image_id):
+        entry = self.entries.get(image_id)
+        if entry is None:
+            return None
+        self.entries.move_to_end(image_id)
+        return entry[0]
+
+    # Store entries from fetch_image_records
+    def update(self, entries):
+        self.entries.update(entries)
+        for image_id in entries:
+            self.entries.move_to_end(image_id)
+        while len(self.entries) > self.max_items:
+            self.entries.popitem(last=False)
+
+    # Drop the records a ChangeSet may have made stale: the changed images, and images
+    # showing the name of a changed tag or creator
+    def invalidate(self, changes):
+        for image_id in changes.images:
+            self.entries.pop(image_id, None)
+        if changes.tags or changes.creators:
+            stale = [image_id for image_id, (_, creator_id, tag_ids) in self.entries.items()
+                     if creator_id in changes.creators or not tag_ids.isdisjoint(changes.tags)]
+            for image_id in stale:
+                del self.entries[image_id]
+
+# Image ids mapped to their stored paths, looked up in chunks
+def image_paths(cursor, image_ids):
+    image_ids = list(image_ids)
+    paths = {}
+    for start in range(0, len(image_ids), NAME_LOOKUP_CHUNK):
+        chunk = image_ids[start:start + NAME_LOOKUP_CHUNK]
+        cursor.execute("SELECT image_id, directory_path FROM images WHERE image_id IN ({})".format(
+            ",".join("?" * len(chunk))), chunk)
+        paths.update(cursor.fetchall())
+    return paths
+
+# Condition (with its parameters) keeping images inside a (column, lower, upper) date range;
+# the bounds come from dates.day_range and either may be None
+def date_range_clause(date_range):
+    if date_range is None:
+        return [], []
+    column, lower, upper = date_range
+    expr = IMAGE_SORT_COLUMNS[column]
+    conditions = []
+    params = []
+    if lower is not None:
+        conditions.append("{} >= ?".format(expr))
+        params.append(lower)
+    else:
+        # Undated images are left out of every range
+        conditions.append("{} > ''".format(expr))
+    if upper is not None:
+        conditions.append("{} < ?".format(expr))
+        params.append(upper)
+    return conditions, params
+
+# Query and parameters for the page of image rows after last_key, a (sort key, image_id)
+# pair, or for the first page when last_key is None (keyset pagination). With backward the
+# page is the rows just before last_key instead, nearest first.
+def image_page_query(sort_column, descending, source, last_key, page_size, date_range=None, backward=False):
+    sort_expr = IMAGE_SORT_COLUMNS[sort_column]
+    # Reading backward is reading the opposite order forward
+    descending = descending != backward
+    order = "DESC" if descending else "ASC"
+    compare = "<" if descending else ">"
+
+    # Sorted by the filtered date column, a page is one seek and a short scan of its index
+    conditions, params = date_range_clause(date_range)
+    if last_key is not None:
+        # The plain range on the sort key lets SQLite seek the index; the row value breaks ties
+        conditions.append("{0} {1}= ? AND ({0}, i.image_id) {1} (?, ?)".format(sort_expr, compare))
+        params += [last_key[0], last_key[0], last_key[1]]
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+
+    # Tags are concatenated per row so only the images on this page are joined
+    query = IMAGE_ROW_SELECT.format(sort_expr, source) + '''{}
+            ORDER BY sort_key {}, i.image_id {}
+            LIMIT ?
+            '''.format(where, order, order)
+    return query, params + [page_size]
+
+# Number of images in each period of a date column, oldest first, as (period, count) pairs.
+# period is the length of the ISO prefix grouped on (dates.PERIOD_YEAR, PERIOD_MONTH or PERIOD_DAY).
+def date_timeline(cursor, column, period, source=IMAGE_SOURCE, date_range=None):
+    expr = IMAGE_SORT_COLUMNS[column]
+    conditions, params = date_range_clause(date_range or (column, None, None))
+    if source != IMAGE_SOURCE:
+        # Search results are few enough to group directly
+        cursor.execute('''SELECT SUBSTR({0}, 1, ?) AS period, COUNT(*) FROM {1}
+                          WHERE {2} GROUP BY period ORDER BY period'''.format(expr, source, " AND ".join(conditions)),
+                       [period] + params)
+        return cursor.fetchall()
+
+    # Seek the index to the first image of each period and count the period's range of it,
+    # instead of grouping (and sorting) every image. Each query gets a single lower bound,
+    # since SQLite would otherwise start the index scan at whichever bound it picks.
+    _, lower, upper = date_range or (column, None, None)
+    upper_clause = " AND {} < ?".format(expr) if upper is not None else ""
+    upper_params = [upper] if upper is not None else []
+    # Undated images ('') are skipped
+    start, compare = (lower, ">=") if lower is not None else ("", ">")
+    timeline = []
+    while True:
+        cursor.execute("SELECT {0} FROM images AS i WHERE {0} {1} ?{2} ORDER BY {0} LIMIT 1".format(
+            expr, compare, upper_clause), [start] + upper_params)
+        row = cursor.fetchone()
+        if row is None:
+            return timeline
+        key = row[0][:period]
+        # Every value starting with key sorts below key with its last character incremented
+        start, compare = key[:-1] + chr(ord(key[-1]) + 1), ">="
+        cursor.execute("SELECT COUNT(*) FROM images AS i WHERE {0} >= ? AND {0} < ?".format(expr),
+                       [max(key, lower or key), min(start, upper or start)])
+        timeline.append((key, cursor.fetchone()[0]))
+
+# Every image with its creator and tags, in image_id order
+def iter_images(cursor):
+    return cursor.execute('''SELECT i.image_id, i.filename, c.creator_name, i.source_url,
+                             (SELECT GROUP_CONCAT(t.tag_name)
+                              FROM image_tags AS it
+                              JOIN tags AS t ON it.tag_id = t.tag_id
+                              WHERE it.image_id = i.image_id) AS tags,
+                             i.date_added, i.date_uploaded, i.directory_path, i.content_hash
+                             FROM images AS i
+                             LEFT JOIN creators AS c ON i.creator_id = c.creator_id
+                             ORDER BY i.image_id''')
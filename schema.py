@@ -0,0 +1,563 @@
+import json
+import time
+
+from dates import normalize_date, normalize_timestamp
+
+# Versioned schema migrations.
+#
+# Each migration upgrades the database by one version and PRAGMA user_version records
+# the last one applied, so existing image_database.db files are upgraded in place.
+# New migrations are only ever appended to MIGRATIONS.
+
+# Times each hot query is repeated when measuring its cost
+MEASURE_REPEATS = 20
+
+def migration_base_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS creators (
+            creator_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            creator_name TEXT NOT NULL UNIQUE
+        )
+    ''' )
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS images (
+            image_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT NOT NULL,
+            directory_path TEXT,
+            creator_id INTEGER,
+            source_url TEXT,
+            date_added TEXT,
+            date_uploaded TEXT,
+            FOREIGN KEY (creator_id) REFERENCES creators (creator_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tags (
+            tag_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tag_name TEXT NOT NULL,
+            tag_description TEXT,
+            category TEXT
+        )
+    ''' )
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_tags (
+            image_id INTEGER,
+            tag_id INTEGER,
+            PRIMARY KEY (image_id, tag_id),
+            FOREIGN KEY (image_id) REFERENCES images (image_id),
+            FOREIGN KEY (tag_id) REFERENCES tags (tag_id)
+        )
+    ''' )
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS socials (
+            social_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            creator_id INTEGER,
+            social_handle TEXT,
+            social_type TEXT,
+            FOREIGN KEY (creator_id) REFERENCES creators (creator_id)
+        )
+    ''' )
+
+def migration_content_hash(cursor):
+    # Databases written before migrations existed may already have the column
+    image_columns = [column[1] for column in cursor.execute("PRAGMA table_info(images)")]
+    if "content_hash" not in image_columns:
+        cursor.execute("ALTER TABLE images ADD COLUMN content_hash TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_content_hash ON images (content_hash)")
+
+def migration_lookup_indexes(cursor):
+    # Merge duplicate tag names into the oldest tag so the name can be made unique
+    cursor.execute('''
+        CREATE TEMP TABLE tag_merge AS
+        SELECT t.tag_id AS old_id, keep.tag_id AS new_id
+        FROM tags AS t
+        JOIN (SELECT tag_name, MIN(tag_id) AS tag_id FROM tags GROUP BY tag_name) AS keep
+        ON t.tag_name = keep.tag_name AND t.tag_id != keep.tag_id
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO image_tags (image_id, tag_id)
+        SELECT it.image_id, m.new_id FROM image_tags AS it JOIN temp.tag_merge AS m ON it.tag_id = m.old_id
+    ''')
+    cursor.execute("DELETE FROM image_tags WHERE tag_id IN (SELECT old_id FROM temp.tag_merge)")
+    cursor.execute("DELETE FROM tags WHERE tag_id IN (SELECT old_id FROM temp.tag_merge)")
+    cursor.execute("DROP TABLE temp.tag_merge")
+
+    # Tag names are looked up on every insert and edit
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tags_tag_name ON tags (tag_name)")
+    # Reverse lookups: images with a tag, images by a creator
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_tags_tag ON image_tags (tag_id, image_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_creator ON images (creator_id, image_id)")
+    # Keyset pages of the image table; expressions match IMAGE_SORT_COLUMNS in repository.py
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_filename ON images (filename, image_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_source_url ON images (COALESCE(source_url, ''), image_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_date_added ON images (COALESCE(date_added, ''), image_id)")
+
+# Rebuild the full-text document of every image selected by a WHERE clause on images (alias i)
+FTS_REFRESH = '''
+    DELETE FROM images_fts WHERE rowid IN (SELECT i.image_id FROM images AS i WHERE {0});
+    INSERT INTO images_fts (rowid, filename, source_url, creator_name, tag_names, tag_descriptions)
+    SELECT i.image_id, i.filename, i.source_url, c.creator_name,
+           (SELECT GROUP_CONCAT(t.tag_name, ' ') FROM image_tags AS it
+            JOIN tags AS t ON it.tag_id = t.tag_id WHERE it.image_id = i.image_id),
+           (SELECT GROUP_CONCAT(t.tag_description, ' ') FROM image_tags AS it
+            JOIN tags AS t ON it.tag_id = t.tag_id WHERE it.image_id = i.image_id)
+    FROM images AS i LEFT JOIN creators AS c ON i.creator_id = c.creator_id
+    WHERE {0};
+'''
+
+# Triggers keeping images_fts in step with the tables it indexes
+FTS_TRIGGERS = {
+    "images_fts_image_insert": "AFTER INSERT ON images",
+    "images_fts_image_update": "AFTER UPDATE OF filename, source_url, creator_id ON images",
+    "images_fts_image_tag_insert": "AFTER INSERT ON image_tags",
+    "images_fts_image_tag_delete": "AFTER DELETE ON image_tags",
+    "images_fts_tag_update": "AFTER UPDATE OF tag_name, tag_description ON tags",
+    "images_fts_creator_update": "AFTER UPDATE OF creator_name ON creators",
+}
+FTS_TRIGGER_TARGETS = {
+    "images_fts_image_insert": "i.image_id = new.image_id",
+    "images_fts_image_update": "i.image_id = new.image_id",
+    "images_fts_image_tag_insert": "i.image_id = new.image_id",
+    "images_fts_image_tag_delete": "i.image_id = old.image_id",
+    "images_fts_tag_update": "i.image_id IN (SELECT image_id FROM image_tags WHERE tag_id = new.tag_id)",
+    "images_fts_creator_update": "i.creator_id = new.creator_id",
+}
+
+# The triggers only run while the one row of fts_sync has suspended = 0. Since migration 15 the
+# change_log triggers on image_tags check it too.
+FTS_TRIGGER_WHEN = "WHEN (SELECT suspended FROM fts_sync) = 0"
+
+# The triggers as migrations 4 and 12 created them; migration 14 replaces them with
+# create_flagged_fts_triggers
+def create_fts_triggers(cursor):
+    for name, event in FTS_TRIGGERS.items():
+        cursor.execute("CREATE TRIGGER IF NOT EXISTS {} {} BEGIN {} END".format(
+            name, event, FTS_REFRESH.format(FTS_TRIGGER_TARGETS[name])))
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS images_fts_image_delete AFTER DELETE ON images
+                      BEGIN DELETE FROM images_fts WHERE rowid = old.image_id; END''')
+
+# The current triggers, which suspend_fts_triggers can pause
+def create_flagged_fts_triggers(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS fts_sync (suspended INTEGER NOT NULL)")
+    cursor.execute("INSERT INTO fts_sync (suspended) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM fts_sync)")
+    for name, event in FTS_TRIGGERS.items():
+        cursor.execute("CREATE TRIGGER IF NOT EXISTS {} {} {} BEGIN {} END".format(
+            name, event, FTS_TRIGGER_WHEN, FTS_REFRESH.format(FTS_TRIGGER_TARGETS[name])))
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS images_fts_image_delete AFTER DELETE ON images {}
+                      BEGIN DELETE FROM images_fts WHERE rowid = old.image_id; END'''.format(FTS_TRIGGER_WHEN))
+
+def drop_fts_triggers(cursor):
+    for name in list(FTS_TRIGGERS) + ["images_fts_image_delete"]:
+        cursor.execute("DROP TRIGGER IF EXISTS {}".format(name))
+
+# Bulk writes skip the per-row triggers and rebuild each touched document once instead.
+# The flag is set inside the caller's transaction and cleared by restore_fts_triggers before
+# it commits (or by its rollback), so other connections never see it set and the schema,
+# which every connection would have to re-read, stays the same.
+def suspend_fts_triggers(cursor):
+    cursor.execute("UPDATE fts_sync SET suspended = 1")
+
+# End a bulk write on the images and tags it touched: their documents are rebuilt and each is
+# logged once for other instances, instead of once per link added or removed
+def restore_fts_triggers(cursor, image_ids, tag_ids=()):
+    image_ids = json.dumps(list(image_ids))
+    for statement in FTS_REFRESH.format("i.image_id IN (SELECT value FROM json_each(?))").split(";"):
+        if statement.strip():
+            cursor.execute(statement, (image_ids,))
+    cursor.execute("INSERT INTO change_log (kind, row_id) SELECT 'images', value FROM json_each(?)", (image_ids,))
+    cursor.execute("INSERT INTO change_log (kind, row_id) SELECT 'tag_counts', value FROM json_each(?)",
+                   (json.dumps(list(tag_ids)),))
+    cursor.execute("UPDATE fts_sync SET suspended = 0")
+
+def migration_full_text_search(cursor):
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5 (
+            filename, source_url, creator_name, tag_names, tag_descriptions,
+            tokenize = "unicode61 remove_diacritics 2",
+            prefix = '2 3'
+        )
+    ''')
+    create_fts_triggers(cursor)
+    for statement in FTS_REFRESH.format("1").split(";"):
+        if statement.strip():
+            cursor.execute(statement)
+
+def migration_perceptual_hash(cursor):
+    # 64-bit dHash stored as a signed integer; filled in on insert or by the duplicate report
+    cursor.execute("ALTER TABLE images ADD COLUMN phash INTEGER")
+
+# Triggers keeping tags.use_count equal to the number of images linked to each tag
+USE_COUNT_TRIGGERS = {
+    "tags_use_count_insert": '''AFTER INSERT ON image_tags BEGIN
+        UPDATE tags SET use_count = use_count + 1 WHERE tag_id = new.tag_id; END''',
+    "tags_use_count_delete": '''AFTER DELETE ON image_tags BEGIN
+        UPDATE tags SET use_count = use_count - 1 WHERE tag_id = old.tag_id; END''',
+    "tags_use_count_update": '''AFTER UPDATE OF tag_id ON image_tags BEGIN
+        UPDATE tags SET use_count = use_count - 1 WHERE tag_id = old.tag_id;
+        UPDATE tags SET use_count = use_count + 1 WHERE tag_id = new.tag_id; END''',
+}
+
+# Recount every tag from image_tags
+USE_COUNT_REFRESH = "UPDATE tags SET use_count = (SELECT COUNT(*) FROM image_tags AS it WHERE it.tag_id = tags.tag_id)"
+
+def create_use_count_triggers(cursor):
+    for name, body in USE_COUNT_TRIGGERS.items():
+        cursor.execute("CREATE TRIGGER IF NOT EXISTS {} {}".format(name, body))
+
+def migration_tag_use_count(cursor):
+    cursor.execute("ALTER TABLE tags ADD COLUMN use_count INTEGER NOT NULL DEFAULT 0")
+    cursor.execute(USE_COUNT_REFRESH)
+    # Tag listings and orphan cleanup read tags by popularity
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tags_use_count ON tags (use_count DESC, tag_name)")
+    create_use_count_triggers(cursor)
+
+# Value in its stored form, or unchanged if it can't be read
+def normalized_or_kept(normalize, value):
+    try:
+        return normalize(value)
+    except ValueError:
+        return value
+
+def migration_normalized_dates(cursor):
+    # date_added held str(datetime) and date_uploaded DateEntry's locale text; both become ISO 8601
+    conn = cursor.connection
+    conn.create_function("normalized_timestamp", 1, lambda value: normalized_or_kept(normalize_timestamp, value))
+    conn.create_function("normalized_date", 1, lambda value: normalized_or_kept(normalize_date, value))
+    cursor.execute("UPDATE images SET date_added = normalized_timestamp(date_added) WHERE date_added IS NOT NULL")
+    cursor.execute("UPDATE images SET date_uploaded = normalized_date(date_uploaded) WHERE date_uploaded IS NOT NULL")
+    # Sorting and range filters on the upload date; date_added's index was created with the others
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_date_uploaded ON images (COALESCE(date_uploaded, ''), image_id)")
+
+def migration_file_integrity(cursor):
+    # Size of the stored file, filled in on insert or by the integrity scan
+    cursor.execute("ALTER TABLE images ADD COLUMN file_size INTEGER")
+    # Size, mtime and hash of each stored file when it was last hashed, keyed by absolute path
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS file_checks (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            content_hash TEXT
+        ) WITHOUT ROWID
+    ''')
+
+def migration_image_metadata(cursor):
+    # Read from each file's header at ingest or by the metadata backfill
+    cursor.execute("ALTER TABLE images ADD COLUMN width INTEGER")
+    cursor.execute("ALTER TABLE images ADD COLUMN height INTEGER")
+    cursor.execute("ALTER TABLE images ADD COLUMN image_format TEXT")
+    cursor.execute("ALTER TABLE images ADD COLUMN date_taken TEXT")
+    cursor.execute("ALTER TABLE images ADD COLUMN camera_model TEXT")
+    # Searches filter on format, dimensions and file size
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_format ON images (image_format)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_width ON images (width)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_height ON images (height)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_file_size ON images (file_size)")
+
+# Triggers recording every change other instances sharing the catalog need to show (see
+# repository.ChangeFeed). Kinds are named after the ChangeSet fields they fill; image columns
+# that are never displayed or searched, like the metadata filled in by the backfill, are left out.
+CHANGE_LOG_TRIGGERS = {
+    "change_log_image_insert": '''AFTER INSERT ON images BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('images', new.image_id); END''',
+    "change_log_image_update": '''AFTER UPDATE OF filename, directory_path, creator_id, source_url, date_added,
+                                  date_uploaded, phash ON images BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('images', new.image_id); END''',
+    "change_log_image_delete": '''AFTER DELETE ON images BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('images', old.image_id); END''',
+    "change_log_image_tag_insert": '''AFTER INSERT ON image_tags BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('images', new.image_id), ('tag_counts', new.tag_id); END''',
+    "change_log_image_tag_delete": '''AFTER DELETE ON image_tags BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('images', old.image_id), ('tag_counts', old.tag_id); END''',
+    "change_log_image_tag_update": '''AFTER UPDATE ON image_tags BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('images', old.image_id), ('tag_counts', old.tag_id),
+                                                      ('images', new.image_id), ('tag_counts', new.tag_id); END''',
+    "change_log_tag_insert": '''AFTER INSERT ON tags BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('tags', new.tag_id); END''',
+    # use_count is covered by the image_tags triggers
+    "change_log_tag_update": '''AFTER UPDATE OF tag_name, tag_description, category ON tags BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('tags', new.tag_id); END''',
+    "change_log_tag_delete": '''AFTER DELETE ON tags BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('tags', old.tag_id); END''',
+    "change_log_creator_insert": '''AFTER INSERT ON creators BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('creators', new.creator_id); END''',
+    "change_log_creator_update": '''AFTER UPDATE ON creators BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('creators', new.creator_id); END''',
+    "change_log_creator_delete": '''AFTER DELETE ON creators BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('creators', old.creator_id); END''',
+}
+
+# The triggers as migrations 10 and 12 created them; migration 15 replaces the ones on
+# image_tags through create_flagged_change_log_triggers
+def create_change_log_triggers(cursor):
+    for name, body in CHANGE_LOG_TRIGGERS.items():
+        cursor.execute("CREATE TRIGGER IF NOT EXISTS {} {}".format(name, body))
+
+# Triggers logging each link; bulk writes pause them and log what they touched once instead
+CHANGE_LOG_LINK_TRIGGERS = ("change_log_image_tag_insert", "change_log_image_tag_delete",
+                            "change_log_image_tag_update")
+
+# The current triggers, with those on image_tags paused by suspend_fts_triggers
+def create_flagged_change_log_triggers(cursor):
+    for name, body in CHANGE_LOG_TRIGGERS.items():
+        if name in CHANGE_LOG_LINK_TRIGGERS:
+            event, _, statements = body.partition(" BEGIN")
+            body = "{} {} BEGIN{}".format(event, FTS_TRIGGER_WHEN, statements)
+        cursor.execute("CREATE TRIGGER IF NOT EXISTS {} {}".format(name, body))
+
+def migration_change_log(cursor):
+    # AUTOINCREMENT keeps ids from being reused after the oldest rows are pruned
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            row_id INTEGER NOT NULL
+        )
+    ''')
+    create_change_log_triggers(cursor)
+
+# change_log entries for tag rules, which other instances reload (see CHANGE_LOG_TRIGGERS)
+TAG_RULE_CHANGE_LOG_TRIGGERS = {
+    "change_log_tag_alias_insert": '''AFTER INSERT ON tag_aliases BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('tag_rules', new.tag_id); END''',
+    "change_log_tag_alias_update": '''AFTER UPDATE ON tag_aliases BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('tag_rules', old.tag_id), ('tag_rules', new.tag_id); END''',
+    "change_log_tag_alias_delete": '''AFTER DELETE ON tag_aliases BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('tag_rules', old.tag_id); END''',
+    "change_log_tag_implication_insert": '''AFTER INSERT ON tag_implications BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('tag_rules', new.tag_id); END''',
+    "change_log_tag_implication_delete": '''AFTER DELETE ON tag_implications BEGIN
+        INSERT INTO change_log (kind, row_id) VALUES ('tag_rules', old.tag_id); END''',
+}
+
+def migration_tag_rules(cursor):
+    # Other names for a tag; they are stored as the tag they name
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tag_aliases (
+            alias_name TEXT PRIMARY KEY,
+            tag_id INTEGER NOT NULL,
+            FOREIGN KEY (tag_id) REFERENCES tags (tag_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tag_aliases_tag ON tag_aliases (tag_id)")
+    # Tags implying another one: images tagged kitten are found by searches for cat
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tag_implications (
+            tag_id INTEGER NOT NULL,
+            implied_tag_id INTEGER NOT NULL,
+            PRIMARY KEY (tag_id, implied_tag_id),
+            FOREIGN KEY (tag_id) REFERENCES tags (tag_id),
+            FOREIGN KEY (implied_tag_id) REFERENCES tags (tag_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tag_implications_implied ON tag_implications (implied_tag_id, tag_id)")
+    # Transitive closure of tag_implications, kept up to date by repository.py: each tag with
+    # every tag it implies directly or through others
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tag_closure (
+            tag_id INTEGER NOT NULL,
+            ancestor_id INTEGER NOT NULL,
+            PRIMARY KEY (tag_id, ancestor_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tag_closure_ancestor ON tag_closure (ancestor_id, tag_id)")
+    for name, body in TAG_RULE_CHANGE_LOG_TRIGGERS.items():
+        cursor.execute("CREATE TRIGGER IF NOT EXISTS {} {}".format(name, body))
+
+def migration_cascading_deletes(cursor):
+    # Older deletes left links, handles and creator ids pointing at rows that are gone
+    cursor.execute("UPDATE images SET creator_id = NULL WHERE creator_id NOT IN (SELECT creator_id FROM creators)")
+
+    # SQLite can't change a foreign key in place, so the child tables are copied into new ones
+    # deleted along with their image, tag or creator. The full-text triggers name image_tags
+    # and would block the rename, so they are dropped until it is done.
+    drop_fts_triggers(cursor)
+    cursor.execute('''
+        CREATE TABLE image_tags_new (
+            image_id INTEGER,
+            tag_id INTEGER,
+            PRIMARY KEY (image_id, tag_id),
+            FOREIGN KEY (image_id) REFERENCES images (image_id) ON DELETE CASCADE,
+            FOREIGN KEY (tag_id) REFERENCES tags (tag_id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('''INSERT INTO image_tags_new (image_id, tag_id) SELECT image_id, tag_id FROM image_tags
+                      WHERE image_id IN (SELECT image_id FROM images) AND tag_id IN (SELECT tag_id FROM tags)''')
+    cursor.execute("DROP TABLE image_tags")
+    cursor.execute("ALTER TABLE image_tags_new RENAME TO image_tags")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_tags_tag ON image_tags (tag_id, image_id)")
+
+    cursor.execute('''
+        CREATE TABLE socials_new (
+            social_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            creator_id INTEGER,
+            social_handle TEXT,
+            social_type TEXT,
+            FOREIGN KEY (creator_id) REFERENCES creators (creator_id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('''INSERT INTO socials_new (social_id, creator_id, social_handle, social_type)
+                      SELECT social_id, creator_id, social_handle, social_type FROM socials
+                      WHERE creator_id IS NULL OR creator_id IN (SELECT creator_id FROM creators)''')
+    cursor.execute("DROP TABLE socials")
+    cursor.execute("ALTER TABLE socials_new RENAME TO socials")
+    # Deleting a creator looks up its handles
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_socials_creator ON socials (creator_id)")
+
+    # The triggers on image_tags went with the old table
+    create_fts_triggers(cursor)
+    create_use_count_triggers(cursor)
+    create_change_log_triggers(cursor)
+    cursor.execute(USE_COUNT_REFRESH)
+
+def migration_trash(cursor):
+    # Deleted images, restorable until trash.py reclaims their batch and removes the files
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS trash_batches (
+            batch_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            deleted_at TEXT NOT NULL
+        )
+    ''')
+    # Each deleted image as JSON: its row, creator name and tag names
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS trash_images (
+            image_id INTEGER PRIMARY KEY,
+            batch_id INTEGER NOT NULL,
+            record TEXT NOT NULL,
+            FOREIGN KEY (batch_id) REFERENCES trash_batches (batch_id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trash_images_batch ON trash_images (batch_id)")
+    # Stored files no remaining image used when the batch was deleted
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS trash_files (
+            path TEXT PRIMARY KEY,
+            batch_id INTEGER NOT NULL,
+            FOREIGN KEY (batch_id) REFERENCES trash_batches (batch_id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trash_files_batch ON trash_files (batch_id)")
+    # Whether another image still uses a deleted image's file
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_directory_path ON images (directory_path)")
+
+def migration_fts_trigger_flag(cursor):
+    # Bulk writes used to drop and recreate the full-text triggers, changing the schema under
+    # every other connection; the triggers now check the fts_sync flag instead
+    drop_fts_triggers(cursor)
+    create_flagged_fts_triggers(cursor)
+
+def migration_change_log_per_image(cursor):
+    # Bulk tagging and imports logged a row for every link; they now log each image and tag once
+    for name in CHANGE_LOG_LINK_TRIGGERS:
+        cursor.execute("DROP TRIGGER IF EXISTS {}".format(name))
+    create_flagged_change_log_triggers(cursor)
+
+MIGRATIONS = [
+    migration_base_tables,
+    migration_content_hash,
+    migration_lookup_indexes,
+    migration_full_text_search,
+    migration_perceptual_hash,
+    migration_tag_use_count,
+    migration_normalized_dates,
+    migration_file_integrity,
+    migration_image_metadata,
+    migration_change_log,
+    migration_tag_rules,
+    migration_cascading_deletes,
+    migration_trash,
+    migration_fts_trigger_flag,
+    migration_change_log_per_image,
+]
+
+# Hot queries measured before and after an upgrade; parameters are sampled from the data
+HOT_QUERIES = {
+    "tag by name": ("SELECT tag_id FROM tags WHERE tag_name = ?",
+                    "SELECT tag_name FROM tags ORDER BY tag_id DESC LIMIT 1"),
+    "images with tag": ("SELECT image_id FROM image_tags WHERE tag_id = ?",
+                        "SELECT tag_id FROM image_tags ORDER BY rowid DESC LIMIT 1"),
+    "images by creator": ("SELECT image_id FROM images WHERE creator_id = ?",
+                          "SELECT creator_id FROM images ORDER BY image_id DESC LIMIT 1"),
+    "image by filename": ("SELECT image_id FROM images WHERE filename = ?",
+                          "SELECT filename FROM images ORDER BY image_id DESC LIMIT 1"),
+    "page by date added": ("SELECT image_id FROM images WHERE (COALESCE(date_added, ''), image_id) > (?, 0) "
+                           "ORDER BY COALESCE(date_added, ''), image_id LIMIT 60",
+                           "SELECT COALESCE(date_added, '') FROM images ORDER BY image_id LIMIT 1"),
+    "images uploaded in range": ("SELECT image_id FROM images WHERE COALESCE(date_uploaded, '') >= ? "
+                                 "AND COALESCE(date_uploaded, '') < '9999' ORDER BY COALESCE(date_uploaded, ''), image_id LIMIT 60",
+                                 "SELECT COALESCE(date_uploaded, '') FROM images ORDER BY image_id LIMIT 1"),
+}
+
+def table_exists(cursor, table_name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+    return cursor.fetchone() is not None
+
+# Average time and query plan of each hot query
+def measure_hot_queries(conn):
+    cursor = conn.cursor()
+    results = {}
+    for name, (query, sample_query) in HOT_QUERIES.items():
+        sample = cursor.execute(sample_query).fetchone()
+        parameters = sample if sample else (None,)
+        plan = "; ".join(row[-1] for row in cursor.execute("EXPLAIN QUERY PLAN " + query, parameters))
+
+        start = time.perf_counter()
+        for _ in range(MEASURE_REPEATS):
+            cursor.execute(query, parameters).fetchall()
+        results[name] = ((time.perf_counter() - start) / MEASURE_REPEATS, plan)
+    return results
+
+def format_measurements(before, after):
+    lines = []
+    for name, (after_seconds, after_plan) in after.items():
+        before_seconds, before_plan = before[name]
+        lines.append("{}: {:.3f} ms -> {:.3f} ms ({} -> {})".format(
+            name, before_seconds * 1000, after_seconds * 1000, before_plan, after_plan))
+    return lines
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# Apply every pending migration, each in its own transaction
+def migrate(conn, report=print):
+    version = schema_version(conn)
+    if version >= len(MIGRATIONS):
+        return version
+
+    # Only existing catalogs have hot queries worth measuring
+    cursor = conn.cursor()
+    measure = table_exists(cursor, "images") and table_exists(cursor, "image_tags")
+    before = measure_hot_queries(conn) if measure else None
+
+    # Migrations rebuild tables and tidy rows that broke foreign keys before they were
+    # enforced, so the checks are off until they are done
+    foreign_keys = conn.execute("PRAGMA foreign_keys").fetchone()[0]
+    conn.execute("PRAGMA foreign_keys = OFF")
+    try:
+        apply_migrations(conn, cursor, report)
+    finally:
+        conn.execute("PRAGMA foreign_keys = {}".format(foreign_keys))
+
+    if before is not None:
+        for line in format_measurements(before, measure_hot_queries(conn)):
+            report(line)
+    return len(MIGRATIONS)
+
+def apply_migrations(conn, cursor, report):
+    while True:
+        # Each migration holds the write lock from the start, and the version is read again
+        # under it, so instances starting together upgrade the catalog once, one step at a time
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            number = schema_version(conn) + 1
+            if number > len(MIGRATIONS):
+                conn.rollback()
+                break
+            migration = MIGRATIONS[number - 1]
+            migration(cursor)
+            cursor.execute("PRAGMA user_version = {}".format(number))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        report("Upgraded database schema to version {} ({})".format(number, migration.__name__))
@@ -0,0 +1,363 @@
+import bisect
+import re
+from array import array
+
+# Boolean tag search and full-text search.
+#
+# Queries look like `cat AND (outdoor OR night) AND NOT sketch creator:"Some Artist"`.
+# Adjacent terms are joined with AND, and names containing spaces or parentheses can be quoted.
+# Queries are evaluated against TagIndex, an in-memory inverted index from each tag
+# (and creator) to the set of image ids carrying it; a tag term also finds the images of its
+# aliases and of every tag implying it (see tag_closure). Terms on file details, such as
+# `format:png width>=3840 size<2M`, are looked up through the indexes on those columns.
+#
+# Free-text searches go through the images_fts table maintained by schema.py instead.
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(\()|(\))|((?:[^\s()"]*:)?"[^"]*")|([^\s()]+))')
+OPERATORS = {"AND", "OR", "NOT"}
+# A set is stored as a bitset once it holds at least 1 of every this many image ids
+DENSE_RATIO = 32
+
+# Comparisons on image details, e.g. width>=3840 or size<2M
+ATTRIBUTE_PATTERN = re.compile(r"^(width|height|size)(>=|<=|>|<|=)(\d+)([kmg]?)b?$", re.IGNORECASE)
+ATTRIBUTE_COLUMNS = {"width": "width", "height": "height", "size": "file_size"}
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+# Names Pillow uses for formats often written differently
+FORMAT_ALIASES = {"JPG": "JPEG", "TIF": "TIFF"}
+
+class QueryError(ValueError):
+    pass
+
+def tokenize(query):
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = TOKEN_PATTERN.match(query, position)
+        if not match or match.end() == position:
+            raise QueryError("Unexpected character at position {}".format(position))
+        position = match.end()
+        open_paren, close_paren, quoted, word = match.groups()
+        if open_paren or close_paren:
+            tokens.append(open_paren or close_paren)
+        elif quoted:
+            prefix, _, name = quoted.partition('"')
+            tokens.append(("term", prefix, name[:-1]))
+        elif word.upper() in OPERATORS:
+            tokens.append(word.upper())
+        elif ATTRIBUTE_PATTERN.match(word):
+            name, operator, number, unit = ATTRIBUTE_PATTERN.match(word).groups()
+            tokens.append(("attribute", ATTRIBUTE_COLUMNS[name.lower()], operator,
+                           int(number) * SIZE_UNITS[unit.lower()]))
+        else:
+            prefix, separator, name = word.rpartition(":")
+            tokens.append(("term", prefix + separator, name))
+    return tokens
+
+# Recursive descent parser producing nested tuples, e.g. ("and", ("tag", "cat"), ("not", ...))
+class QueryParser:
+    def __init__(self, query):
+        self.tokens = tokenize(query)
+        self.position = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise QueryError("The search is empty.")
+        node = self.parse_or()
+        if self.position < len(self.tokens):
+            raise QueryError("Unexpected '{}'".format(self.describe(self.tokens[self.position])))
+        return node
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def describe(self, token):
+        return token[2] if isinstance(token, tuple) else token
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.peek() == "OR":
+            self.take()
+            node = ("or", node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.peek() not in (None, "OR", ")"):
+            if self.peek() == "AND":
+                self.take()
+            node = ("and", node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.peek() == "NOT":
+            self.take()
+            return ("not", self.parse_not())
+        return self.parse_primary()
+
+    def parse_primary(self):
+        token = self.take()
+        if token == "(":
+            node = self.parse_or()
+            if self.take() != ")":
+                raise QueryError("Missing ')'")
+            return node
+        if isinstance(token, tuple) and token[0] == "attribute":
+            return token
+        if isinstance(token, tuple):
+            _, prefix, name = token
+            if prefix.lower() == "creator:":
+                return ("creator", name)
+            if prefix.lower() == "tag:":
+                return ("tag", name)
+            if prefix.lower() == "format:":
+                return ("attribute", "image_format", "=", FORMAT_ALIASES.get(name.upper(), name.upper()))
+            # Any other prefix is part of the tag name, e.g. rating:safe
+            return ("tag", prefix + name)
+        if token is None:
+            raise QueryError("The search ends unexpectedly.")
+        raise QueryError("Unexpected '{}'".format(token))
+
+def parse_query(query):
+    return QueryParser(query).parse()
+
+# Turn free text into an FTS5 query: every word must match, as a prefix of an indexed word
+def fts_query(text):
+    words = re.findall(r"\w+", text)
+    if not words:
+        raise QueryError("The search is empty.")
+    return " ".join('"{}"*'.format(word) for word in words)
+
+# Ranked full-text search over filenames, source URLs, creators and tags, one page at a time
+def text_search(cursor, text, limit=50, offset=0):
+    cursor.execute("SELECT rowid FROM images_fts WHERE images_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+                   (fts_query(text), limit, offset))
+    return [row[0] for row in cursor.fetchall()]
+
+# Convert sorted image ids to an int bitset (bit n set for image n)
+def ids_to_bits(ids):
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for image_id in ids:
+        buffer[image_id >> 3] |= 1 << (image_id & 7)
+    return int.from_bytes(buffer, "little")
+
+# Convert an int bitset back to a sorted list of image ids
+def bits_to_ids(bits):
+    ids = []
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for byte_index, byte in enumerate(data):
+        if byte:
+            base = byte_index * 8
+            for bit in range(8):
+                if byte >> bit & 1:
+                    ids.append(base + bit)
+    return ids
+
+# A set of image ids: a sorted array while sparse, an int bitset once dense
+class ImageSet:
+    __slots__ = ("ids", "bits", "count")
+
+    def __init__(self, ids=()):
+        self.ids = array("I", sorted(ids))
+        self.bits = None
+        self.count = len(self.ids)
+
+    def add(self, image_id, universe_size):
+        if self.bits is not None:
+            if not self.bits >> image_id & 1:
+                self.bits |= 1 << image_id
+                self.count += 1
+            return
+        position = bisect.bisect_left(self.ids, image_id)
+        if position == len(self.ids) or self.ids[position] != image_id:
+            self.ids.insert(position, image_id)
+            self.count += 1
+            self.compact(universe_size)
+
+    def discard(self, image_id):
+        if self.bits is not None:
+            if self.bits >> image_id & 1:
+                self.bits &= ~(1 << image_id)
+                self.count -= 1
+            return
+        position = bisect.bisect_left(self.ids, image_id)
+        if position < len(self.ids) and self.ids[position] == image_id:
+            del self.ids[position]
+            self.count -= 1
+
+    # Switch to a bitset when it takes less memory than the array
+    def compact(self, universe_size):
+        if self.bits is None and self.count * DENSE_RATIO >= universe_size:
+            self.bits = ids_to_bits(self.ids)
+            self.ids = None
+
+    def as_bits(self):
+        return self.bits if self.bits is not None else ids_to_bits(self.ids)
+
+# Inverted index from tags and creators to the images that carry them
+class TagIndex:
+    def __init__(self):
+        self.tags = {}             # tag_id -> ImageSet
+        self.creators = {}         # creator_id -> ImageSet
+        self.tag_ids = {}          # casefolded tag name -> set of tag_ids
+        self.tag_names = {}        # tag_id -> casefolded tag name
+        self.creator_ids = {}      # casefolded creator name -> set of creator_ids
+        self.creator_names = {}    # creator_id -> casefolded creator name
+        self.image_tags = {}       # image_id -> tuple of tag_ids, used to undo an image's old tags
+        self.image_creator = {}    # image_id -> creator_id
+        self.all_images = 0        # bitset of every image id
+        self.alias_tags = {}       # casefolded alias name -> set of tag_ids
+        self.implied_by = {}       # tag_id -> tag_ids implying it, directly or through others
+
+    # Load the whole index from the database
+    def build(self, cursor):
+        self.__init__()
+        for tag_id, name in cursor.execute("SELECT tag_id, tag_name FROM tags"):
+            self.set_name(self.tag_ids, self.tag_names, tag_id, name)
+        for creator_id, name in cursor.execute("SELECT creator_id, creator_name FROM creators"):
+            self.set_name(self.creator_ids, self.creator_names, creator_id, name)
+
+        image_ids = []
+        creator_members = {}
+        for image_id, creator_id in cursor.execute("SELECT image_id, creator_id FROM images ORDER BY image_id"):
+            image_ids.append(image_id)
+            self.image_creator[image_id] = creator_id
+            creator_members.setdefault(creator_id, []).append(image_id)
+        self.all_images = ids_to_bits(image_ids)
+        universe_size = image_ids[-1] + 1 if image_ids else 1
+
+        tag_members = {}
+        image_tags = {}
+        for image_id, tag_id in cursor.execute("SELECT image_id, tag_id FROM image_tags ORDER BY tag_id, image_id"):
+            tag_members.setdefault(tag_id, []).append(image_id)
+            image_tags.setdefault(image_id, []).append(tag_id)
+        self.image_tags = {image_id: tuple(tag_ids) for image_id, tag_ids in image_tags.items()}
+
+        for members, target in ((tag_members, self.tags), (creator_members, self.creators)):
+            for key, ids in members.items():
+                image_set = ImageSet(ids)
+                image_set.compact(universe_size)
+                target[key] = image_set
+        self.load_rules(cursor)
+
+    # Aliases and the implication closure are small, so they are reloaded whole when they change
+    def load_rules(self, cursor):
+        self.alias_tags = {}
+        for alias_name, tag_id in cursor.execute("SELECT alias_name, tag_id FROM tag_aliases"):
+            self.alias_tags.setdefault(alias_name.casefold(), set()).add(tag_id)
+        self.implied_by = {}
+        for tag_id, ancestor_id in cursor.execute("SELECT tag_id, ancestor_id FROM tag_closure"):
+            self.implied_by.setdefault(ancestor_id, set()).add(tag_id)
+
+    def universe_size(self):
+        return self.all_images.bit_length()
+
+    # Point a name at an id, replacing the id's previous name (None removes it)
+    def set_name(self, ids_by_name, names_by_id, key, name):
+        old_name = names_by_id.pop(key, None)
+        if old_name is not None:
+            ids_by_name[old_name].discard(key)
+            if not ids_by_name[old_name]:
+                del ids_by_name[old_name]
+        if name is not None:
+            names_by_id[key] = name.casefold()
+            ids_by_name.setdefault(name.casefold(), set()).add(key)
+
+    # Re-read the rows touched by a ChangeSet and patch the index
+    def update(self, cursor, changes):
+        for tag_id in changes.tags:
+            row = cursor.execute("SELECT tag_name FROM tags WHERE tag_id = ?", (tag_id,)).fetchone()
+            self.set_name(self.tag_ids, self.tag_names, tag_id, row[0] if row else None)
+            if not row:
+                self.tags.pop(tag_id, None)
+
+        for creator_id in changes.creators:
+            row = cursor.execute("SELECT creator_name FROM creators WHERE creator_id = ?", (creator_id,)).fetchone()
+            self.set_name(self.creator_ids, self.creator_names, creator_id, row[0] if row else None)
+            if not row:
+                self.creators.pop(creator_id, None)
+
+        for image_id in changes.images:
+            self.update_image(cursor, image_id)
+
+        if changes.tag_rules:
+            self.load_rules(cursor)
+
+    def update_image(self, cursor, image_id):
+        # Remove the image from everything it was indexed under
+        for tag_id in self.image_tags.pop(image_id, ()):
+            if tag_id in self.tags:
+                self.tags[tag_id].discard(image_id)
+        creator_id = self.image_creator.pop(image_id, None)
+        if creator_id in self.creators:
+            self.creators[creator_id].discard(image_id)
+        self.all_images &= ~(1 << image_id)
+
+        row = cursor.execute("SELECT creator_id FROM images WHERE image_id = ?", (image_id,)).fetchone()
+        if not row:
+            return
+
+        # Index the image under its current creator and tags
+        self.all_images |= 1 << image_id
+        universe_size = self.universe_size()
+        self.image_creator[image_id] = row[0]
+        self.creators.setdefault(row[0], ImageSet()).add(image_id, universe_size)
+        tag_ids = tuple(tag[0] for tag in cursor.execute("SELECT tag_id FROM image_tags WHERE image_id = ?", (image_id,)))
+        if tag_ids:
+            self.image_tags[image_id] = tag_ids
+        for tag_id in tag_ids:
+            self.tags.setdefault(tag_id, ImageSet()).add(image_id, universe_size)
+
+    # Names match case-insensitively, so a term can cover several ids
+    def term_bits(self, sets, ids_by_name, name):
+        bits = 0
+        for key in ids_by_name.get(name.casefold(), ()):
+            if key in sets:
+                bits |= sets[key].as_bits()
+        return bits
+
+    # A tag term also matches its aliases and every tag implying it, read from the closure
+    def tag_bits(self, name):
+        tag_ids = self.tag_ids.get(name.casefold(), set()) | self.alias_tags.get(name.casefold(), set())
+        bits = 0
+        for tag_id in tag_ids.union(*(self.implied_by.get(tag_id, ()) for tag_id in tag_ids)):
+            if tag_id in self.tags:
+                bits |= self.tags[tag_id].as_bits()
+        return bits
+
+    # Images whose column compares true with a value; column and operator come from the parser
+    def attribute_bits(self, cursor, column, operator, value):
+        if cursor is None:
+            raise QueryError("Searching by {} needs the database".format(column))
+        cursor.execute("SELECT image_id FROM images WHERE {} {} ?".format(column, operator), (value,))
+        return ids_to_bits([row[0] for row in cursor.fetchall()])
+
+    # Evaluate a parsed query to a bitset of matching image ids; terms on image details
+    # are read through cursor
+    def evaluate(self, node, cursor=None):
+        kind = node[0]
+        if kind == "tag":
+            return self.tag_bits(node[1])
+        if kind == "creator":
+            return self.term_bits(self.creators, self.creator_ids, node[1])
+        if kind == "attribute":
+            return self.attribute_bits(cursor, *node[1:])
+        if kind == "not":
+            return self.all_images & ~self.evaluate(node[1], cursor)
+        if kind == "and":
+            left = self.evaluate(node[1], cursor)
+            return left & self.evaluate(node[2], cursor) if left else 0
+        if kind == "or":
+            return self.evaluate(node[1], cursor) | self.evaluate(node[2], cursor)
+        raise QueryError("Unknown query node {}".format(kind))
+
+    # Parse and evaluate a query, returning matching image ids in ascending order
+    def search(self, query, cursor=None):
+        return bits_to_ids(self.evaluate(parse_query(query), cursor))
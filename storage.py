@@ -0,0 +1,91 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Storage backends for copied images
+STORAGE_FLAT = "flat"      # every file in one folder, renamed with _1, _2, ... on collisions
+STORAGE_HASHED = "hashed"  # files named by content hash in hash-prefix subfolders
+# Bytes read per chunk while copying and hashing
+COPY_CHUNK_SIZE = 1024 * 1024
+# Number of two-character hash prefixes used as nested subfolders
+HASH_SHARD_DEPTH = 2
+
+# Claim a free filename in the destination folder; safe to call from several threads
+def reserve_destination(directory, filename):
+    filename_noext, extension = os.path.splitext(filename)
+    temp_filename = filename
+    counter = 1
+    while True:
+        final_destination = os.path.join(directory, temp_filename)
+        try:
+            # O_EXCL makes creating the placeholder atomic, so two copies never share a name
+            os.close(os.open(final_destination, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return final_destination
+        except FileExistsError:
+            temp_filename = "{}_{}{}".format(filename_noext, counter, extension)
+            counter += 1
+
+# Copy a file into an open destination, hashing it in the same pass
+def stream_copy(filepath, destination_file):
+    hasher = hashlib.sha256()
+    with open(filepath, "rb") as source_file:
+        while True:
+            chunk = source_file.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            destination_file.write(chunk)
+    return hasher.hexdigest()
+
+# Path of a stored file in the hashed layout, e.g. images/ab/cd/abcd...ef.jpg
+def hashed_path(directory, content_hash, extension):
+    shards = [content_hash[2 * level:2 * level + 2] for level in range(HASH_SHARD_DEPTH)]
+    return os.path.join(directory, *shards, content_hash + extension.lower())
+
+def store_flat(filepath, directory):
+    final_destination = reserve_destination(directory, os.path.basename(filepath))
+    try:
+        with open(final_destination, "wb") as destination_file:
+            content_hash = stream_copy(filepath, destination_file)
+        shutil.copystat(filepath, final_destination)
+    except OSError:
+        os.remove(final_destination)
+        raise
+    return final_destination, content_hash, True
+
+def store_hashed(filepath, directory):
+    # Copy to a temporary name first; the final name is only known once the hash is
+    temp_fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+    try:
+        with os.fdopen(temp_fd, "wb") as destination_file:
+            content_hash = stream_copy(filepath, destination_file)
+        final_destination = hashed_path(directory, content_hash, os.path.splitext(filepath)[1])
+
+        # Identical content is already stored: keep the existing file
+        if os.path.exists(final_destination):
+            os.remove(temp_path)
+            return final_destination, content_hash, False
+
+        os.makedirs(os.path.dirname(final_destination), exist_ok=True)
+        shutil.copystat(filepath, temp_path)
+        os.replace(temp_path, final_destination)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return final_destination, content_hash, True
+
+# Size of a stored file, or None if it can't be read
+def stored_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+# Copy a file into the image folder; returns (path, sha256 hex digest, whether a new file was written)
+def store_file(filepath, directory, storage_mode=STORAGE_FLAT):
+    os.makedirs(directory, exist_ok=True)
+    if storage_mode == STORAGE_HASHED:
+        return store_hashed(filepath, directory)
+    return store_flat(filepath, directory)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# An empty catalog in a temporary folder, which is also the working directory so stored
+# image paths stay relative like the app's
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    import repository
+
+    monkeypatch.chdir(tmp_path)
+    conn = repository.connect(str(tmp_path / "catalog.db"), report=lambda line: None)
+    yield conn
+    conn.close()
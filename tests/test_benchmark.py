@@ -0,0 +1,67 @@
+import json
+
+import pytest
+from PIL import Image
+
+import benchmark
+import repository
+
+@pytest.fixture
+def generate(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    # A small generated catalog, opened for reading
+    def generate(name="generated.db", seed=1, images=300):
+        benchmark.generate_catalog(name, "files", images=images, tags=200, creators=20, files=3,
+                                   tags_per_image=4, zipf=1.1, seed=seed)
+        return repository.open_connection(name)
+
+    return generate
+
+def dump(conn):
+    return [conn.execute("SELECT * FROM {} ORDER BY 1, 2".format(table)).fetchall()
+            for table in ("creators", "tags", "images", "image_tags")]
+
+def test_generated_catalog_is_reproducible(generate):
+    first = generate("first.db")
+    assert dump(generate("second.db")) == dump(first)
+    assert dump(generate("other.db", seed=2)) != dump(first)
+
+def test_generated_catalog_is_complete(generate, catalog):
+    conn = generate()
+    assert conn.execute("SELECT COUNT(*) FROM images").fetchone() == (300,)
+    # The triggers dropped for the bulk load are back as a migrated catalog has them
+    triggers = "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' ORDER BY name"
+    assert conn.execute(triggers).fetchall() == catalog.execute(triggers).fetchall()
+    assert conn.execute('''SELECT COUNT(*) FROM tags AS t WHERE use_count !=
+                           (SELECT COUNT(*) FROM image_tags AS it WHERE it.tag_id = t.tag_id)''').fetchone() == (0,)
+    assert conn.execute("SELECT COUNT(*) FROM images_fts").fetchone() == (300,)
+    # Tag usage falls off with the tag id
+    counts = [row[0] for row in conn.execute("SELECT use_count FROM tags ORDER BY tag_id")]
+    assert counts[0] == max(counts) and sum(counts[:20]) > sum(counts[-100:])
+    # Every row points at a readable dummy file
+    for (path,) in conn.execute("SELECT DISTINCT directory_path FROM images"):
+        with Image.open(path) as image:
+            assert image.size == (1, 1)
+
+def test_main_writes_and_compares_results(generate, capsys):
+    assert benchmark.main(["--scale", "10k", "--tags", "300", "--creators", "20", "--files", "2",
+                           "--repeat", "2", "--output", "first.json"]) == 0
+    with open("first.json", encoding="utf-8") as results:
+        report = json.load(results)
+    assert report["catalog"]["images"] == benchmark.SCALES["10k"]
+    assert {"image_page.first.filename", "image_page.deep.date_added", "image_page.date_range", "timeline.months",
+            "insert.tag_resolution", "edit.tag_diff", "fetch_image", "autocomplete.keystroke_ranked",
+            "store_file.collisions"} <= set(report["results"])
+    assert all(result["repeat"] == 2 and result["min_ms"] <= result["median_ms"] <= result["max_ms"]
+               for result in report["results"].values())
+
+    # Reusing the catalog skips generating it, and the timed writes are rolled back
+    capsys.readouterr()
+    assert benchmark.main(["--reuse", "--repeat", "1", "--compare", "first.json"]) == 0
+    output = capsys.readouterr()
+    assert json.loads(output.out)["results"].keys() == report["results"].keys()
+    assert "Generated" not in output.err and "fetch_image: " in output.err
+    conn = repository.open_connection("benchmark_database.db")
+    assert conn.execute("SELECT COUNT(*) FROM images").fetchone() == (benchmark.SCALES["10k"],)
+    conn.close()
@@ -0,0 +1,78 @@
+import repository
+from repository import CHANGES_RELOAD, ChangeFeed
+
+def add_images(conn, count):
+    cursor = conn.cursor()
+    for number in range(count):
+        repository.add_image(cursor, "images/{}.png".format(number), "alice", tags=["cat"])
+    conn.commit()
+    return cursor
+
+def logged(conn):
+    return conn.execute("SELECT COUNT(*) FROM change_log").fetchone()[0]
+
+def test_feed_sees_other_connections(catalog, tmp_path):
+    cursor = add_images(catalog, 3)
+    other = repository.open_connection(str(tmp_path / "catalog.db"))
+    feed = ChangeFeed(reload_threshold=100)
+    feed.start(other.cursor())
+    assert feed.poll(other.cursor()) is None
+
+    changes = repository.tag_images(cursor, [1, 2], add=["night"], remove=["cat"])
+    cursor.execute("UPDATE creators SET creator_name = 'alicia'")
+    catalog.commit()
+    seen = feed.poll(other.cursor())
+    assert seen.images == {1, 2}
+    assert seen.tag_counts == changes.tag_counts
+    assert seen.creators == {1}
+    assert feed.poll(other.cursor()) is None
+
+    # Too many changes at once are shown by reloading
+    repository.tag_images(cursor, [1, 2, 3], add=["sky"])
+    for number in range(50):
+        cursor.execute("UPDATE images SET source_url = ? WHERE image_id = 3", (str(number),))
+    catalog.commit()
+    assert ChangeFeed(reload_threshold=10).poll(other.cursor()) is CHANGES_RELOAD
+    other.close()
+
+def test_bulk_writes_log_each_image_once(catalog):
+    cursor = add_images(catalog, 40)
+    before = logged(catalog)
+    repository.tag_images(cursor, range(1, 41), add=["night", "sky", "moon"], remove=["cat"])
+    catalog.commit()
+    # An image and a tag's count each, rather than one per link added or removed (160), and the new tags
+    assert logged(catalog) - before == 40 + 4 + 3
+    # Single edits still go through the triggers
+    before = logged(catalog)
+    repository.edit_image(cursor, 1, "alice", "", ["night"], None, "")
+    assert logged(catalog) - before == 1 + 2 * 2
+
+def test_prune_change_log(catalog, monkeypatch):
+    monkeypatch.setattr(repository, "CHANGE_LOG_PRUNE_SLACK", 10)
+    cursor = add_images(catalog, 5)
+    total = logged(catalog)
+    # Within the slack nothing is deleted
+    repository.prune_change_log(cursor, keep=total - 10)
+    assert logged(catalog) == total
+    repository.prune_change_log(cursor, keep=total - 11)
+    assert logged(catalog) == total - 11
+
+# Polling prunes too, and an instance that fell behind the pruned rows reloads
+def test_poll_prunes_change_log(catalog, tmp_path):
+    cursor = add_images(catalog, 1)
+    other = repository.open_connection(str(tmp_path / "catalog.db"))
+    behind = ChangeFeed()
+    behind.start(other.cursor())
+    feed = ChangeFeed()
+    feed.start(other.cursor())
+    cursor.executemany("INSERT INTO change_log (kind, row_id) VALUES ('images', 1)",
+                       [()] * (repository.CHANGE_LOG_KEEP_ROWS + repository.CHANGE_LOG_PRUNE_SLACK))
+    catalog.commit()
+    assert feed.poll(other.cursor()) is CHANGES_RELOAD
+    other.commit()
+    assert logged(catalog) == repository.CHANGE_LOG_KEEP_ROWS
+    cursor.execute("UPDATE images SET source_url = 'x'")
+    catalog.commit()
+    assert feed.poll(other.cursor()).images == {1}
+    assert behind.poll(other.cursor()) is CHANGES_RELOAD
+    other.close()
@@ -0,0 +1,84 @@
+import csv
+import os
+import subprocess
+import sys
+
+import pytest
+from PIL import Image
+
+import cli
+
+@pytest.fixture
+def run(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    capsys.readouterr()
+
+    # Run a command, returning its exit code and the lines it printed
+    def run(*argv):
+        code = cli.main(list(argv))
+        return code, capsys.readouterr().out.splitlines()
+
+    return run
+
+def make_image(tmp_path, name, color):
+    path = str(tmp_path / name)
+    Image.new("RGB", (64, 48), color).save(path)
+    return path
+
+def test_add_tag_and_search(tmp_path, run):
+    red = make_image(tmp_path, "red.png", "red")
+    blue = make_image(tmp_path, "blue.png", "blue")
+    assert run("add", red, "--creator", "alice", "--tags", "cat, night", "--uploaded", "2024-05-31") == (0, ["1"])
+    assert run("add", blue, "--creator", "bob", "--tags", "dog") == (0, ["2"])
+    # The same content again is refused unless asked for
+    assert run("add", red, "--creator", "alice") == (1, [])
+
+    assert run("tag", "1", "2", "--add", "pet", "--remove", "night") == (0, [])
+    assert run("tag", "1", "3", "--add", "pet") == (1, [])
+    assert run("search", "pet AND NOT dog") == (0, ["1\timages/red.png"])
+    assert run("search", "creator:bob OR cat", "--limit", "1") == (0, ["1\timages/red.png"])
+    assert run("search", "--text", "blue") == (0, ["2\timages/blue.png"])
+    assert run("search", "cat AND (") == (2, [])
+    assert run("tags") == (0, ["2\tpet", "1\tcat", "1\tdog", "0\tnight"])
+    assert run("tags", "--prune", "--limit", "2") == (0, ["2\tpet", "1\tcat"])
+    assert run("tags") == (0, ["2\tpet", "1\tcat", "1\tdog"])
+
+    assert run("export", "--output", "images.csv") == (0, [])
+    with open("images.csv", newline="", encoding="utf-8") as file:
+        rows = list(csv.DictReader(file))
+    assert [(row["image_id"], row["creator"], row["date_uploaded"]) for row in rows] == [
+        ("1", "alice", "2024-05-31"), ("2", "bob", "")]
+
+def test_delete_and_restore(tmp_path, run):
+    run("add", make_image(tmp_path, "red.png", "red"), "--creator", "alice", "--tags", "cat")
+    code, lines = run("delete", "1", "5")
+    assert code == 1 and lines == ["1"]
+    assert run("search", "cat") == (0, [])
+    code, lines = run("trash")
+    assert code == 0 and [line.split("\t")[::2] for line in lines] == [["1", "1"]]
+    assert run("trash", "--restore", "1") == (0, [])
+    assert run("search", "cat") == (0, ["1\timages/red.png"])
+    assert run("trash", "--restore", "1") == (1, [])
+
+def test_bad_arguments(run):
+    assert run("tag", "1") == (2, [])
+    with pytest.raises(SystemExit):
+        run("add", "missing.png", "--creator", "alice", "--uploaded", "not a date")
+
+# Searching from the command line loads neither the GUI nor the imaging packages
+def test_search_imports_no_gui(tmp_path, run):
+    run("tags")
+    code = ("import sys; import cli; cli.main(['search', 'cat']); "
+            "print(sorted(set(sys.modules) & {'tkinter', 'ttkwidgets', 'tkcalendar', 'PIL', 'numpy'}))")
+    output = subprocess.run([sys.executable, "-c", code], cwd=str(tmp_path), check=True, capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONPATH=os.path.dirname(cli.__file__)))
+    assert output.stdout.splitlines() == ["[]"]
+
+def test_check_and_fix(tmp_path, run):
+    run("add", make_image(tmp_path, "red.png", "red"), "--creator", "alice")
+    os.makedirs("images/sub")
+    os.rename("images/red.png", "images/sub/red.png")
+    moved = ["moved\t1\t" + os.path.join("images", "sub", "red.png")]
+    assert run("check") == (1, moved)
+    assert run("check", "--fix") == (0, moved)
+    assert run("check", "--incremental") == (0, [])
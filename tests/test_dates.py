@@ -0,0 +1,58 @@
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from dates import day_range, normalize_date, normalize_timestamp, parse_date, period_days
+
+@pytest.mark.parametrize("value, expected", [
+    ("2024-05-01", date(2024, 5, 1)),
+    ("2024-05-01T10:00:00Z", date(2024, 5, 1)),
+    ("05/02/24", date(2024, 5, 2)),
+    ("05/02/2024", date(2024, 5, 2)),
+    ("02.05.24", date(2024, 5, 2)),
+    (" 2024/05/02 ", date(2024, 5, 2)),
+    ("31/05/2024", date(2024, 5, 31)),
+])
+def test_parse_date(value, expected):
+    assert parse_date(value) == expected
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ("", None),
+    ("2024-05-01 10:00:00.123456", "2024-05-01T10:00:00Z"),
+    ("2024-05-01T12:00:00+02:00", "2024-05-01T10:00:00Z"),
+    (datetime(2024, 5, 1, 10, tzinfo=timezone(timedelta(hours=-4))), "2024-05-01T14:00:00Z"),
+    (datetime(2024, 5, 1, 10), "2024-05-01T10:00:00Z"),
+    (date(2024, 5, 1), "2024-05-01T00:00:00Z"),
+    ("05/02/24", "2024-05-02T00:00:00Z"),
+])
+def test_normalize_timestamp(value, expected):
+    assert normalize_timestamp(value) == expected
+
+def test_normalize_date():
+    assert normalize_date("05/02/24") == "2024-05-02"
+    assert normalize_date(date(2024, 5, 2)) == "2024-05-02"
+    assert normalize_date("") is None
+    for normalize in (normalize_date, normalize_timestamp):
+        with pytest.raises(ValueError):
+            normalize("someday")
+
+def test_day_range():
+    # Timestamps of the last day sort below the upper bound
+    lower, upper = day_range("2024-05-01", "05/31/24")
+    assert (lower, upper) == ("2024-05-01", "2024-06-01")
+    assert lower <= "2024-05-01" < "2024-05-31T23:59:59Z" < upper
+    assert day_range(None, "2024-12-31") == (None, "2025-01-01")
+    assert day_range() == (None, None)
+    assert day_range("2024-05-01", "2024-05-01") == ("2024-05-01", "2024-05-02")
+    with pytest.raises(ValueError):
+        day_range("2024-05-02", "2024-05-01")
+
+@pytest.mark.parametrize("key, expected", [
+    ("2024", ("2024-01-01", "2024-12-31")),
+    ("2024-02", ("2024-02-01", "2024-02-29")),
+    ("2024-12", ("2024-12-01", "2024-12-31")),
+    ("2024-05-07", ("2024-05-07", "2024-05-07")),
+])
+def test_period_days(key, expected):
+    assert period_days(key) == expected
@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+
+from dbworker import DatabaseWorker
+from diagnostics import Diagnostics
+
+# Stands in for the Tk root, running the callbacks scheduled with after() on demand
+class FakeRoot:
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, ms, callback):
+        self.scheduled.append(callback)
+
+    # Deliver everything submitted so far, as the mainloop would
+    def run(self, worker):
+        while self.scheduled:
+            # Work runs in order, so once this returns everything submitted before it has finished
+            worker.call(lambda cursor: None)
+            self.scheduled.pop(0)()
+
+@pytest.fixture
+def make_worker(catalog, tmp_path):
+    workers = []
+
+    def make_worker(**options):
+        worker = DatabaseWorker(FakeRoot(), str(tmp_path / "catalog.db"), **options)
+        workers.append(worker)
+        return worker
+
+    yield make_worker
+    for worker in workers:
+        worker.shutdown()
+
+def add_creator(cursor, name):
+    cursor.execute("INSERT INTO creators (creator_name) VALUES (?)", (name,))
+    return cursor.lastrowid
+
+def fail(cursor):
+    cursor.execute("INSERT INTO creators (creator_name) VALUES ('lost')")
+    raise ValueError("failed")
+
+def creator_names(cursor):
+    return [row[0] for row in cursor.execute("SELECT creator_name FROM creators ORDER BY creator_id")]
+
+def test_work_runs_in_order_off_the_calling_thread(catalog, make_worker):
+    worker = make_worker()
+    results = []
+    threads = set()
+    for name in ("alice", "bob"):
+        worker.submit(add_creator, name, callback=results.append)
+    worker.submit(lambda cursor: threads.add(threading.get_ident()))
+    worker.root.run(worker)
+    assert results == [1, 2]
+    assert threads == {worker.thread.ident} != {threading.get_ident()}
+    # Each piece of work is committed, so other connections see it
+    assert creator_names(catalog.cursor()) == ["alice", "bob"]
+    assert worker.outstanding == 0 and not worker.polling
+
+def test_failed_work_is_rolled_back(catalog, make_worker):
+    errors = []
+    worker = make_worker(on_error=lambda error: errors.append(("default", str(error))))
+    worker.submit(fail, callback=errors.append, errback=lambda error: errors.append(("own", str(error))))
+    worker.submit(fail)
+    worker.submit(add_creator, "alice")
+    worker.root.run(worker)
+    assert errors == [("own", "failed"), ("default", "failed")]
+    assert creator_names(catalog.cursor()) == ["alice"]
+    with pytest.raises(ValueError):
+        worker.call(fail)
+
+def test_cancelled_work_is_skipped(make_worker):
+    worker = make_worker()
+    results = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def block(cursor):
+        started.set()
+        release.wait()
+
+    worker.submit(block)
+    started.wait()
+    worker.submit(add_creator, "alice", callback=results.append).cancel()
+    release.set()
+    worker.root.run(worker)
+    assert results == [] and worker.outstanding == 0
+    assert worker.call(creator_names) == []
+
+def test_diagnostics_time_the_work(make_worker):
+    diagnostics = Diagnostics(enabled=True)
+    worker = make_worker(diagnostics=diagnostics)
+    worker.submit(add_creator, "alice")
+    worker.root.run(worker)
+    snapshot = diagnostics.snapshot()
+    assert snapshot["operations"]["db.run.add_creator"]["count"] == 1
+    assert snapshot["operations"]["db.wait.add_creator"]["count"] == 1
+    assert "INSERT INTO creators (creator_name) VALUES (?)" in snapshot["statements"]
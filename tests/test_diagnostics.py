@@ -0,0 +1,57 @@
+import threading
+
+from diagnostics import Diagnostics, LatencyHistogram, normalize_statement
+
+def test_normalize_statement():
+    assert normalize_statement("SELECT *\n   FROM images WHERE image_id IN (1, 2,3) AND filename = 'it''s.png'") == \
+        "SELECT * FROM images WHERE image_id IN (N, N,N) AND filename = ?"
+    assert normalize_statement("INSERT INTO t VALUES (?, ?, ?)") == normalize_statement("INSERT INTO t VALUES (?,?)")
+    # Trigger comments keep the quoted table names
+    assert normalize_statement("-- TRIGGER 'images_fts'") == "-- TRIGGER 'images_fts'"
+
+def test_percentile():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(0.5) == 0.0
+    for ms in (0.2, 0.2, 0.2, 3, 8000):
+        histogram.add(ms)
+    assert histogram.percentile(0.5) == 0.25
+    assert histogram.percentile(0.8) == 5
+    # The open last bucket reports the slowest sample
+    assert histogram.percentile(0.95) == 8000
+    single = LatencyHistogram()
+    single.add(30)
+    assert single.percentile(0.5) == 30
+    assert histogram.summary()["buckets"]["inf"] == 1
+
+def test_begin_and_end():
+    diagnostics = Diagnostics(enabled=True)
+    diagnostics.end("search")
+    assert diagnostics.snapshot()["operations"] == {}
+    diagnostics.begin("search")
+    diagnostics.end("search")
+    diagnostics.end("search")
+    assert diagnostics.snapshot()["operations"]["search"]["count"] == 1
+
+    # Actions begun and ended from several threads are each timed once
+    def run(number):
+        for _ in range(200):
+            diagnostics.begin("action{}".format(number))
+            diagnostics.end("action{}".format(number))
+
+    threads = [threading.Thread(target=run, args=(number,)) for number in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    operations = diagnostics.snapshot()["operations"]
+    assert [operations["action{}".format(number)]["count"] for number in range(4)] == [200] * 4
+    assert diagnostics.pending == {}
+
+# Stalls go in the report, not to the console
+def test_record_stall(capsys):
+    diagnostics = Diagnostics(enabled=True)
+    diagnostics.record_stall(300)
+    snapshot = diagnostics.snapshot()
+    assert [stall["ms"] for stall in snapshot["stalls"]] == [300]
+    assert snapshot["operations"]["mainloop_stall"]["count"] == 1
+    assert capsys.readouterr().out == ""
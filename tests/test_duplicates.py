@@ -0,0 +1,82 @@
+import random
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import duplicates
+import repository
+from duplicates import DuplicateReport, HashIndex, chunk_widths, dhash, to_signed, to_unsigned
+
+# Random hashes with a few near copies of each, flipping up to flips bits
+def make_index(count, flips, seed=1):
+    generator = random.Random(seed)
+    hashes = []
+    for _ in range(count):
+        value = generator.getrandbits(64)
+        hashes.append(value)
+        for _ in range(2):
+            for bit in generator.sample(range(64), generator.randint(0, flips)):
+                value ^= 1 << bit
+            hashes.append(value)
+    index = HashIndex()
+    index.ids = np.arange(1, len(hashes) + 1, dtype=np.int64)
+    index.hashes = np.array(hashes, dtype=np.uint64)
+    return index, hashes
+
+def brute_force_pairs(hashes, max_distance):
+    return {(first + 1, second + 1): bin(hashes[first] ^ hashes[second]).count("1")
+            for first in range(len(hashes)) for second in range(first + 1, len(hashes))
+            if bin(hashes[first] ^ hashes[second]).count("1") <= max_distance}
+
+def test_chunk_widths():
+    assert chunk_widths(6) == [10, 9, 9, 9, 9, 9, 9]
+    assert sum(chunk_widths(100)) == 64
+
+@pytest.mark.parametrize("group_limit", [duplicates.PAIRWISE_GROUP_LIMIT, 2])
+@pytest.mark.parametrize("max_distance", [0, 3, 6])
+def test_duplicate_pairs_match_brute_force(monkeypatch, group_limit, max_distance):
+    monkeypatch.setattr(duplicates, "PAIRWISE_GROUP_LIMIT", group_limit)
+    index, hashes = make_index(60, 8)
+    assert index.duplicate_pairs(max_distance) == brute_force_pairs(hashes, max_distance)
+
+def test_query_and_signed_round_trip():
+    index, hashes = make_index(20, 4)
+    found = index.query(hashes[0], 4)
+    assert found[0] == (1, 0)
+    assert [distance for _, distance in found] == sorted(distance for _, distance in found)
+    assert HashIndex().query(hashes[0]) == []
+    for value in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+        assert to_unsigned(to_signed(value)) == value
+        assert -(1 << 63) <= to_signed(value) < 1 << 63
+
+def make_image(path, size):
+    image = Image.radial_gradient("L").resize(size).convert("RGB")
+    image.save(str(path))
+    return str(path)
+
+def test_resized_copies_are_near_duplicates(tmp_path):
+    original = dhash(make_image(tmp_path / "a.png", (256, 256)))
+    smaller = dhash(make_image(tmp_path / "b.jpg", (100, 100)))
+    assert bin(original ^ smaller).count("1") <= duplicates.NEAR_DUPLICATE_DISTANCE
+    with pytest.raises(OSError):
+        dhash(str(tmp_path / "missing.png"))
+
+def test_report_backfills_hashes(catalog, tmp_path):
+    cursor = catalog.cursor()
+    repository.add_image(cursor, make_image(tmp_path / "a.png", (256, 256)), "alice")
+    repository.add_image(cursor, make_image(tmp_path / "b.jpg", (100, 100)), "alice")
+    repository.add_image(cursor, str(tmp_path / "missing.png"), "alice")
+    catalog.commit()
+    report = DuplicateReport(str(tmp_path / "catalog.db"))
+    report.run()
+    assert report.progress.get() == ("hashed", 2)
+    kind, pairs = report.progress.get()
+    assert kind == "done" and list(pairs) == [(1, 2)]
+    assert catalog.execute("SELECT image_id FROM images WHERE phash IS NULL").fetchall() == [(3,)]
+
+    index = HashIndex()
+    index.build(cursor)
+    cursor.execute("UPDATE images SET phash = NULL WHERE image_id = 2")
+    index.update(cursor, [2])
+    assert index.duplicate_pairs() == {}
@@ -0,0 +1,76 @@
+import os
+
+import pytest
+from PIL import Image
+
+import repository
+from importer import BulkImporter, iter_image_files
+from storage import STORAGE_FLAT, STORAGE_HASHED
+
+def make_image(folder, name, color, size=(40, 30)):
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, name)
+    Image.new("RGB", size, color).save(path)
+    return path
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = str(tmp_path / "incoming")
+    make_image(folder, "red.png", "red")
+    make_image(os.path.join(folder, "alice"), "blue.png", "blue", size=(80, 20))
+    # The same content twice within the import
+    make_image(os.path.join(folder, "alice"), "copy.PNG", "blue", size=(80, 20))
+    make_image(os.path.join(folder, "bob", "old"), "green.jpg", "green")
+    with open(os.path.join(folder, "notes.txt"), "w") as notes:
+        notes.write("not an image")
+    return folder
+
+# Run the import on the test's thread and collect its progress messages
+def run_import(importer):
+    importer.run()
+    messages = []
+    while not importer.progress.empty():
+        messages.append(importer.progress.get())
+    return messages
+
+def test_iter_image_files(folder):
+    assert sorted(os.path.relpath(path, folder) for path in iter_image_files(folder)) == [
+        os.path.join("alice", "blue.png"), os.path.join("alice", "copy.PNG"),
+        os.path.join("bob", "old", "green.jpg"), "red.png"]
+    assert list(iter_image_files(os.path.join(folder, "missing"))) == []
+
+@pytest.mark.parametrize("storage_mode", [STORAGE_FLAT, STORAGE_HASHED])
+def test_bulk_import(catalog, folder, storage_mode):
+    cursor = catalog.cursor()
+    # Content already catalogued is skipped
+    path, content_hash, _, _ = repository.store_image(cursor, make_image("known", "red.png", "red"), "images", storage_mode)
+    repository.add_image(cursor, path, "carol", content_hash=content_hash)
+    repository.add_tag_alias(cursor, "kitty", "cat")
+    catalog.commit()
+
+    importer = BulkImporter("catalog.db", "images", folder, creator_name="dave", tags=["kitty", "night"],
+                            creator_from_folder=True, storage_mode=storage_mode)
+    messages = run_import(importer)
+    assert [message[0] for message in messages] == ["batch", "done"]
+    assert messages[-1] == ("done", 2)
+    assert importer.skipped == 2
+
+    rows = catalog.execute('''SELECT i.image_id, c.creator_name, i.width, i.height, i.image_format, i.file_size,
+                                     i.phash IS NOT NULL, i.directory_path FROM images AS i
+                              JOIN creators AS c ON i.creator_id = c.creator_id WHERE i.image_id > 1
+                              ORDER BY c.creator_name''').fetchall()
+    assert [row[1:5] for row in rows] == [("alice", 80, 20, "PNG"), ("old", 40, 30, "JPEG")]
+    assert all(row[5] == os.path.getsize(row[7]) and row[6] for row in rows)
+    assert messages[0][2].images == {row[0] for row in rows}
+    # Copies of skipped content are removed, leaving only the catalogued files
+    stored = {os.path.join(root, name) for root, _, names in os.walk("images") for name in names}
+    assert stored == {row[0] for row in catalog.execute("SELECT directory_path FROM images")}
+    # Aliases resolve to their tag, and the new images are searchable at once
+    assert repository.tag_usage(cursor) == [("cat", 2), ("night", 2)]
+    assert catalog.execute("SELECT COUNT(*) FROM images_fts WHERE images_fts MATCH 'cat AND night'").fetchone() == (2,)
+
+def test_cancelled_import_writes_nothing(catalog, folder):
+    importer = BulkImporter("catalog.db", "images", folder, creator_name="dave")
+    importer.cancel()
+    assert run_import(importer) == [("done", 0)]
+    assert catalog.execute("SELECT COUNT(*) FROM images").fetchone() == (0,)
@@ -0,0 +1,85 @@
+import hashlib
+import os
+
+import pytest
+
+import repository
+from integrity import (CONTENT_MISMATCH, MISSING, MOVED, ORPHAN, ORPHAN_MIN_AGE_SECONDS, SIZE_MISMATCH,
+                       IntegrityScan, fix_problems)
+
+def write_file(path, content, age=0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(content)
+    if age:
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - int(age * 1e9)))
+    return path
+
+def add(cursor, path, content):
+    write_file(path, content)
+    return repository.add_image(cursor, path, "alice", content_hash=hashlib.sha256(content).hexdigest())
+
+# A catalog with one problem of each kind
+@pytest.fixture
+def scan(catalog):
+    cursor = catalog.cursor()
+    old = ORPHAN_MIN_AGE_SECONDS + 60
+    add(cursor, "images/ok.png", b"ok")
+    add(cursor, "images/sized.png", b"sized")
+    add(cursor, "images/changed.png", b"before")
+    add(cursor, "images/moved.png", b"moved")
+    add(cursor, "images/trashed.png", b"trashed")
+    repository.add_image(cursor, "images/gone.png", "alice")
+    cursor.execute("UPDATE images SET file_size = 99 WHERE directory_path = 'images/sized.png'")
+    # Catalogued before sizes were recorded
+    cursor.execute("UPDATE images SET file_size = NULL WHERE directory_path = 'images/ok.png'")
+    repository.delete_images(cursor, [5])
+    catalog.commit()
+    write_file("images/changed.png", b"after!")
+    os.rename("images/moved.png", write_file("images/sub/moved.png", b"moved", age=old))
+    write_file("images/old.png", b"old", age=old)
+    write_file("images/new.png", b"new")
+    write_file("images/.DS_Store", b"hidden", age=old)
+    return IntegrityScan(os.path.abspath("catalog.db"), "images")
+
+def test_scan_finds_each_problem(catalog, scan):
+    report = scan.scan(catalog)
+    assert sorted(report.rows()) == sorted([
+        (MOVED, 4, os.path.join("images", "sub", "moved.png")),
+        (MISSING, 6, "images/gone.png"),
+        (SIZE_MISMATCH, 2, os.path.join("images", "sized.png")),
+        (CONTENT_MISMATCH, 3, os.path.join("images", "changed.png")),
+        (ORPHAN, None, os.path.join("images", "old.png")),
+        (ORPHAN, None, os.path.join("images", "new.png"))])
+    assert report.problems() == 7 and (report.images, report.files) == (5, 7)
+    assert catalog.execute("SELECT file_size FROM images WHERE image_id = 1").fetchone() == (2,)
+
+    # Unchanged files aren't hashed again by an incremental scan
+    scan.incremental = True
+    assert scan.scan(catalog).hashed == 0
+    os.utime("images/changed.png")
+    assert scan.scan(catalog).hashed == 1
+
+def test_fix_problems(catalog, scan):
+    report = scan.scan(catalog)
+    changes, deleted = fix_problems(catalog.cursor(), report)
+    catalog.commit()
+    assert changes.images == {4}
+    assert deleted == [os.path.join("images", "old.png")]
+    assert catalog.execute("SELECT directory_path FROM images WHERE image_id = 4").fetchone() == (
+        os.path.join("images", "sub", "moved.png"),)
+    # Missing and mismatched images, and recent orphans, are left for the user
+    assert sorted(kind for kind, _, _ in scan.scan(catalog).rows()) == [
+        CONTENT_MISMATCH, MISSING, ORPHAN, SIZE_MISMATCH]
+    assert os.path.exists("images/new.png") and os.path.exists("images/trashed.png")
+
+def test_scan_in_background(catalog, scan):
+    scan.start()
+    scan.thread.join()
+    messages = []
+    while not scan.progress.empty():
+        messages.append(scan.progress.get())
+    assert messages[0] == ("walked", 7)
+    assert messages[-2] == ("hashed", 5, 5)
+    assert messages[-1][0] == "done" and messages[-1][1].problems() == 7
@@ -0,0 +1,59 @@
+import pytest
+from PIL import Image
+
+import metadata
+import repository
+from metadata import UNKNOWN_FORMAT, MetadataBackfill, read_metadata
+
+def make_photo(path, orientation=None, taken=None, model=None):
+    exif = Image.Exif()
+    if orientation:
+        exif[metadata.EXIF_ORIENTATION] = orientation
+    if model:
+        exif[metadata.EXIF_MODEL] = model
+    if taken:
+        exif.get_ifd(metadata.EXIF_IFD)[metadata.EXIF_DATE_TIME_ORIGINAL] = taken
+    Image.new("RGB", (60, 40), "red").save(str(path), exif=exif)
+    return str(path)
+
+def test_read_metadata(tmp_path):
+    png = tmp_path / "a.png"
+    Image.new("RGBA", (30, 20)).save(str(png))
+    assert read_metadata(str(png)) == {"width": 30, "height": 20, "image_format": "PNG",
+                                       "date_taken": None, "camera_model": None}
+
+    photo = make_photo(tmp_path / "b.jpg", orientation=6, taken="2024:05:01 10:00:00", model="Camera\0 ")
+    assert read_metadata(photo) == {"width": 40, "height": 60, "image_format": "JPEG",
+                                    "date_taken": "2024-05-01T10:00:00", "camera_model": "Camera"}
+    # Unreadable EXIF dates are dropped
+    assert read_metadata(make_photo(tmp_path / "c.jpg", orientation=1, taken="0000:00:00 00:00:00"))["date_taken"] is None
+
+    text = tmp_path / "notes.png"
+    text.write_text("not an image")
+    assert read_metadata(str(text))["image_format"] == UNKNOWN_FORMAT
+    with pytest.raises(OSError):
+        read_metadata(str(tmp_path / "missing.png"))
+
+def test_backfill(catalog, tmp_path, monkeypatch):
+    monkeypatch.setattr(metadata, "BACKFILL_BATCH_SIZE", 2)
+    cursor = catalog.cursor()
+    repository.add_image(cursor, make_photo(tmp_path / "a.jpg", orientation=8), "alice")
+    repository.add_image(cursor, str(tmp_path / "missing.png"), "alice")
+    repository.add_image(cursor, make_photo(tmp_path / "b.jpg"), "alice")
+    # Already read at ingest
+    repository.add_image(cursor, make_photo(tmp_path / "c.jpg"), "alice", metadata={"image_format": "PNG"})
+    catalog.commit()
+
+    backfill = MetadataBackfill(str(tmp_path / "catalog.db"))
+    backfill.run()
+    assert [backfill.progress.get() for _ in range(3)] == [("read", 1), ("read", 2), ("done", 2)]
+    assert catalog.execute("SELECT image_id, width, height, image_format FROM images ORDER BY image_id").fetchall() == [
+        (1, 40, 60, "JPEG"), (2, None, None, None), (3, 60, 40, "JPEG"), (4, None, None, "PNG")]
+    # The worker processes start from a fresh interpreter, not a fork of this threaded one
+    with metadata.metadata_pool() as pool:
+        assert pool._mp_context.get_start_method() == metadata.METADATA_START_METHOD
+
+    # Nothing left that can be read
+    backfill = MetadataBackfill(str(tmp_path / "catalog.db"))
+    backfill.run()
+    assert backfill.progress.get() == ("read", 0)
@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from prefix_index import PrefixIndex
+
+# A list that counts the items read from it, through indexing or slicing
+class CountingList(list):
+    reads = 0
+
+    def __getitem__(self, key):
+        result = list.__getitem__(self, key)
+        self.reads += len(result) if isinstance(key, slice) else 1
+        return result
+
+def ranked_index(count, seed=1):
+    rng = random.Random(seed)
+    names = ["tag{:05d}".format(number) for number in range(count)]
+    return PrefixIndex(names, weights={name: rng.randrange(1000) for name in names})
+
+# Heaviest first, ties alphabetical, without the index
+def expected(index, prefix, limit):
+    names = sorted((name for name in index if name.casefold().startswith(prefix.casefold())), key=str.casefold)
+    return sorted(names, key=lambda name: -index._weights.get(name, 0))[:limit]
+
+def test_unranked_matches_are_alphabetical():
+    index = PrefixIndex(["Cat", "camera", "dog", "cab"])
+    assert index.matches("ca") == ["cab", "camera", "Cat"]
+    assert index.matches("ca", exclude={"camera"}, limit=1) == ["cab"]
+    assert index.matches("x") == []
+
+def test_ranked_matches_follow_weights():
+    index = PrefixIndex(["cat", "car", "cab", "dog"], weights={"cat": 5, "car": 9, "dog": 7})
+    assert index.matches("ca") == ["car", "cat", "cab"]
+    assert index.matches("", limit=2) == ["car", "dog"]
+    index.set_weight("cab", 10)
+    assert index.matches("", limit=2) == ["cab", "car"]
+    index.discard("cab")
+    index.add("cow")
+    index.set_weight("cow", 8)
+    assert index.matches("c", exclude={"car"}) == ["cow", "cat"]
+
+@pytest.mark.parametrize("prefix", ["", "t", "tag0", "tag012", "tag01234", "zzz"])
+def test_ranked_matches_agree_with_sorting(prefix):
+    index = ranked_index(2000)
+    assert index.matches(prefix, limit=50) == expected(index, prefix, 50)
+
+def test_ranked_empty_prefix_does_not_visit_every_tag():
+    index = ranked_index(50000)
+    want = expected(index, "", 200)
+    index._entries = CountingList(index._entries)
+    index._ranked = CountingList(index._ranked)
+
+    assert index.matches("", limit=200) == want
+    assert index._entries.reads + index._ranked.reads < 1000
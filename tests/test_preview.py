@@ -0,0 +1,106 @@
+import threading
+from concurrent.futures import wait
+
+import pytest
+from PIL import Image
+
+import preview
+from preview import PreviewLoader, decode_preview
+
+# Stands in for the Tk root, running the callbacks scheduled with after() on demand
+class FakeRoot:
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, ms, callback):
+        self.scheduled.append(callback)
+
+    def run(self):
+        while self.scheduled:
+            self.scheduled.pop(0)()
+
+# PhotoImage needs a display; the tests only look at what it was made from
+class FakePhoto:
+    def __init__(self, image):
+        self.size = image.size
+
+def make_image(tmp_path, name, size=(640, 480), **options):
+    path = str(tmp_path / name)
+    Image.new("RGB", size, "red").save(path, **options)
+    return path
+
+def test_decode_preview(tmp_path):
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    rotated = decode_preview(make_image(tmp_path, "a.jpg", (1600, 1200), exif=exif))
+    assert rotated.size == (240, 320) and rotated.mode == "RGB"
+    palette = str(tmp_path / "b.gif")
+    Image.new("P", (100, 50)).save(palette)
+    assert decode_preview(palette).mode == "RGB"
+    assert decode_preview(palette, (40, 40)).size == (40, 20)
+
+# Decodes wait until released, so the tests decide when they finish
+@pytest.fixture
+def loader(monkeypatch):
+    monkeypatch.setattr(preview.ImageTk, "PhotoImage", FakePhoto)
+    release = threading.Event()
+    decoded = []
+
+    def decode(path, size):
+        decoded.append(path)
+        release.wait()
+        return decode_preview(path, size)
+
+    monkeypatch.setattr(preview, "decode_preview", decode)
+    loader = PreviewLoader(FakeRoot(), size=(64, 64))
+    loader.release = release
+    loader.decoded = decoded
+    yield loader
+    release.set()
+    loader.shutdown()
+
+def finish(loader):
+    loader.release.set()
+    wait(list(loader.pending.values()))
+    loader.root.run()
+
+def test_only_the_latest_request_is_shown(tmp_path, loader):
+    first, second = make_image(tmp_path, "a.png"), make_image(tmp_path, "b.png")
+    shown = []
+    loader.show(first, lambda photo: shown.append(("first", photo)))
+    loader.show(second, lambda photo: shown.append(("second", photo)))
+    finish(loader)
+    assert [name for name, _ in shown] == ["second"] and shown[0][1].size == (64, 48)
+    # The stale decode still lands in the cache, so going back is immediate
+    loader.show(first, lambda photo: shown.append(("again", photo)))
+    assert [name for name, _ in shown] == ["second", "again"]
+    assert not loader.pending
+
+def test_new_request_drops_queued_neighbors(tmp_path, loader):
+    paths = [make_image(tmp_path, "{}.png".format(number)) for number in range(5)]
+    loader.show(paths[0], lambda photo: None, neighbors=paths[1:4])
+    assert len(loader.pending) == preview.PREVIEW_WORKERS and len(loader.queued) == 2
+    shown = []
+    loader.show(paths[4], shown.append)
+    finish(loader)
+    # Running decodes finish; neighbors still waiting for a worker are never decoded
+    assert sorted(loader.decoded) == [paths[0], paths[1], paths[4]]
+    assert len(shown) == 1 and len(loader.images) == 3
+
+def test_unreadable_files(tmp_path, loader):
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"not an image")
+    shown = []
+    loader.show(str(tmp_path / "missing.png"), shown.append)
+    assert shown == [None] and not loader.pending
+    loader.show(str(broken), shown.append)
+    finish(loader)
+    assert shown == [None, None] and not loader.images
+
+def test_memory_keeps_most_recently_used(tmp_path, loader):
+    loader.memory_items = 2
+    paths = [make_image(tmp_path, "{}.png".format(number)) for number in range(3)]
+    for path in paths:
+        loader.show(path, lambda photo: None)
+        finish(loader)
+    assert list(loader.images) == [loader.key(paths[1]), loader.key(paths[2])]
@@ -0,0 +1,315 @@
+import pytest
+
+import repository
+from dates import PERIOD_DAY, PERIOD_MONTH, PERIOD_YEAR, day_range, period_days
+
+def image_tags(conn):
+    rows = conn.execute('''SELECT it.image_id, t.tag_name FROM image_tags AS it JOIN tags AS t ON it.tag_id = t.tag_id
+                           ORDER BY it.image_id, t.tag_name''').fetchall()
+    tags = {}
+    for image_id, tag_name in rows:
+        tags.setdefault(image_id, []).append(tag_name)
+    return tags
+
+def tag_ids(conn, *names):
+    return {name: conn.execute("SELECT tag_id FROM tags WHERE tag_name = ?", (name,)).fetchone()[0] for name in names}
+
+# use_count as kept by the triggers, next to a count of the links
+def use_counts(conn):
+    return conn.execute('''SELECT t.tag_name, t.use_count, (SELECT COUNT(*) FROM image_tags AS it WHERE it.tag_id = t.tag_id)
+                           FROM tags AS t ORDER BY t.tag_name''').fetchall()
+
+def add_images(conn):
+    cursor = conn.cursor()
+    repository.add_image(cursor, "images/1.png", "alice", tags=["cat", "night"])
+    repository.add_image(cursor, "images/2.png", "alice", tags=["cat"])
+    repository.add_image(cursor, "images/3.png", "bob", tags=["dog"])
+    conn.commit()
+    return cursor
+
+def test_tag_images_add_and_remove(catalog):
+    cursor = add_images(catalog)
+    ids = tag_ids(catalog, "cat", "night", "dog")
+    changes = repository.tag_images(cursor, [1, 2, 3], add=["night", "outdoor"], remove=["cat"])
+    assert image_tags(catalog) == {1: ["night", "outdoor"], 2: ["night", "outdoor"], 3: ["dog", "night", "outdoor"]}
+    # Only tags that gained or lost links are reported; dog kept its one link
+    assert changes.images == {1, 2, 3}
+    assert changes.tag_counts == {ids["cat"], ids["night"], tag_ids(catalog, "outdoor")["outdoor"]}
+    assert all(count == links for _, count, links in use_counts(catalog))
+    assert repository.tag_usage(cursor)[0] == ("night", 3)
+
+def test_tag_images_add_wins_over_remove(catalog):
+    cursor = add_images(catalog)
+    changes = repository.tag_images(cursor, [2, 3], add=["cat"], remove=["cat", "dog"])
+    assert image_tags(catalog) == {1: ["cat", "night"], 2: ["cat"], 3: ["cat"]}
+    assert changes.tag_counts == set(tag_ids(catalog, "cat", "dog").values())
+
+def test_tag_images_replace(catalog):
+    cursor = add_images(catalog)
+    changes = repository.tag_images(cursor, [1, 3], replace=["cat", "sketch"], creator_name="carol")
+    assert image_tags(catalog) == {1: ["cat", "sketch"], 2: ["cat"], 3: ["cat", "sketch"]}
+    assert changes.tag_counts == set(tag_ids(catalog, "cat", "night", "dog", "sketch").values())
+    assert catalog.execute('''SELECT i.image_id, c.creator_name FROM images AS i JOIN creators AS c
+                              ON i.creator_id = c.creator_id ORDER BY i.image_id''').fetchall() == [
+        (1, "carol"), (2, "alice"), (3, "carol")]
+    assert all(count == links for _, count, links in use_counts(catalog))
+    # The full-text documents follow the new tags and creator
+    assert catalog.execute("SELECT rowid FROM images_fts WHERE images_fts MATCH 'sketch AND carol' ORDER BY rowid").fetchall() == [
+        (1,), (3,)]
+    assert catalog.execute("SELECT rowid FROM images_fts WHERE images_fts MATCH 'night OR dog'").fetchall() == []
+
+def test_tag_images_without_changes(catalog):
+    cursor = add_images(catalog)
+    before = image_tags(catalog)
+    changes = repository.tag_images(cursor, [1, 2], add=["cat"], remove=["dog"])
+    assert image_tags(catalog) == before
+    assert changes.tag_counts == set()
+
+def read_pages(conn, sort_column, descending, page_size, backward=False, start=None):
+    rows = []
+    key = start
+    while True:
+        query, params = repository.image_page_query(sort_column, descending, repository.IMAGE_SOURCE, key,
+                                                    page_size, backward=backward)
+        page = conn.execute(query, params).fetchall()
+        rows += [row[0] for row in page]
+        if len(page) < page_size:
+            return rows
+        key = (page[-1][-1], page[-1][0])
+
+@pytest.mark.parametrize("sort_column", ["image_id", "filename", "creator", "source_url", "date_added"])
+@pytest.mark.parametrize("descending", [False, True])
+def test_image_pages(catalog, sort_column, descending):
+    cursor = catalog.cursor()
+    # Few distinct values, so pages split runs of equal sort keys
+    for number in range(23):
+        repository.add_image(cursor, "images/{}.png".format(number % 4), "creator{}".format(number % 3),
+                             "https://example.com/{}".format(number % 2) if number % 7 else None, tags=["cat"],
+                             date_added="2024-05-0{}T10:00:00Z".format(number % 3 + 1) if number % 6 else None)
+    # Images of deleted creators sort first
+    cursor.execute("UPDATE images SET creator_id = NULL WHERE image_id % 5 = 0")
+    catalog.commit()
+    query, params = repository.image_page_query(sort_column, descending, repository.IMAGE_SOURCE, None, 100)
+    everything = [row[0] for row in catalog.execute(query, params)]
+    assert sorted(everything) == list(range(1, 24))
+
+    for page_size in (1, 5, 23):
+        assert read_pages(catalog, sort_column, descending, page_size) == everything
+    # Backward from the last row reads the rest in reverse
+    last = catalog.execute(query, params).fetchall()[-1]
+    assert read_pages(catalog, sort_column, descending, 4, backward=True,
+                      start=(last[-1], last[0])) == everything[-2::-1]
+
+def catalog_state(conn):
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(images)") if column[1] != "creator_id"]
+    # Creators deleted while the images were in the trash come back with new ids
+    return (conn.execute('''SELECT {}, c.creator_name FROM images AS i LEFT JOIN creators AS c
+                            ON i.creator_id = c.creator_id ORDER BY i.image_id'''.format(
+                                ", ".join("i." + column for column in columns))).fetchall(),
+            image_tags(conn), use_counts(conn),
+            # Tags added back get new ids, which can change the order of the words in the documents
+            [row[:4] + (sorted((row[4] or "").split()),) for row in conn.execute(
+                "SELECT rowid, filename, source_url, creator_name, tag_names FROM images_fts ORDER BY rowid")])
+
+def test_delete_and_restore_trash(catalog, tmp_path):
+    cursor = add_images(catalog)
+    for name in ("1.png", "2.png", "3.png"):
+        (tmp_path / "images").mkdir(exist_ok=True)
+        (tmp_path / "images" / name).write_bytes(b"image")
+    # A second image sharing a file keeps it out of the trash
+    repository.add_image(cursor, "images/3.png", "carol", tags=["dog"])
+    catalog.commit()
+    before = catalog_state(catalog)
+
+    changes = repository.delete_images(cursor, [1, 3, 99])
+    assert changes.images == {1, 3}
+    assert changes.tag_counts == set(tag_ids(catalog, "cat", "night", "dog").values())
+    assert catalog.execute("SELECT image_id FROM images ORDER BY image_id").fetchall() == [(2,), (4,)]
+    assert catalog.execute("SELECT image_id FROM image_tags ORDER BY image_id").fetchall() == [(2,), (4,)]
+    assert catalog.execute("SELECT rowid FROM images_fts ORDER BY rowid").fetchall() == [(2,), (4,)]
+    assert catalog.execute("SELECT path, batch_id FROM trash_files").fetchall() == [("images/1.png", changes.trash_batch)]
+    assert [row[0] for row in repository.trash_batches(cursor)] == [changes.trash_batch]
+    assert repository.trash_batches(cursor)[0][2:] == (2, 1)
+
+    # Tags and creators removed while the images were in the trash come back
+    cursor.execute("DELETE FROM tags WHERE tag_name = 'night'")
+    cursor.execute("DELETE FROM creators WHERE creator_name = 'bob'")
+    restored = repository.restore_trash(cursor, changes.trash_batch)
+    catalog.commit()
+    assert restored.images == {1, 3}
+    assert catalog_state(catalog) == before
+    assert catalog.execute("SELECT COUNT(*) FROM trash_files").fetchone() == (0,)
+    assert repository.trash_batches(cursor) == []
+    assert catalog.execute("PRAGMA foreign_key_check").fetchall() == []
+
+# Each mutation reports the rows it touched, which is all the views re-read
+def test_mutations_report_changed_rows(catalog):
+    cursor = add_images(catalog)
+    ids = tag_ids(catalog, "cat", "night", "dog")
+    changes = repository.add_image(cursor, "images/4.png", "carol", tags=["cat", "sky"])
+    assert (changes.images, changes.creators) == ({4}, {3})
+    sky = tag_ids(catalog, "sky")["sky"]
+    assert (changes.tags, changes.tag_counts) == ({sky}, {ids["cat"], sky})
+
+    changes = repository.edit_image(cursor, 1, "alice", "", ["cat", "dog"], None, "")
+    assert (changes.images, changes.tags, changes.creators) == ({1}, set(), set())
+    assert changes.tag_counts == {ids["night"], ids["dog"]}
+
+    assert repository.add_creator(cursor, "alice") is None
+    assert repository.add_creator(cursor, "dave").creators == {4}
+    assert repository.add_tag(cursor, "cat") is None
+    kitten = repository.add_tag(cursor, "kitten").tags
+    assert kitten == set(tag_ids(catalog, "kitten").values())
+    assert repository.delete_unused_tags(cursor).tags == {ids["night"]} | kitten
+
+    changes = repository.delete_creators(cursor, [2], reassign_to="alice")
+    assert (changes.images, changes.creators) == ({3}, {2})
+    assert not repository.ChangeSet()
+    merged = repository.ChangeSet(images=[1]).update(repository.ChangeSet(tag_counts=[2], trash_batch=7))
+    assert (merged.images, merged.tag_counts, merged.trash_batch) == ({1}, {2}, 7)
+    assert repository.ChangeSet(tag_counts=[2]).update(repository.ChangeSet()).tag_counts == {2}
+
+def test_fetch_image_records(catalog, monkeypatch):
+    monkeypatch.setattr(repository, "NAME_LOOKUP_CHUNK", 2)
+    cursor = add_images(catalog)
+    repository.add_image(cursor, "images/4.png", "carol")
+    cursor.execute("UPDATE images SET creator_id = NULL WHERE image_id = 3")
+    row = list(catalog.execute("SELECT * FROM images WHERE image_id = 1").fetchone())
+    record = repository.fetch_image(cursor, 1)
+    # The creator name stands in for its id, and the tag names follow the row
+    assert record[:3] + record[4:-1] == row[:3] + row[4:]
+    assert record[3] == "alice" and sorted(record[-1].split(",")) == ["cat", "night"]
+    assert repository.fetch_image(cursor, 99) is None
+
+    records = repository.fetch_image_records(cursor, [1, 2, 3, 4, 99])
+    assert sorted(records) == [1, 2, 3, 4]
+    assert records[3][0][3] is None and records[3][1] is None
+    assert records[4][0][-1] == "" and records[4][2] == frozenset()
+    assert records[1][1:] == (1, frozenset(tag_ids(catalog, "cat", "night").values()))
+
+def test_image_record_cache(catalog):
+    cursor = add_images(catalog)
+    cache = repository.ImageRecordCache(max_items=2)
+    cache.update(repository.fetch_image_records(cursor, [1, 2]))
+    assert cache.get(1)[3] == "alice"
+    cache.update(repository.fetch_image_records(cursor, [3]))
+    # The least recently used record makes room
+    assert list(cache.entries) == [1, 3]
+    assert cache.get(2) is None
+
+    cache = repository.ImageRecordCache()
+    cache.update(repository.fetch_image_records(cursor, [1, 2, 3]))
+    cache.invalidate(repository.edit_image(cursor, 3, "bob", "", ["dog"], None, ""))
+    assert list(cache.entries) == [1, 2]
+    # Renaming a tag or creator drops every record showing it
+    cache.update(repository.fetch_image_records(cursor, [3]))
+    cache.invalidate(repository.ChangeSet(tags=tag_ids(catalog, "night").values()))
+    assert list(cache.entries) == [2, 3]
+    cache.invalidate(repository.ChangeSet(creators=[1]))
+    assert list(cache.entries) == [3]
+    # Changes to how many images use a tag don't show in the records
+    cache.invalidate(repository.ChangeSet(tag_counts=tag_ids(catalog, "dog").values()))
+    assert list(cache.entries) == [3]
+
+# The triggers keep use_count right however image_tags is written
+def test_use_count_triggers(catalog):
+    cursor = add_images(catalog)
+    ids = tag_ids(catalog, "cat", "night", "dog")
+    cursor.execute("INSERT INTO image_tags (image_id, tag_id) VALUES (3, ?)", (ids["cat"],))
+    cursor.execute("UPDATE image_tags SET tag_id = ? WHERE image_id = 1 AND tag_id = ?", (ids["dog"], ids["night"]))
+    cursor.execute("DELETE FROM image_tags WHERE image_id = 2")
+    assert use_counts(catalog) == [("cat", 2, 2), ("dog", 2, 2), ("night", 0, 0)]
+    assert repository.tag_usage(cursor, limit=2) == [("cat", 2), ("dog", 2)]
+
+    # Unused tags go, unless an alias or implication still refers to them
+    repository.add_tag(cursor, "kitten")
+    repository.add_tag(cursor, "sky")
+    repository.add_tag_implication(cursor, "kitten", "cat")
+    repository.add_tag_alias(cursor, "heavens", "sky")
+    repository.delete_unused_tags(cursor)
+    assert [row[0] for row in use_counts(catalog)] == ["cat", "dog", "kitten", "sky"]
+
+def test_date_timeline_and_ranges(catalog):
+    cursor = catalog.cursor()
+    for number, (added, uploaded) in enumerate([
+            ("2023-12-31T23:59:59Z", "2023-12-30"), ("2024-01-01T00:00:00Z", ""), ("2024-01-15T08:00:00Z", "2024-01-02"),
+            ("2024-03-01T12:00:00Z", "2024-02-29"), (None, "2024-03-01"), ("2024-03-31T23:00:00Z", None)]):
+        repository.add_image(cursor, "images/{}.png".format(number), "alice", tags=["cat"] if number % 2 else [],
+                             date_added=added, date_uploaded=uploaded)
+    catalog.commit()
+
+    assert repository.date_timeline(cursor, "date_added", PERIOD_YEAR) == [("2023", 1), ("2024", 4)]
+    assert repository.date_timeline(cursor, "date_added", PERIOD_MONTH) == [("2023-12", 1), ("2024-01", 2), ("2024-03", 2)]
+    assert repository.date_timeline(cursor, "date_uploaded", PERIOD_DAY) == [
+        ("2023-12-30", 1), ("2024-01-02", 1), ("2024-02-29", 1), ("2024-03-01", 1)]
+    # Ranges cut periods at their bounds
+    march = ("date_added",) + day_range(*period_days("2024-03"))
+    assert repository.date_timeline(cursor, "date_added", PERIOD_YEAR, date_range=("date_added",) + day_range(
+        "2024-01-10", "2024-03-01")) == [("2024", 2)]
+    assert repository.date_timeline(cursor, "date_added", PERIOD_MONTH, date_range=march) == [("2024-03", 2)]
+    # Over search results the periods are grouped directly
+    cursor.execute("CREATE TEMP TABLE image_filter (image_id INTEGER PRIMARY KEY, position INTEGER)")
+    cursor.execute("INSERT INTO temp.image_filter (image_id) SELECT image_id FROM image_tags")
+    assert repository.date_timeline(cursor, "date_added", PERIOD_MONTH, repository.IMAGE_FILTER_SOURCE) == [
+        ("2024-01", 1), ("2024-03", 2)]
+
+    query, params = repository.image_page_query("date_added", True, repository.IMAGE_SOURCE, None, 10, march)
+    assert [row[0] for row in catalog.execute(query, params)] == [6, 4]
+    # Undated images are left out of every range
+    query, params = repository.image_page_query("date_uploaded", False, repository.IMAGE_SOURCE, None, 10,
+                                                ("date_uploaded", None, "2024-01-03"))
+    assert [row[0] for row in catalog.execute(query, params)] == [1, 3]
+
+def test_alias_merges_tag(catalog):
+    cursor = add_images(catalog)
+    repository.add_image(cursor, "images/4.png", "alice", tags=["kitty", "cat"])
+    repository.add_image(cursor, "images/5.png", "alice", tags=["kitty"])
+    ids = tag_ids(catalog, "cat", "kitty")
+    changes = repository.add_tag_alias(cursor, "kitty", "cat")
+    assert (changes.images, changes.tags, changes.tag_rules) == ({4, 5}, {ids["kitty"]}, {ids["cat"]})
+    assert image_tags(catalog)[4] == ["cat"] and image_tags(catalog)[5] == ["cat"]
+    assert all(count == links for _, count, links in use_counts(catalog))
+    assert catalog.execute("SELECT rowid FROM images_fts WHERE images_fts MATCH 'kitty'").fetchall() == []
+
+    # Entered names resolve through aliases, including aliases of a tag that became an alias
+    repository.add_tag_alias(cursor, "neko", "kitty")
+    repository.add_image(cursor, "images/6.png", "alice", tags=["neko", "kitty", "cat"])
+    assert image_tags(catalog)[6] == ["cat"]
+    assert repository.tag_rules(cursor)[0] == [("kitty", "cat"), ("neko", "cat")]
+    assert repository.add_tag(cursor, "neko") is None
+    assert repository.remove_tag_alias(cursor, "neko").tag_rules == {ids["cat"]}
+    assert repository.remove_tag_alias(cursor, "neko").tag_rules == set()
+
+    # A tag can't become an alias of itself, also by way of one of its aliases
+    with pytest.raises(ValueError):
+        repository.add_tag_alias(cursor, "cat", "kitty")
+    repository.add_tag_implication(cursor, "dog", "animal")
+    with pytest.raises(ValueError):
+        repository.add_tag_alias(cursor, "dog", "cat")
+
+def closure(conn):
+    return set(conn.execute("SELECT tag_id, ancestor_id FROM tag_closure"))
+
+def test_implications_and_closure(catalog):
+    cursor = catalog.cursor()
+    for tag_name, implied_name in [("kitten", "cat"), ("cat", "animal"), ("animal", "thing"), ("puppy", "animal")]:
+        repository.add_tag_implication(cursor, tag_name, implied_name)
+    ids = tag_ids(catalog, "kitten", "cat", "animal", "thing", "puppy")
+    assert {(ids[name], ids[ancestor]) for name, ancestor in [("kitten", "cat"), ("kitten", "animal"), ("kitten", "thing"),
+            ("cat", "animal"), ("cat", "thing"), ("animal", "thing"), ("puppy", "animal"), ("puppy", "thing")]} == closure(catalog)
+
+    # Rules making a tag imply itself are refused, however long the path
+    for tag_name, implied_name in [("thing", "kitten"), ("animal", "cat"), ("cat", "cat")]:
+        with pytest.raises(ValueError):
+            repository.add_tag_implication(cursor, tag_name, implied_name)
+
+    # Removing a rule keeps what another path still implies
+    repository.add_tag_implication(cursor, "kitten", "animal")
+    repository.remove_tag_implication(cursor, "cat", "animal")
+    assert {(ids["kitten"], ids["animal"]), (ids["kitten"], ids["thing"])} <= closure(catalog)
+    assert (ids["cat"], ids["animal"]) not in closure(catalog)
+    # The incremental updates end where recomputing every tag would
+    expected = closure(catalog)
+    repository.refresh_tag_closure(cursor, ids.values())
+    assert closure(catalog) == expected
+    assert repository.remove_tag_implication(cursor, "cat", "animal").tag_rules == set()
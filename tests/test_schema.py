@@ -0,0 +1,69 @@
+import sqlite3
+
+import repository
+import schema
+
+# A catalog as the first release wrote it: no migrations applied, str(datetime) for date_added,
+# DateEntry's locale text for date_uploaded and the same tag name added more than once
+def baseline_catalog(path):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    schema.migration_base_tables(cursor)
+    cursor.execute("INSERT INTO creators (creator_name) VALUES ('alice')")
+    cursor.executemany("INSERT INTO tags (tag_id, tag_name) VALUES (?, ?)",
+                       [(1, "cat"), (2, "night"), (3, "cat"), (4, "cat")])
+    cursor.executemany('''INSERT INTO images (image_id, filename, directory_path, creator_id, source_url,
+                                              date_added, date_uploaded) VALUES (?, ?, ?, 1, '', ?, ?)''',
+                       [(1, "a.png", "images/a.png", "2024-05-01 10:00:00.123456", "05/02/24"),
+                        (2, "b.png", "images/b.png", "2024-05-03 08:30:00", ""),
+                        (3, "c.png", "images/c.png", "not a date", "someday")])
+    cursor.executemany("INSERT INTO image_tags (image_id, tag_id) VALUES (?, ?)",
+                       [(1, 1), (1, 3), (1, 2), (2, 3), (3, 4)])
+    conn.commit()
+    conn.close()
+
+def test_migrate_baseline_catalog(tmp_path):
+    path = str(tmp_path / "catalog.db")
+    baseline_catalog(path)
+    reported = []
+    conn = repository.connect(path, report=reported.append)
+    assert schema.schema_version(conn) == len(schema.MIGRATIONS)
+    assert any("version {}".format(len(schema.MIGRATIONS)) in line for line in reported)
+
+    # The duplicate tags are merged into the oldest, keeping every image's links once
+    assert conn.execute("SELECT tag_id, tag_name, use_count FROM tags ORDER BY tag_id").fetchall() == [
+        (1, "cat", 3), (2, "night", 1)]
+    assert conn.execute("SELECT image_id, tag_id FROM image_tags ORDER BY image_id, tag_id").fetchall() == [
+        (1, 1), (1, 2), (2, 1), (3, 1)]
+    assert conn.execute("INSERT OR IGNORE INTO tags (tag_name) VALUES ('cat')").rowcount == 0
+    # Dates become ISO 8601; text that isn't a date is kept for the user to fix
+    assert conn.execute("SELECT date_added, date_uploaded FROM images ORDER BY image_id").fetchall() == [
+        ("2024-05-01T10:00:00Z", "2024-05-02"), ("2024-05-03T08:30:00Z", None), ("not a date", "someday")]
+    assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+    assert conn.execute("PRAGMA foreign_keys").fetchone() == (1,)
+    conn.close()
+
+    # Opening it again finds nothing to do
+    reported = []
+    conn = repository.connect(path, report=reported.append)
+    assert reported == []
+    conn.close()
+
+def fts_trigger_sql(conn):
+    return [row[0] for row in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'images_fts_%' ORDER BY name")]
+
+# Each version keeps the triggers it was released with; only migration 14 adds the fts_sync flag
+def test_fts_triggers_change_only_in_their_migration(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "catalog.db"))
+    cursor = conn.cursor()
+    for migration in schema.MIGRATIONS[:13]:
+        migration(cursor)
+    triggers = fts_trigger_sql(conn)
+    assert len(triggers) == 7 and not any("fts_sync" in sql for sql in triggers)
+    assert not schema.table_exists(cursor, "fts_sync")
+
+    schema.MIGRATIONS[13](cursor)
+    assert all(schema.FTS_TRIGGER_WHEN in sql for sql in fts_trigger_sql(conn))
+    assert conn.execute("SELECT suspended FROM fts_sync").fetchall() == [(0,)]
+    conn.close()
@@ -0,0 +1,106 @@
+import pytest
+
+import repository
+from search import QueryError, TagIndex, fts_query, parse_query, text_search
+
+@pytest.mark.parametrize("query, expected", [
+    ("cat", ("tag", "cat")),
+    ("cat dog", ("and", ("tag", "cat"), ("tag", "dog"))),
+    ("cat and dog OR bird", ("or", ("and", ("tag", "cat"), ("tag", "dog")), ("tag", "bird"))),
+    ("cat AND (dog OR bird)", ("and", ("tag", "cat"), ("or", ("tag", "dog"), ("tag", "bird")))),
+    ("NOT NOT cat", ("not", ("not", ("tag", "cat")))),
+    ('creator:"Some Artist" tag:"a (b)"', ("and", ("creator", "Some Artist"), ("tag", "a (b)"))),
+    ("rating:safe", ("tag", "rating:safe")),
+    ("format:jpg WIDTH>=3840", ("and", ("attribute", "image_format", "=", "JPEG"), ("attribute", "width", ">=", 3840))),
+    ("size<2M OR height=10", ("or", ("attribute", "file_size", "<", 2 * 1024 ** 2), ("attribute", "height", "=", 10))),
+    ("size>=512kb", ("attribute", "file_size", ">=", 512 * 1024)),
+    ("width>wide", ("tag", "width>wide")),
+])
+def test_parse_query(query, expected):
+    assert parse_query(query) == expected
+
+@pytest.mark.parametrize("query", ["", "   ", "(cat", "cat)", "cat AND", "NOT"])
+def test_parse_query_rejects(query):
+    with pytest.raises(QueryError):
+        parse_query(query)
+
+@pytest.fixture
+def index(catalog):
+    cursor = catalog.cursor()
+    repository.add_image(cursor, "images/1.png", "alice", tags=["cat", "night"])
+    repository.add_image(cursor, "images/2.png", "alice", tags=["dog"])
+    repository.add_image(cursor, "images/3.png", "Bob", tags=["kitten", "night"])
+    repository.add_image(cursor, "images/4.png", "bob", tags=[])
+    repository.add_tag_implication(cursor, "kitten", "cat")
+    repository.add_tag_alias(cursor, "kitty", "cat")
+    catalog.commit()
+    tag_index = TagIndex()
+    tag_index.build(cursor)
+    return tag_index
+
+@pytest.mark.parametrize("query, expected", [
+    ("cat", [1, 3]),
+    ("CAT", [1, 3]),
+    ("kitty", [1, 3]),
+    ("kitten", [3]),
+    ("cat night", [1, 3]),
+    ("cat NOT kitten", [1]),
+    ("dog OR kitten", [2, 3]),
+    ("NOT night", [2, 4]),
+    ("creator:ALICE", [1, 2]),
+    ("creator:bob", [3, 4]),
+    ("creator:bob AND NOT (cat OR dog)", [4]),
+    ("missing", []),
+    ("NOT missing", [1, 2, 3, 4]),
+])
+def test_tag_index_search(index, query, expected):
+    assert index.search(query) == expected
+
+def test_tag_index_update(catalog, index):
+    cursor = catalog.cursor()
+    changes = repository.tag_images(cursor, [2, 4], add=["cat"], remove=["dog"])
+    changes.update(repository.delete_images(cursor, [1]))
+    index.update(cursor, changes)
+    assert index.search("cat") == [2, 3, 4]
+    assert index.search("dog") == []
+    assert index.search("creator:alice") == [2]
+    # Incremental updates end where a rebuild would
+    rebuilt = TagIndex()
+    rebuilt.build(cursor)
+    for query in ("cat", "night", "NOT kitten", "creator:bob"):
+        assert index.search(query) == rebuilt.search(query)
+
+def test_fts_query():
+    assert fts_query("Cat, night-sky") == '"Cat"* "night"* "sky"*'
+    with pytest.raises(QueryError):
+        fts_query(" -- ")
+
+def test_text_search_follows_edits(catalog):
+    cursor = catalog.cursor()
+    repository.add_image(cursor, "images/sunset_beach.png", "alice", "https://example.com/summer", ["orange"])
+    repository.add_image(cursor, "images/forest.png", "bob", tags=["green", "summer"])
+    catalog.commit()
+    assert sorted(text_search(cursor, "summer")) == [1, 2]
+    assert text_search(cursor, "sun bea") == [1]
+    assert text_search(cursor, "ALI") == [1]
+
+    # Renaming a tag or a creator, and editing an image, rewrite the documents that show them
+    cursor.execute("UPDATE tags SET tag_name = 'emerald' WHERE tag_name = 'green'")
+    cursor.execute("UPDATE creators SET creator_name = 'robert' WHERE creator_name = 'bob'")
+    repository.edit_image(cursor, 1, "alice", "", ["orange"], None, "")
+    assert text_search(cursor, "emerald robert") == [2]
+    assert text_search(cursor, "green") == [] and text_search(cursor, "bob") == []
+    assert text_search(cursor, "summer") == [2]
+    assert text_search(cursor, "summer", limit=1, offset=1) == []
+
+def test_attribute_terms(catalog, index):
+    catalog.executemany("UPDATE images SET width = ?, image_format = ?, file_size = ? WHERE image_id = ?",
+                        [(4000, "JPEG", 3 * 1024 ** 2, 1), (4000, "PNG", 1024, 2), (800, "JPEG", 1024, 3)])
+    cursor = catalog.cursor()
+    assert index.search("width>=3840 night", cursor) == [1]
+    assert index.search("format:jpeg", cursor) == [1, 3]
+    assert index.search("format:JPG AND size<2M", cursor) == [3]
+    assert index.search("NOT width>=3840", cursor) == [3, 4]
+    # Without a cursor only the in-memory terms can be answered
+    with pytest.raises(QueryError):
+        index.search("width>=3840")
@@ -0,0 +1,57 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import storage
+from storage import STORAGE_FLAT, STORAGE_HASHED, hashed_path, reserve_destination, store_file, stored_size
+
+def write_file(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+def test_hashed_path():
+    content_hash = "abcdef" + "0" * 58
+    assert hashed_path("images", content_hash, ".JPG") == os.path.join("images", "ab", "cd", content_hash + ".jpg")
+
+def test_store_flat_renames_on_collision(tmp_path):
+    source = write_file(tmp_path, "a.png", b"first")
+    other = write_file(tmp_path, "b.png", b"second")
+    directory = str(tmp_path / "images")
+    first = store_file(source, directory)
+    assert first == (os.path.join(directory, "a.png"), hashlib.sha256(b"first").hexdigest(), True)
+    # Flat storage copies every file, identical or not
+    assert store_file(source, directory, STORAGE_FLAT)[0] == os.path.join(directory, "a_1.png")
+    os.rename(other, source)
+    assert store_file(source, directory)[0] == os.path.join(directory, "a_2.png")
+
+def test_reserve_destination_from_threads(tmp_path):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        names = list(pool.map(lambda _: reserve_destination(str(tmp_path), "a.png"), range(20)))
+    assert len(set(names)) == 20
+
+def test_store_hashed_shares_identical_content(tmp_path, monkeypatch):
+    # Chunks smaller than the file exercise the streaming hash
+    monkeypatch.setattr(storage, "COPY_CHUNK_SIZE", 3)
+    source = write_file(tmp_path, "a.png", b"same content")
+    copy = write_file(tmp_path, "copy.png", b"same content")
+    directory = str(tmp_path / "images")
+    content_hash = hashlib.sha256(b"same content").hexdigest()
+    path = hashed_path(directory, content_hash, ".png")
+    assert store_file(source, directory, STORAGE_HASHED) == (path, content_hash, True)
+    assert store_file(copy, directory, STORAGE_HASHED) == (path, content_hash, False)
+    with open(path, "rb") as stored:
+        assert stored.read() == b"same content"
+    assert stored_size(path) == len(b"same content")
+    assert stored_size(str(tmp_path / "missing.png")) is None
+    # Nothing is left behind from the second copy
+    assert [name for _, _, names in os.walk(directory) for name in names] == [content_hash + ".png"]
+
+def test_failed_copy_leaves_nothing(tmp_path):
+    directory = str(tmp_path / "images")
+    for storage_mode in (STORAGE_FLAT, STORAGE_HASHED):
+        with pytest.raises(OSError):
+            store_file(str(tmp_path / "missing.png"), directory, storage_mode)
+    assert os.listdir(directory) == []
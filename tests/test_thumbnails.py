@@ -0,0 +1,136 @@
+import os
+from concurrent.futures import wait
+
+import pytest
+from PIL import Image
+
+import thumbnails
+from thumbnails import ThumbnailCache, render_thumbnail, thumbnail_key
+
+# Stands in for the Tk root, running the callbacks scheduled with after() on demand
+class FakeRoot:
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, ms, callback):
+        self.scheduled.append(callback)
+
+    # Run the polls until every pending thumbnail has been delivered
+    def run(self, cache):
+        while self.scheduled:
+            wait([future for future, _ in cache.pending.values()])
+            self.scheduled.pop(0)()
+
+# PhotoImage needs a display; the tests only look at what it was made from
+class FakePhoto:
+    def __init__(self, image):
+        self.size = image.size
+
+@pytest.fixture
+def make_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(thumbnails.ImageTk, "PhotoImage", FakePhoto)
+    caches = []
+
+    def make_cache(**options):
+        options.setdefault("cache_dir", str(tmp_path / "thumbnails"))
+        cache = ThumbnailCache(FakeRoot(), **options)
+        caches.append(cache)
+        return cache
+
+    yield make_cache
+    for cache in caches:
+        cache.shutdown()
+
+def make_image(tmp_path, name, size=(640, 480), color="red"):
+    path = str(tmp_path / name)
+    Image.new("RGB", size, color).save(path)
+    return path
+
+def request(cache, path):
+    photos = []
+    cache.request(path, photos.append)
+    cache.root.run(cache)
+    assert len(photos) == 1
+    return photos[0]
+
+def test_render_thumbnail(tmp_path):
+    source = make_image(tmp_path, "wide.png", size=(1000, 250))
+    destination = str(tmp_path / "wide.jpg")
+    assert render_thumbnail(source, destination) == destination
+    with Image.open(destination) as image:
+        assert image.format == "JPEG"
+        assert image.size == (128, 32)
+    assert not os.path.exists(destination + ".part")
+
+def test_thumbnail_key_follows_file_changes(tmp_path):
+    path = make_image(tmp_path, "a.png")
+    key = thumbnail_key(path)
+    assert thumbnail_key(path) == key
+    assert thumbnail_key(path, (64, 64)) != key
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+    assert thumbnail_key(path) != key
+
+def test_request_renders_then_reuses(tmp_path, make_cache):
+    path = make_image(tmp_path, "a.png")
+    cache = make_cache()
+    photo = request(cache, path)
+    assert photo.size == (128, 96)
+    # Rendered in a fresh interpreter, not a fork of one running threads
+    assert cache.pool._mp_context.get_start_method() == thumbnails.THUMBNAIL_START_METHOD
+    assert os.path.exists(cache.cache_path(thumbnail_key(path)))
+    assert cache.disk_bytes == os.path.getsize(cache.cache_path(thumbnail_key(path)))
+
+    # From memory, without scheduling another render
+    assert request(cache, path) is photo
+    # A new cache finds the file rendered by the first
+    other = make_cache()
+    assert other.disk_bytes == cache.disk_bytes
+    other.request(path, lambda photo: None)
+    assert other.pool is None and not other.pending
+
+def test_requests_for_one_file_share_a_render(tmp_path, make_cache):
+    path = make_image(tmp_path, "a.png")
+    cache = make_cache()
+    photos = []
+    cache.request(path, photos.append)
+    cache.request(path, photos.append)
+    assert len(cache.pending) == 1
+    cache.root.run(cache)
+    assert len(photos) == 2 and photos[0] is photos[1]
+
+def test_memory_keeps_most_recently_used(tmp_path, make_cache):
+    paths = [make_image(tmp_path, "{}.png".format(number)) for number in range(3)]
+    cache = make_cache(memory_items=2)
+    request(cache, paths[0])
+    request(cache, paths[1])
+    request(cache, paths[0])
+    request(cache, paths[2])
+    assert list(cache.photos) == [thumbnail_key(paths[0]), thumbnail_key(paths[2])]
+
+def test_disk_cap_removes_least_recently_used(tmp_path, make_cache):
+    paths = [make_image(tmp_path, "{}.png".format(number), color=color)
+             for number, color in enumerate(("red", "green", "blue"))]
+    keys = [thumbnail_key(path) for path in paths]
+    measure = make_cache(cache_dir=str(tmp_path / "measure"))
+    for path in paths:
+        request(measure, path)
+    sizes = [os.path.getsize(measure.cache_path(key)) for key in keys]
+
+    # Room for two files; nothing is kept in memory, so every request after the first render reads the disk
+    cache = make_cache(max_bytes=sizes[0] + max(sizes[1], sizes[2]), memory_items=0)
+    request(cache, paths[0])
+    request(cache, paths[1])
+    request(cache, paths[0])
+    request(cache, paths[2])
+    assert list(cache.disk_files) == [keys[0], keys[2]]
+    assert not os.path.exists(cache.cache_path(keys[1]))
+    assert cache.disk_bytes == sizes[0] + sizes[2]
+
+def test_unreadable_images(tmp_path, make_cache):
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"not an image")
+    cache = make_cache()
+    assert request(cache, str(tmp_path / "missing.png")) is None
+    assert request(cache, str(broken)) is None
+    assert cache.disk_files == {} and cache.photos == {}
@@ -0,0 +1,82 @@
+import pytest
+
+import repository
+from transfer import export_catalog, import_catalog
+
+def add_images(conn):
+    cursor = conn.cursor()
+    repository.add_image(cursor, "images/a.png", "alice", "https://example.com/a", ["cat", "night"],
+                         "2024-05-01T10:00:00Z", "2024-04-30", content_hash="aa")
+    repository.add_image(cursor, "images/b.png", "bob", "", ["cat"], "2024-05-02T10:00:00Z", "")
+    # Catalogued before content hashes were recorded
+    repository.add_image(cursor, "images/c.png", "bob", "", [], "2024-05-03T10:00:00Z", "")
+    repository.add_tag_alias(cursor, "kitty", "cat")
+    cursor.execute("INSERT INTO socials (creator_id, social_handle, social_type) SELECT creator_id, '@alice', 'web' "
+                   "FROM creators WHERE creator_name = 'alice'")
+    conn.commit()
+
+# CSV cells can't tell an empty string from NULL, so neither is compared
+def catalog_rows(conn):
+    return sorted(conn.execute('''SELECT i.filename, i.directory_path, c.creator_name, NULLIF(i.source_url, ''),
+                                         i.date_added, NULLIF(i.date_uploaded, ''), i.content_hash,
+                                         (SELECT GROUP_CONCAT(tag_name) FROM (SELECT t.tag_name FROM image_tags AS it
+                                          JOIN tags AS t ON it.tag_id = t.tag_id WHERE it.image_id = i.image_id
+                                          ORDER BY t.tag_name))
+                                  FROM images AS i LEFT JOIN creators AS c ON i.creator_id = c.creator_id''').fetchall(),
+                  key=repr)
+
+@pytest.mark.parametrize("name", ["backup.jsonl.gz", "backup"])
+def test_export_import_round_trip(catalog, tmp_path, name):
+    add_images(catalog)
+    path = str(tmp_path / name)
+    export_catalog(catalog, path, report=lambda line: None)
+
+    restored = repository.connect(str(tmp_path / "restored.db"), report=lambda line: None)
+    counts = import_catalog(restored, path, report=lambda line: None)
+    assert counts["images"] == 3
+    assert catalog_rows(restored) == catalog_rows(catalog)
+    assert restored.execute("SELECT alias_name FROM tag_aliases").fetchall() == [("kitty",)]
+    assert restored.execute("SELECT social_handle FROM socials").fetchall() == [("@alice",)]
+    # Searchable like images added in the app
+    assert restored.execute("SELECT COUNT(*) FROM images_fts WHERE images_fts MATCH 'cat'").fetchone() == (2,)
+    restored.close()
+
+@pytest.mark.parametrize("name", ["backup.jsonl", "backup"])
+def test_import_is_idempotent(catalog, tmp_path, name):
+    add_images(catalog)
+    path = str(tmp_path / name)
+    export_catalog(catalog, path, report=lambda line: None)
+    before = catalog_rows(catalog)
+
+    # Into the catalog it came from, then twice into another, images without a hash included
+    import_catalog(catalog, path, report=lambda line: None)
+    assert catalog_rows(catalog) == before
+    restored = repository.connect(str(tmp_path / "restored.db"), report=lambda line: None)
+    import_catalog(restored, path, report=lambda line: None)
+    import_catalog(restored, path, report=lambda line: None)
+    assert catalog_rows(restored) == before
+    assert restored.execute("SELECT COUNT(*) FROM socials").fetchone() == (1,)
+    assert restored.execute("SELECT tag_name, use_count FROM tags ORDER BY tag_name").fetchall() == [
+        ("cat", 2), ("night", 1)]
+    restored.close()
+
+# A backup can hold the same image twice; it is restored once, with the tags of both rows
+def test_import_merges_repeated_images(catalog, tmp_path):
+    cursor = catalog.cursor()
+    repository.add_image(cursor, "images/a.png", "alice", tags=["cat"], content_hash="aa")
+    repository.add_image(cursor, "copy/a.png", "alice", tags=["night"], content_hash="aa")
+    repository.add_image(cursor, "images/c.png", "bob", tags=["dog"])
+    repository.add_image(cursor, "images/c.png", "bob", tags=["sky"])
+    catalog.commit()
+    path = str(tmp_path / "backup.jsonl")
+    export_catalog(catalog, path, report=lambda line: None)
+
+    restored = repository.connect(str(tmp_path / "restored.db"), report=lambda line: None)
+    import_catalog(restored, path, report=lambda line: None)
+    assert sorted(restored.execute('''SELECT i.directory_path, t.tag_name FROM images AS i
+                                      JOIN image_tags AS it ON i.image_id = it.image_id
+                                      JOIN tags AS t ON it.tag_id = t.tag_id''').fetchall()) == [
+        ("images/a.png", "cat"), ("images/a.png", "night"), ("images/c.png", "dog"), ("images/c.png", "sky")]
+    assert restored.execute("SELECT COUNT(*) FROM images").fetchone() == (2,)
+    assert restored.execute("SELECT COUNT(*) FROM images_fts WHERE images_fts MATCH 'night AND cat'").fetchone() == (1,)
+    restored.close()
@@ -0,0 +1,142 @@
+import hashlib
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageTk
+
+# Bounding box of generated thumbnails
+THUMBNAIL_SIZE = (128, 128)
+# Folder holding rendered thumbnails
+THUMBNAIL_CACHE_DIR = ".thumbnails"
+# Largest total size of the thumbnail folder before the least recently used files are removed
+THUMBNAIL_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Number of decoded thumbnails kept in memory
+THUMBNAIL_MEMORY_ITEMS = 500
+# Worker processes rendering thumbnails (None uses one per CPU)
+THUMBNAIL_WORKERS = None
+# The pool starts after the database, preview and import threads, and forking a process
+# running threads can copy a lock another thread holds, so workers start from a fresh interpreter
+THUMBNAIL_START_METHOD = "spawn"
+# Milliseconds between checks for finished thumbnails
+THUMBNAIL_POLL_MS = 50
+
+# Cache key of a thumbnail: changes whenever the original file is replaced or edited
+def thumbnail_key(path, size=THUMBNAIL_SIZE):
+    stat = os.stat(path)
+    identity = "{}|{}|{}|{}x{}".format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size, *size)
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+# Render one thumbnail to disk; runs in a worker process
+def render_thumbnail(source, destination, size=THUMBNAIL_SIZE):
+    with Image.open(source) as image:
+        # JPEGs decode straight to a reduced scale instead of full size
+        image.draft("RGB", size)
+        image.thumbnail(size)
+        image = image.convert("RGB")
+        temp_destination = destination + ".part"
+        image.save(temp_destination, "JPEG", quality=85)
+    os.replace(temp_destination, destination)
+    return destination
+
+# Thumbnails for the Tk UI: rendered off the Tk thread, cached on disk and in memory
+class ThumbnailCache:
+    def __init__(self, root, cache_dir=THUMBNAIL_CACHE_DIR, size=THUMBNAIL_SIZE,
+                 max_bytes=THUMBNAIL_CACHE_MAX_BYTES, memory_items=THUMBNAIL_MEMORY_ITEMS):
+        self.root = root
+        self.cache_dir = cache_dir
+        self.size = size
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+
+        self.photos = OrderedDict()   # key -> PhotoImage, least recently used first
+        self.pending = {}             # key -> (future, callbacks waiting for it)
+        self.pool = None
+        self.polling = False
+
+        # Files on disk, least recently used first, with their sizes
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith(".jpg")]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        self.disk_files = OrderedDict((entry.name[:-4], entry.stat().st_size) for entry in entries)
+        self.disk_bytes = sum(self.disk_files.values())
+
+    def cache_path(self, key):
+        return os.path.join(self.cache_dir, key + ".jpg")
+
+    # Call callback(photo) with the thumbnail of path; photo is None if it can't be made
+    def request(self, path, callback):
+        try:
+            key = thumbnail_key(path, self.size)
+        except OSError:
+            callback(None)
+            return
+
+        if key in self.photos:
+            self.photos.move_to_end(key)
+            callback(self.photos[key])
+        elif key in self.disk_files:
+            callback(self.load_cached(key))
+        elif key in self.pending:
+            self.pending[key][1].append(callback)
+        else:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS,
+                                                mp_context=multiprocessing.get_context(THUMBNAIL_START_METHOD))
+            future = self.pool.submit(render_thumbnail, path, self.cache_path(key), self.size)
+            self.pending[key] = (future, [callback])
+            if not self.polling:
+                self.polling = True
+                self.root.after(THUMBNAIL_POLL_MS, self.poll)
+
+    # Deliver finished thumbnails on the Tk thread
+    def poll(self):
+        for key, (future, callbacks) in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[key]
+            photo = None
+            if future.exception() is None:
+                self.add_disk_file(key)
+                photo = self.load_cached(key)
+            for callback in callbacks:
+                callback(photo)
+
+        self.polling = bool(self.pending)
+        if self.polling:
+            self.root.after(THUMBNAIL_POLL_MS, self.poll)
+
+    # Decode a small cached file into a PhotoImage and remember it
+    def load_cached(self, key):
+        path = self.cache_path(key)
+        try:
+            with Image.open(path) as image:
+                photo = ImageTk.PhotoImage(image)
+            os.utime(path)
+        except OSError:
+            self.disk_bytes -= self.disk_files.pop(key, 0)
+            return None
+
+        self.disk_files.move_to_end(key)
+        self.photos[key] = photo
+        while len(self.photos) > self.memory_items:
+            self.photos.popitem(last=False)
+        return photo
+
+    def add_disk_file(self, key):
+        size = os.path.getsize(self.cache_path(key))
+        self.disk_bytes += size - self.disk_files.pop(key, 0)
+        self.disk_files[key] = size
+        # Evict the least recently used files once over the cap
+        while self.disk_bytes > self.max_bytes and len(self.disk_files) > 1:
+            old_key, old_size = self.disk_files.popitem(last=False)
+            self.disk_bytes -= old_size
+            try:
+                os.remove(self.cache_path(old_key))
+            except OSError:
+                pass
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
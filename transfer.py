@@ -0,0 +1,384 @@
+import csv
+import gzip
+import json
+import os
+import time
+import uuid
+
+from dates import normalize_date, normalize_timestamp
+from repository import add_implication_ids, implies
+from schema import normalized_or_kept, restore_fts_triggers, schema_version, suspend_fts_triggers
+
+# Streaming backup and restore of a whole catalog.
+#
+# An export is either a JSON Lines file (optionally .gz), holding a header line then one
+# {"table": ..., "row": {...}} line per row, or a directory with manifest.json and one CSV
+# file per table. Rows are read from a cursor in batches and written as they arrive, so
+# memory use does not grow with the catalog.
+#
+# Importing merges the export into a catalog. Ids are remapped: creators and tags are
+# matched by name, images by content hash, and everything else gets new ids. The map from
+# exported to new ids lives in the database, not in memory. Each batch is committed
+# together with a checkpoint, so an interrupted import continues where it stopped when
+# it is run again.
+EXPORT_FORMAT = "image-keeper-export"
+EXPORT_VERSION = 1
+
+# Tables in the order they are written and read back, each parent before its children
+EXPORT_TABLES = ("creators", "tags", "tag_aliases", "tag_implications", "images", "image_tags", "socials")
+EXPORT_ORDER = {
+    "creators": "creator_id",
+    "tags": "tag_id",
+    "tag_aliases": "alias_name",
+    "tag_implications": "tag_id, implied_tag_id",
+    "images": "image_id",
+    "image_tags": "image_id, tag_id",
+    "socials": "social_id",
+}
+# Columns the catalog computes for itself
+DERIVED_COLUMNS = {"tags": {"use_count"}}
+
+# Rows fetched from the cursor at a time while exporting
+EXPORT_FETCH_ROWS = 1000
+# Rows written in each import transaction
+IMPORT_BATCH_ROWS = 1000
+# Ids looked up per IN (...) query
+ID_LOOKUP_CHUNK = 500
+
+def table_columns(cursor, table):
+    return list(column_types(cursor, table))
+
+# Exported columns of a table and their declared types, in table order
+def column_types(cursor, table):
+    return {column[1]: column[2] for column in cursor.execute("PRAGMA table_info({})".format(table))
+            if column[1] not in DERIVED_COLUMNS.get(table, ())}
+
+# Rows of a table as dicts, fetched a batch at a time
+def iter_table(conn, table):
+    cursor = conn.cursor()
+    columns = table_columns(cursor, table)
+    cursor.execute("SELECT {} FROM {} ORDER BY {}".format(", ".join(columns), table, EXPORT_ORDER[table]))
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_ROWS)
+        if not rows:
+            return
+        for row in rows:
+            yield dict(zip(columns, row))
+
+def open_text(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+# Write every table to path; a path ending in .jsonl(.gz) gets JSON Lines, anything else
+# a directory of CSV files. Returns the number of rows written per table.
+def export_catalog(conn, path, report=print):
+    header = {"format": EXPORT_FORMAT, "version": EXPORT_VERSION, "export_id": uuid.uuid4().hex,
+              "schema_version": schema_version(conn), "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              "tables": list(EXPORT_TABLES)}
+    counts = {}
+
+    # One read transaction, so the tables are a consistent snapshot
+    conn.execute("BEGIN")
+    try:
+        if path.endswith((".jsonl", ".jsonl.gz")):
+            with open_text(path, "w") as output:
+                output.write(json.dumps(header) + "\n")
+                for table in EXPORT_TABLES:
+                    counts[table] = 0
+                    for row in iter_table(conn, table):
+                        output.write(json.dumps({"table": table, "row": row}) + "\n")
+                        counts[table] += 1
+                    report("Exported {} {}".format(counts[table], table))
+        else:
+            os.makedirs(path, exist_ok=True)
+            for table in EXPORT_TABLES:
+                counts[table] = 0
+                with open_text(os.path.join(path, table + ".csv"), "w") as output:
+                    writer = csv.writer(output)
+                    writer.writerow(table_columns(conn.cursor(), table))
+                    for row in iter_table(conn, table):
+                        # Empty cells read back as NULL
+                        writer.writerow(["" if value is None else value for value in row.values()])
+                        counts[table] += 1
+                report("Exported {} {}".format(counts[table], table))
+            # Written last, so a directory without it is an incomplete export. CSV cells are
+            # all text, so the manifest records which columns to read back as numbers.
+            types = {table: column_types(conn.cursor(), table) for table in EXPORT_TABLES}
+            with open(os.path.join(path, "manifest.json"), "w", encoding="utf-8") as manifest:
+                json.dump(dict(header, counts=counts, columns=types), manifest, indent=2)
+    finally:
+        conn.rollback()
+    return counts
+
+# Read an export's header and its rows as (table, row, position) from a position onwards.
+# A position is where reading can resume after the row it came with.
+def read_export(path):
+    if os.path.isdir(path):
+        with open(os.path.join(path, "manifest.json"), encoding="utf-8") as manifest:
+            header = json.load(manifest)
+        return header, lambda position: read_csv_rows(path, header, position)
+
+    with open_text(path, "r") as source:
+        header = json.loads(source.readline())
+    return header, lambda position: read_jsonl_rows(path, position)
+
+def read_jsonl_rows(path, position):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as source:
+        # Positions are byte offsets; the header line is skipped on a fresh start
+        if position is None:
+            source.readline()
+        else:
+            source.seek(position["offset"])
+        for line in iter(source.readline, b""):
+            record = json.loads(line)
+            yield record["table"], record["row"], {"offset": source.tell()}
+
+def read_csv_rows(path, header, position):
+    done_tables, done_rows = (position["tables"], position["rows"]) if position else (0, 0)
+    for table_index, table in enumerate(header["tables"]):
+        if table_index < done_tables:
+            continue
+        with open_text(os.path.join(path, table + ".csv"), "r") as source:
+            reader = csv.reader(source)
+            columns = next(reader)
+            types = header["columns"][table]
+            convert = [int if types.get(column) == "INTEGER" else float if types.get(column) == "REAL" else str
+                       for column in columns]
+            for row_number, values in enumerate(reader, start=1):
+                if table_index == done_tables and row_number <= done_rows:
+                    continue
+                row = {column: (to_type(value) if value != "" else None)
+                       for column, to_type, value in zip(columns, convert, values)}
+                yield table, row, {"tables": table_index, "rows": row_number}
+
+def create_import_tables(cursor):
+    # Exported id -> id in this catalog, per table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS import_id_map (
+                          export_id TEXT, table_name TEXT, old_id INTEGER, new_id INTEGER,
+                          PRIMARY KEY (export_id, table_name, old_id)
+                      ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS import_checkpoint (
+                          export_id TEXT PRIMARY KEY, position TEXT, counts TEXT
+                      )''')
+
+# Import the export at path into the catalog, resuming an interrupted run of the same export.
+# Returns the number of rows read per table.
+def import_catalog(conn, path, report=print):
+    header, read_rows = read_export(path)
+    if header.get("format") != EXPORT_FORMAT or header.get("version", 0) > EXPORT_VERSION:
+        raise ValueError("{} is not an export this version can read".format(path))
+    export_id = header["export_id"]
+
+    cursor = conn.cursor()
+    create_import_tables(cursor)
+    conn.commit()
+    checkpoint = cursor.execute("SELECT position, counts FROM import_checkpoint WHERE export_id = ?",
+                                (export_id,)).fetchone()
+    position = json.loads(checkpoint[0]) if checkpoint else None
+    counts = json.loads(checkpoint[1]) if checkpoint else {}
+    if checkpoint:
+        report("Resuming import of {} after {} rows".format(path, sum(counts.values())))
+
+    columns = {table: set(table_columns(cursor, table)) for table in EXPORT_TABLES}
+    batch = []
+    batch_table = None
+    for table, row, row_position in read_rows(position):
+        if table not in columns:
+            continue
+        if batch and (table != batch_table or len(batch) >= IMPORT_BATCH_ROWS):
+            write_batch(conn, export_id, batch_table, batch, columns[batch_table], position, counts, report)
+        if table != batch_table:
+            batch = []
+            batch_table = table
+        batch.append(row)
+        position = row_position
+    if batch:
+        write_batch(conn, export_id, batch_table, batch, columns[batch_table], position, counts, report)
+
+    # Finished: the id map and checkpoint are only needed to resume
+    cursor.execute("DELETE FROM import_id_map WHERE export_id = ?", (export_id,))
+    cursor.execute("DELETE FROM import_checkpoint WHERE export_id = ?", (export_id,))
+    conn.commit()
+    return counts
+
+# Write one batch of rows from a table and the checkpoint after it, in one transaction
+def write_batch(conn, export_id, table, rows, columns, position, counts, report):
+    cursor = conn.cursor()
+    # Holding the write lock keeps new image ids in one range (see import_images)
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        suspend_fts_triggers(cursor)
+        touched_images = IMPORTERS[table](cursor, export_id, rows, columns)
+        # Restoring only adds links, so the touched tags are those of the touched images
+        touched_tags = [row[0] for row in cursor.execute(
+            "SELECT DISTINCT tag_id FROM image_tags WHERE image_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(touched_images)),))]
+        restore_fts_triggers(cursor, touched_images, touched_tags)
+
+        done = dict(counts)
+        done[table] = done.get(table, 0) + len(rows)
+        cursor.execute("INSERT OR REPLACE INTO import_checkpoint (export_id, position, counts) VALUES (?, ?, ?)",
+                       (export_id, json.dumps(position), json.dumps(done)))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    counts.update(done)
+    rows.clear()
+    report("Imported {} {}".format(counts[table], table))
+
+def save_ids(cursor, export_id, table, pairs):
+    cursor.executemany("INSERT OR REPLACE INTO import_id_map (export_id, table_name, old_id, new_id) VALUES (?, ?, ?, ?)",
+                       [(export_id, table, old_id, new_id) for old_id, new_id in pairs])
+
+# New ids of exported ids, as a dict; ids that were never imported are left out
+def mapped_ids(cursor, export_id, table, old_ids):
+    old_ids = list({old_id for old_id in old_ids if old_id is not None})
+    mapping = {}
+    for start in range(0, len(old_ids), ID_LOOKUP_CHUNK):
+        chunk = old_ids[start:start + ID_LOOKUP_CHUNK]
+        cursor.execute("SELECT old_id, new_id FROM import_id_map WHERE export_id = ? AND table_name = ? "
+                       "AND old_id IN ({})".format(",".join("?" * len(chunk))), [export_id, table] + chunk)
+        mapping.update(cursor.fetchall())
+    return mapping
+
+# Look up names in a table with a unique name column, as a dict of name -> id
+def ids_by_name(cursor, table, id_column, name_column, names):
+    names = list(set(names))
+    found = {}
+    for start in range(0, len(names), ID_LOOKUP_CHUNK):
+        chunk = names[start:start + ID_LOOKUP_CHUNK]
+        cursor.execute("SELECT {}, {} FROM {} WHERE {} IN ({})".format(
+            name_column, id_column, table, name_column, ",".join("?" * len(chunk))), chunk)
+        found.update(cursor.fetchall())
+    return found
+
+# Creators and tags already in the catalog are kept as they are and reused
+def import_named(cursor, export_id, rows, columns, table, id_column, name_column):
+    names = [row[name_column] for row in rows]
+    existing = ids_by_name(cursor, table, id_column, name_column, names)
+    insert_columns = [column for column in rows[0] if column in columns and column != id_column]
+    cursor.executemany("INSERT OR IGNORE INTO {} ({}) VALUES ({})".format(
+        table, ", ".join(insert_columns), ", ".join("?" * len(insert_columns))),
+        [[row[column] for column in insert_columns] for row in rows if row[name_column] not in existing])
+    new_ids = ids_by_name(cursor, table, id_column, name_column, names)
+    save_ids(cursor, export_id, table, [(row[id_column], new_ids[row[name_column]]) for row in rows])
+    return ()
+
+def import_creators(cursor, export_id, rows, columns):
+    return import_named(cursor, export_id, rows, columns, "creators", "creator_id", "creator_name")
+
+def import_tags(cursor, export_id, rows, columns):
+    # Names that are aliases here map onto the tag they stand for
+    aliased = ids_by_name(cursor, "tag_aliases", "tag_id", "alias_name", [row["tag_name"] for row in rows])
+    save_ids(cursor, export_id, "tags", [(row["tag_id"], aliased[row["tag_name"]]) for row in rows if row["tag_name"] in aliased])
+    rows = [row for row in rows if row["tag_name"] not in aliased]
+    return import_named(cursor, export_id, rows, columns, "tags", "tag_id", "tag_name") if rows else ()
+
+# Names already used here by a tag or an alias are left as they are
+def import_tag_aliases(cursor, export_id, rows, columns):
+    tags = mapped_ids(cursor, export_id, "tags", [row["tag_id"] for row in rows])
+    cursor.executemany('''INSERT OR IGNORE INTO tag_aliases (alias_name, tag_id)
+                          SELECT ?1, ?2 WHERE NOT EXISTS (SELECT 1 FROM tags WHERE tag_name = ?1)''',
+                       [(row["alias_name"], tags[row["tag_id"]]) for row in rows if row["tag_id"] in tags])
+    return ()
+
+# Implications that would make a tag imply itself together with this catalog's own are skipped
+def import_tag_implications(cursor, export_id, rows, columns):
+    tags = mapped_ids(cursor, export_id, "tags", [row["tag_id"] for row in rows] + [row["implied_tag_id"] for row in rows])
+    for row in rows:
+        tag_id, implied_id = tags.get(row["tag_id"]), tags.get(row["implied_tag_id"])
+        if tag_id is not None and implied_id is not None and tag_id != implied_id and not implies(cursor, implied_id, tag_id):
+            add_implication_ids(cursor, tag_id, implied_id)
+    return ()
+
+def import_images(cursor, export_id, rows, columns):
+    creators = mapped_ids(cursor, export_id, "creators", [row.get("creator_id") for row in rows])
+
+    # Images whose content is already catalogued map onto the existing row
+    hashes = [row["content_hash"] for row in rows if row.get("content_hash")]
+    known = {}
+    for start in range(0, len(hashes), ID_LOOKUP_CHUNK):
+        chunk = hashes[start:start + ID_LOOKUP_CHUNK]
+        cursor.execute("SELECT content_hash, MIN(image_id) FROM images WHERE content_hash IN ({}) "
+                       "GROUP BY content_hash".format(",".join("?" * len(chunk))), chunk)
+        known.update(cursor.fetchall())
+    # Images catalogued before content hashes have none; they match an image with the same
+    # file name and path, so restoring a backup again doesn't add them twice
+    paths = list({(row.get("filename"), row.get("directory_path")) for row in rows if not row.get("content_hash")})
+    known_paths = {}
+    if paths:
+        cursor.execute('''SELECT json_extract(j.value, '$[0]'), json_extract(j.value, '$[1]'),
+                                 (SELECT MIN(i.image_id) FROM images AS i WHERE i.filename = json_extract(j.value, '$[0]')
+                                  AND i.directory_path IS json_extract(j.value, '$[1]'))
+                          FROM json_each(?) AS j''', (json.dumps(paths),))
+        known_paths = {(filename, path): image_id for filename, path, image_id in cursor.fetchall() if image_id is not None}
+
+    pairs = []
+    # The first row of each image not yet catalogued, by the key it is matched on; later rows
+    # of the same image in the backup map onto the id the first one gets
+    new_rows = {}
+    repeats = []
+    for row in rows:
+        key = row["content_hash"] if row.get("content_hash") else (row.get("filename"), row.get("directory_path"))
+        image_id = known.get(key) if row.get("content_hash") else known_paths.get(key)
+        if image_id is not None:
+            pairs.append((row["image_id"], image_id))
+        elif key in new_rows:
+            repeats.append((row["image_id"], key))
+        else:
+            new_rows[key] = row
+
+    if new_rows:
+        insert_columns = [column for column in next(iter(new_rows.values())) if column in columns and column != "image_id"]
+        values = []
+        for row in new_rows.values():
+            # Exports from before dates were normalized still hold the old text
+            row = dict(row, creator_id=creators.get(row.get("creator_id")),
+                       date_added=normalized_or_kept(normalize_timestamp, row.get("date_added")),
+                       date_uploaded=normalized_or_kept(normalize_date, row.get("date_uploaded")))
+            values.append([row[column] for column in insert_columns])
+
+        # Ids are allocated in order inside the transaction, so they can be read back by range
+        cursor.execute("SELECT COALESCE(MAX(image_id), 0) FROM images")
+        last_id = cursor.fetchone()[0]
+        cursor.executemany("INSERT INTO images ({}) VALUES ({})".format(
+            ", ".join(insert_columns), ", ".join("?" * len(insert_columns))), values)
+        cursor.execute("SELECT image_id FROM images WHERE image_id > ? ORDER BY image_id", (last_id,))
+        new_ids = [row[0] for row in cursor.fetchall()]
+        added = dict(zip(new_rows, new_ids))
+        pairs.extend(zip([row["image_id"] for row in new_rows.values()], new_ids))
+        pairs.extend((old_id, added[key]) for old_id, key in repeats)
+
+    save_ids(cursor, export_id, "images", pairs)
+    return list({new_id for _, new_id in pairs})
+
+def import_image_tags(cursor, export_id, rows, columns):
+    images = mapped_ids(cursor, export_id, "images", [row["image_id"] for row in rows])
+    tags = mapped_ids(cursor, export_id, "tags", [row["tag_id"] for row in rows])
+    links = {(images[row["image_id"]], tags[row["tag_id"]]) for row in rows
+             if row["image_id"] in images and row["tag_id"] in tags}
+    cursor.executemany("INSERT OR IGNORE INTO image_tags (image_id, tag_id) VALUES (?, ?)", links)
+    return {image_id for image_id, _ in links}
+
+def import_socials(cursor, export_id, rows, columns):
+    creators = mapped_ids(cursor, export_id, "creators", [row.get("creator_id") for row in rows])
+    # A handle already listed for the creator is not added twice
+    cursor.executemany('''INSERT INTO socials (creator_id, social_handle, social_type)
+                          SELECT ?1, ?2, ?3 WHERE NOT EXISTS (
+                              SELECT 1 FROM socials WHERE creator_id IS ?1 AND social_handle IS ?2 AND social_type IS ?3)''',
+                       [(creators.get(row.get("creator_id")), row.get("social_handle"), row.get("social_type"))
+                        for row in rows])
+    return ()
+
+IMPORTERS = {
+    "creators": import_creators,
+    "tags": import_tags,
+    "tag_aliases": import_tag_aliases,
+    "tag_implications": import_tag_implications,
+    "images": import_images,
+    "image_tags": import_image_tags,
+    "socials": import_socials,
+}
@@ -0,0 +1,88 @@
+import json
+import os
+import queue
+import threading
+
+from dates import TIMESTAMP_FORMAT
+from repository import open_connection
+
+# Reclaims the trash left by repository.delete_images.
+#
+# Deleted images stay restorable for a while, with their files still in the image folder.
+# Once a batch is older than the retention period it is forgotten and the files no image
+# has used since are removed. Each batch is forgotten and committed before its files are
+# touched, so an interrupted run can leave unused files behind, which the integrity check
+# reports as orphans, but never an image whose file is gone.
+
+# Seconds deleted images can be restored before their files are removed
+TRASH_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+# Ids of the batches deleted more than retention_seconds ago, oldest first
+def expired_batches(cursor, retention_seconds):
+    cursor.execute("SELECT batch_id FROM trash_batches WHERE deleted_at <= strftime(?, 'now', ?) ORDER BY batch_id",
+                   (TIMESTAMP_FORMAT, "-{} seconds".format(retention_seconds)))
+    return [row[0] for row in cursor.fetchall()]
+
+# Forget trash batches, returning the paths of their files that no image uses.
+# Images imported since may have reused a file, which then stays.
+def forget_batches(cursor, batch_ids):
+    batch_ids = json.dumps(list(batch_ids))
+    cursor.execute('''SELECT path FROM trash_files AS tf WHERE batch_id IN (SELECT value FROM json_each(?))
+                      AND NOT EXISTS (SELECT 1 FROM images AS i WHERE i.directory_path = tf.path)''', (batch_ids,))
+    paths = [row[0] for row in cursor.fetchall()]
+    cursor.execute("DELETE FROM trash_batches WHERE batch_id IN (SELECT value FROM json_each(?))", (batch_ids,))
+    return paths
+
+# Remove files, returning how many were removed; files already gone count as removed
+def remove_files(paths):
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            print("Could not delete {}: {}".format(path, error))
+            continue
+        removed += 1
+    return removed
+
+# Empties expired trash batches on a background thread, or the given ones whatever their age
+class TrashCollector:
+    def __init__(self, database_path, retention_seconds=TRASH_RETENTION_SECONDS, batch_ids=None):
+        self.database_path = database_path
+        self.retention_seconds = retention_seconds
+        self.batch_ids = batch_ids
+        # Messages for the UI thread: ("removed", files), ("done", (batches, files)) or ("error", message)
+        self.progress = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        conn = open_connection(self.database_path)
+        try:
+            self.progress.put(("done", self.collect(conn)))
+        except Exception as error:
+            conn.rollback()
+            self.progress.put(("error", str(error)))
+        finally:
+            conn.close()
+
+    def collect(self, conn):
+        cursor = conn.cursor()
+        if self.batch_ids is None:
+            batch_ids = expired_batches(cursor, self.retention_seconds)
+        else:
+            batch_ids = list(self.batch_ids)
+        removed = 0
+        for batch_id in batch_ids:
+            # Hold the write lock from the start, so an undo or import in another instance
+            # can't use a file between it being picked and the batch being forgotten
+            cursor.execute("BEGIN IMMEDIATE")
+            paths = forget_batches(cursor, [batch_id])
+            conn.commit()
+            removed += remove_files(paths)
+            self.progress.put(("removed", removed))
+        return len(batch_ids), removed